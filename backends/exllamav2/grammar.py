@@ -1,17 +1,24 @@
+import asyncio
+import hashlib
+import json
 import traceback
 import typing
-from functools import lru_cache
-from typing import List
+from copy import copy
+from typing import Dict, List, Optional, Union
 
+import kbnf
 import torch
 from exllamav2 import ExLlamaV2, ExLlamaV2Tokenizer
 from exllamav2.generator.filters import ExLlamaV2Filter
 from formatron.extractor import NonterminalExtractor
 from formatron.formatter import FormatterBuilder
-from formatron.integrations.exllamav2 import FormatterFilter, create_engine_vocabulary
+from formatron.integrations.exllamav2 import FormatterFilter
 from formatron.schemas import json_schema
 from loguru import logger
 
+from common.concurrency import cpu_pool
+from common.lru_cache import LRUCache
+
 
 class ExLlamaV2Grammar:
     """ExLlamaV2 class for various grammar filters/parsers."""
@@ -21,95 +28,233 @@ class ExLlamaV2Grammar:
     def __init__(self):
         self.filters = []
 
-    def add_json_schema_filter(
-        self,
-        schema: dict,
-        model: ExLlamaV2,
-        tokenizer: ExLlamaV2Tokenizer,
-    ):
+    async def add_json_schema_filter(self, schema: dict, grammar_cache: "GrammarCache"):
         """Adds an ExllamaV2 filter based on a JSON schema."""
 
-        # Create the parser
-        try:
-            # Add fields required by formatron if not present
-            if "$id" not in schema:
-                schema["$id"] = "https://example.com/example.json"
-            if "$schema" not in schema:
-                schema["$schema"] = "http://json-schema.org/draft-07/schema#"
-
-            # Validate schema and create formatter
-            schema = json_schema.create_schema(schema)
-            f = FormatterBuilder()
-            f.append_line(f"{f.json(schema)}")
-        except Exception:
-            traceback.print_exc()
-            logger.error(
-                "Skipping because the JSON schema couldn't be parsed. "
-                "Please read the above error for more information."
-            )
+        await self._add_filter("json_schema", schema, grammar_cache)
 
-            return
+    async def add_regex_filter(self, pattern: str, grammar_cache: "GrammarCache"):
+        """Adds an ExllamaV2 filter based on regular expressions."""
 
-        lmfilter = _create_formatter_filter(model, tokenizer, f)
+        await self._add_filter("regex", pattern, grammar_cache)
 
-        # Append the filters
-        self.filters.append(lmfilter)
+    async def add_kbnf_filter(self, kbnf_string: str, grammar_cache: "GrammarCache"):
+        """Adds an ExllamaV2 filter based on KBNF grammar."""
 
-    def add_regex_filter(
-        self,
-        pattern: str,
-        model: ExLlamaV2,
-        tokenizer: ExLlamaV2Tokenizer,
+        await self._add_filter("kbnf", kbnf_string, grammar_cache)
+
+    async def _add_filter(
+        self, kind: str, source: Union[str, dict], grammar_cache: "GrammarCache"
     ):
-        """Adds an ExllamaV2 filter based on regular expressions."""
+        lmfilter = await grammar_cache.get_filter(kind, source)
 
-        # Create the parser
-        try:
-            # Validate regex and create formatter
-            f = FormatterBuilder()
-            f.append_line(f"{f.regex(pattern)}")
-        except Exception:
-            traceback.print_exc()
-            logger.error(
-                "Skipping because the regex pattern couldn't be parsed. "
-                "Please read the above error for more information."
-            )
+        # Invalid grammars are skipped
+        if lmfilter:
+            self.filters.append(lmfilter)
+
+
+def _create_json_schema_formatter(schema: dict):
+    """Validates a JSON schema and creates its formatter."""
+
+    # Add fields required by formatron if not present
+    # Copy to keep the request's schema untouched
+    schema = {
+        "$id": "https://example.com/example.json",
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        **schema,
+    }
+
+    schema = json_schema.create_schema(schema)
+    f = FormatterBuilder()
+    f.append_line(f"{f.json(schema)}")
+
+    return f
+
+
+def _create_regex_formatter(pattern: str):
+    """Validates a regex and creates its formatter."""
+
+    f = FormatterBuilder()
+    f.append_line(f"{f.regex(pattern)}")
+
+    return f
+
+
+def _create_kbnf_formatter(kbnf_string: str):
+    """Validates a KBNF grammar and creates its formatter."""
+
+    f = FormatterBuilder()
+    f.append_line(
+        f"""{f.extractor(lambda nonterminal:
+            CFGExtractor(nonterminal, kbnf_string))}"""
+    )
+
+    return f
+
+
+# Formatter factory and name of each grammar kind
+GRAMMAR_KINDS = {
+    "json_schema": (_create_json_schema_formatter, "JSON schema"),
+    "regex": (_create_regex_formatter, "regex pattern"),
+    "kbnf": (_create_kbnf_formatter, "KBNF string"),
+}
+
+
+def grammar_key(kind: str, source: Union[str, dict]) -> str:
+    """Hashes the source of a grammar into its cache key."""
+
+    if not isinstance(source, str):
+        source = json.dumps(source, sort_keys=True, separators=(",", ":"))
+
+    return hashlib.sha256(f"{kind}\0{source}".encode()).hexdigest()
+
+
+def compile_grammar_filter(
+    kind: str,
+    source: Union[str, dict],
+    model: ExLlamaV2,
+    tokenizer: ExLlamaV2Tokenizer,
+    vocabulary: kbnf.Vocabulary,
+) -> Optional[FormatterFilter]:
+    """Compiles a grammar into a filter. Returns None if it's invalid."""
+
+    create_formatter, name = GRAMMAR_KINDS[kind]
+
+    # Create the parser
+    try:
+        f = create_formatter(source)
+    except Exception:
+        traceback.print_exc()
+        logger.error(
+            f"Skipping because the {name} couldn't be parsed. "
+            "Please read the above error for more information."
+        )
 
-            return
+        return None
 
-        lmfilter = _create_formatter_filter(model, tokenizer, f)
+    return _create_formatter_filter(model, tokenizer, vocabulary, f)
 
-        # Append the filters
-        self.filters.append(lmfilter)
 
-    def add_kbnf_filter(
+def _clone_formatter_filter(lmfilter: FormatterFilter) -> FormatterFilter:
+    """
+    Returns a copy of a compiled filter with its own matcher state.
+
+    FormatterFilter.clone shares the formatter's engine between copies, so
+    the engine is copied here instead. Copies of a kbnf engine share its
+    compiled grammar.
+    """
+
+    formatter = copy(lmfilter._formatter)
+    formatter._engine = copy(formatter._engine)
+    formatter._captures = {}
+    formatter._token_id_or_bytes = []
+
+    return FormatterFilter(
+        lmfilter.model, lmfilter.tokenizer, formatter, lmfilter._config
+    )
+
+
+class GrammarCache:
+    """
+    Compiled grammar filters of a model, keyed by a hash of their source.
+
+    Compiling a large JSON schema takes hundreds of milliseconds, so every
+    unique grammar is compiled once on the CPU worker pool. Concurrent
+    requests for the same grammar wait on the same compilation. Cached
+    filters are never run, and every job gets its own clone.
+    """
+
+    def __init__(
         self,
-        kbnf_string: str,
         model: ExLlamaV2,
         tokenizer: ExLlamaV2Tokenizer,
+        vocabulary: kbnf.Vocabulary,
+        max_size: int = 32,
     ):
-        """Adds an ExllamaV2 filter based on KBNF grammar."""
+        self.model = model
+        self.tokenizer = tokenizer
+        self.vocabulary = vocabulary
+        self.filters: LRUCache[FormatterFilter] = LRUCache(max_size=max_size)
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    async def get_filter(
+        self, kind: str, source: Union[str, dict]
+    ) -> Optional[FormatterFilter]:
+        """Returns a fresh filter for a grammar, compiling it on a miss."""
+
+        key = grammar_key(kind, source)
+        lmfilter = self.filters.get(key)
 
-        # Create the parser
+        if lmfilter is None:
+            task = self.pending.get(key)
+            if task is None:
+                task = asyncio.create_task(self._compile(key, kind, source))
+                self.pending[key] = task
+
+            # Don't cancel a shared compilation if this request disconnects
+            lmfilter = await asyncio.shield(task)
+
+            if lmfilter is None:
+                return None
+
+        return _clone_formatter_filter(lmfilter)
+
+    async def _compile(self, key: str, kind: str, source: Union[str, dict]):
         try:
-            # Validate KBNF and create formatter
-            f = FormatterBuilder()
-            f.append_line(
-                f"""{f.extractor(lambda nonterminal:
-                    CFGExtractor(nonterminal, kbnf_string))}"""
-            )
-        except Exception:
-            logger.error(
-                "Skipping because the KBNF string couldn't be parsed. "
-                "Please read the above error for more information."
+            lmfilter = await cpu_pool.run(
+                compile_grammar_filter,
+                kind,
+                source,
+                self.model,
+                self.tokenizer,
+                self.vocabulary,
             )
 
-            return
+            if lmfilter is not None:
+                self.filters.put(key, lmfilter)
 
-        lmfilter = _create_formatter_filter(model, tokenizer, f)
+            return lmfilter
+        finally:
+            self.pending.pop(key, None)
 
-        # Append the filters
-        self.filters.append(lmfilter)
+    async def warm(self, schemas: List[dict]):
+        """Compiles JSON schemas ahead of the first request."""
+
+        for schema in schemas:
+            await self.get_filter("json_schema", schema)
+
+        logger.info(f"Compiled {len(schemas)} JSON schema grammar(s) ahead of time.")
+
+    def clear(self):
+        self.filters.clear()
+
+    def stats(self):
+        return self.filters.stats()
+
+
+def get_forced_tokens(filters: List[ExLlamaV2Filter], max_tokens: int) -> List[int]:
+    """
+    Returns the tokens that a job's grammar allows as the only continuation.
+
+    Runs on a copy of the filter's engine, so the filter itself is unchanged.
+    Stops at the first step with more than one allowed token.
+    """
+
+    if len(filters) != 1 or not isinstance(filters[0], FormatterFilter):
+        return []
+
+    engine = copy(filters[0]._formatter._engine)
+    forced_tokens = []
+    while len(forced_tokens) < max_tokens and not engine.is_finished():
+        engine.compute_allowed_token_ids()
+        allowed_tokens = engine.get_allowed_token_ids_from_last_computation()
+        if len(allowed_tokens) != 1:
+            break
+
+        engine.try_accept_new_token(allowed_tokens[0])
+        forced_tokens.append(allowed_tokens[0])
+
+    return forced_tokens
 
 
 class CFGExtractor(NonterminalExtractor):
@@ -128,31 +273,19 @@ class CFGExtractor(NonterminalExtractor):
         return self.kbnf_string.replace("start", self.nonterminal)
 
 
-@lru_cache(1)
-def _create_cached_engine_vocabulary(tokenizer: ExLlamaV2Tokenizer):
-    """Build and cache engine vocabulary on first grammar run"""
-
-    return create_engine_vocabulary(tokenizer)
-
-
 def _create_formatter_filter(
-    model: ExLlamaV2, tokenizer: ExLlamaV2Tokenizer, formatter_builder: FormatterBuilder
+    model: ExLlamaV2,
+    tokenizer: ExLlamaV2Tokenizer,
+    vocabulary: kbnf.Vocabulary,
+    formatter_builder: FormatterBuilder,
 ) -> ExLlamaV2Filter:
     """
     Create a formatter filter for the ExLlamaV2 engine.
     Minimalist clone of formatron.integrations.exllamav2.create_formatter_filter
-    with lru_cache enabled for engine vocabulary
+    which uses the model's prebuilt engine vocabulary
     """
 
-    vocab = _create_cached_engine_vocabulary(tokenizer)
     f = formatter_builder.build(
-        vocab, lambda tokens: tokenizer.decode(torch.tensor(tokens))
+        vocabulary, lambda tokens: tokenizer.decode(torch.tensor(tokens))
     )
     return FormatterFilter(model, tokenizer, f)
-
-
-def clear_grammar_func_cache():
-    """Flush tokenizer_data cache to avoid holding references to
-    tokenizers after unloading a model"""
-
-    _create_cached_engine_vocabulary.cache_clear()
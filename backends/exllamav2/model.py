@@ -3,14 +3,16 @@
 import aiofiles
 import asyncio
 import gc
+import json
 import math
 import pathlib
 import traceback
-from backends.exllamav2.vision import clear_image_embedding_cache
+from backends.exllamav2.vision import ImageEmbeddingCache
+from common.images import ImagePreprocessPolicy, min_limit
 from common.multimodal import MultimodalEmbeddingWrapper
+from common.sampling import GenerationParams
 import torch
 import uuid
-from copy import deepcopy
 from exllamav2 import (
     ExLlamaV2,
     ExLlamaV2Config,
@@ -29,30 +31,38 @@ from exllamav2.generator import (
     ExLlamaV2DynamicGeneratorAsync,
     ExLlamaV2DynamicJobAsync,
 )
-from itertools import zip_longest
 from loguru import logger
 from typing import List, Optional, Union
 
 from ruamel.yaml import YAML
 
 from common.health import HealthManager
-
-from backends.exllamav2.grammar import (
-    ExLlamaV2Grammar,
-    clear_grammar_func_cache,
+from common.accumulator import ResponseAccumulator
+from common.logprobs import TokenLogprobs
+
+from backends.exllamav2.grammar import ExLlamaV2Grammar, GrammarCache
+from backends.exllamav2.profiles import GenerationProfile, profile_key
+from backends.exllamav2.speculation import (
+    MAX_Q_SIZE,
+    SpeculationScheduler,
+    get_draft_stats,
 )
+from backends.exllamav2.token_cache import PrefixTokenCache
+from backends.exllamav2.vocabulary import load_engine_vocabulary
 from backends.exllamav2.utils import (
     exllama_disabled_flash_attn,
+    get_continuation_ids,
     hardware_supports_flash_attn,
     supports_paged_attn,
 )
-from common.concurrency import iterate_in_threadpool
+from common.concurrency import cpu_pool, iterate_in_threadpool, iterate_until
 from common.gen_logging import (
     log_generation_params,
     log_metrics,
     log_prompt,
     log_response,
 )
+from common.lru_cache import LRUCache
 from common.templating import (
     PromptTemplate,
     TemplateLoadError,
@@ -77,7 +87,10 @@ class ExllamaV2Container:
     cache: Optional[ExLlamaV2Cache] = None
     draft_cache: Optional[ExLlamaV2Cache] = None
     tokenizer: Optional[ExLlamaV2Tokenizer] = None
+    id_to_piece: Optional[List[str]] = None
+    token_cache: Optional[PrefixTokenCache] = None
     generator: Optional[ExLlamaV2DynamicGeneratorAsync] = None
+    speculation: Optional[SpeculationScheduler] = None
     prompt_template: Optional[PromptTemplate] = None
     paged: bool = True
 
@@ -86,8 +99,17 @@ class ExllamaV2Container:
     cache_mode: str = "FP16"
     draft_cache_mode: str = "FP16"
     max_batch_size: Optional[int] = None
+    tokenizer_cache_size: int = 64
     generation_config: Optional[GenerationConfig] = None
 
+    # Compiled sampler settings keyed by request params
+    generation_profiles: Optional[LRUCache[GenerationProfile]] = None
+
+    # Compiled grammar filters keyed by their source
+    grammar_cache: Optional[GrammarCache] = None
+    grammar_cache_size: int = 32
+    grammar_schemas: List[dict] = []
+
     # GPU split vars
     gpu_split: List[float] = []
     draft_gpu_split: List[float] = []
@@ -99,6 +121,13 @@ class ExllamaV2Container:
     use_vision: bool = False
     vision_model: Optional[ExLlamaV2VisionTower] = None
 
+    # Image embeddings keyed by a hash of the image
+    image_embedding_cache: Optional[ImageEmbeddingCache] = None
+    vision_cache_bytes: int = 268435456
+
+    # Downscaling applied to images before they're embedded
+    image_policy: Optional[ImagePreprocessPolicy] = None
+
     # Load state
     model_is_loading: bool = False
     model_loaded: bool = False
@@ -121,6 +150,16 @@ class ExllamaV2Container:
         self = cls()
 
         self.quiet = quiet
+        self.generation_profiles = LRUCache(max_size=64)
+        self.tokenizer_cache_size = unwrap(kwargs.get("tokenizer_cache_size"), 64)
+        self.grammar_cache_size = unwrap(kwargs.get("grammar_cache_size"), 32)
+        self.vision_cache_bytes = unwrap(kwargs.get("vision_cache_bytes"), 268435456)
+
+        # JSON schemas which are compiled when the model loads
+        self.grammar_schemas = []
+        for schema_path in unwrap(kwargs.get("grammar_schemas"), []):
+            with open(schema_path, "r", encoding="utf8") as schema_file:
+                self.grammar_schemas.append(json.load(schema_file))
 
         # Initialize config
         self.config = ExLlamaV2Config()
@@ -161,6 +200,16 @@ class ExllamaV2Container:
                 "Please reload with vision disabled."
             )
 
+        # Larger images would fail in the vision tower, so they're downscaled
+        if self.use_vision:
+            self.image_policy = ImagePreprocessPolicy(
+                max_pixels=kwargs.get("vision_max_pixels"),
+                max_side=min_limit(
+                    kwargs.get("vision_max_side"), self.config.vision_max_size
+                ),
+                resample=unwrap(kwargs.get("vision_resample"), "bicubic"),
+            )
+
         # Prepare the draft model config if necessary
         draft_args = unwrap(kwargs.get("draft_model"), {})
         draft_model_name = draft_args.get("draft_model_name")
@@ -517,6 +566,22 @@ class ExllamaV2Container:
 
         return model_params
 
+    def get_stats(self):
+        """Returns runtime statistics of the container's caches."""
+
+        return {
+            "generation_profiles": self.generation_profiles.stats(),
+            "grammar_cache": self.grammar_cache.stats() if self.grammar_cache else None,
+            "image_embedding_cache": (
+                self.image_embedding_cache.stats()
+                if self.image_embedding_cache
+                else None
+            ),
+            "cpu_pool": cpu_pool.stats(),
+            "tokenizer_cache": self.token_cache.stats() if self.token_cache else None,
+            "speculation": self.speculation.stats() if self.speculation else None,
+        }
+
     async def wait_for_jobs(self, skip_wait: bool = False):
         """Polling mechanism to wait for pending generation jobs."""
 
@@ -558,6 +623,7 @@ class ExllamaV2Container:
 
         # Indicate that model load has started
         # Do this operation under the load lock's context
+        vocabulary_task = None
         try:
             await self.load_lock.acquire()
             self.model_is_loading = True
@@ -565,6 +631,14 @@ class ExllamaV2Container:
             # Wait for existing generation jobs to finish
             await self.wait_for_jobs(kwargs.get("skip_wait"))
 
+            # The grammar vocabulary is built while the weights load
+            await asyncio.to_thread(self.load_tokenizer_sync)
+            vocabulary_task = asyncio.create_task(
+                asyncio.to_thread(
+                    load_engine_vocabulary, self.tokenizer, self.model_dir
+                )
+            )
+
             # Streaming gen for model load progress
             model_load_generator = self.load_model_sync(progress_callback)
             async for value in iterate_in_threadpool(model_load_generator):
@@ -573,6 +647,24 @@ class ExllamaV2Container:
             # Create async generator
             await self.create_generator()
 
+            # Report the vocabulary as its own load stage
+            yield 0, 1
+            vocabulary = await vocabulary_task
+            vocabulary_task = None
+            yield 1, 1
+
+            self.grammar_cache = GrammarCache(
+                self.model, self.tokenizer, vocabulary, self.grammar_cache_size
+            )
+
+            if self.vision_model:
+                self.image_embedding_cache = ImageEmbeddingCache(
+                    self.vision_model,
+                    self.model,
+                    self.tokenizer,
+                    self.vision_cache_bytes,
+                )
+
             # Clean up any extra vram usage from torch and cuda
             # (Helps reduce VRAM bottlenecking on Windows)
             gc.collect()
@@ -582,12 +674,37 @@ class ExllamaV2Container:
             self.model_loaded = True
             logger.info("Model successfully loaded.")
         finally:
+            # Don't leave the vocabulary running if the load failed
+            if vocabulary_task is not None:
+                vocabulary_task.cancel()
+                await asyncio.gather(vocabulary_task, return_exceptions=True)
+
             self.load_lock.release()
             self.model_is_loading = False
 
             async with self.load_condition:
                 self.load_condition.notify_all()
 
+    def load_tokenizer_sync(self):
+        """Creates the tokenizer and the caches that depend on it."""
+
+        # Reset tokenizer namespace vars and create a tokenizer
+        ExLlamaV2Tokenizer.unspecial_piece_to_id = {}
+        ExLlamaV2Tokenizer.unspecial_id_to_piece = {}
+        ExLlamaV2Tokenizer.extended_id_to_piece = {}
+        ExLlamaV2Tokenizer.extended_piece_to_id = {}
+
+        self.tokenizer = ExLlamaV2Tokenizer(self.config)
+
+        # Piece table for logprobs, includes special and added tokens
+        self.id_to_piece = self.tokenizer.get_id_to_piece_list(True)
+
+        # Cached prompt prefixes are only valid for this tokenizer
+        if self.tokenizer_cache_size > 0:
+            self.token_cache = PrefixTokenCache(
+                self.tokenizer, self.tokenizer_cache_size * 1024**2
+            )
+
     @torch.inference_mode()
     def load_model_sync(self, progress_callback=None):
         """
@@ -601,16 +718,9 @@ class ExllamaV2Container:
                 def progress(loaded_modules: int, total_modules: int)
 
         Runs under a shared inference mode context.
+        The tokenizer is created beforehand by load_tokenizer_sync.
         """
 
-        # Reset tokenizer namespace vars and create a tokenizer
-        ExLlamaV2Tokenizer.unspecial_piece_to_id = {}
-        ExLlamaV2Tokenizer.unspecial_id_to_piece = {}
-        ExLlamaV2Tokenizer.extended_id_to_piece = {}
-        ExLlamaV2Tokenizer.extended_piece_to_id = {}
-
-        self.tokenizer = ExLlamaV2Tokenizer(self.config)
-
         # Calculate autosplit reserve for all GPUs
         gpu_count = torch.cuda.device_count()
         autosplit_reserve = self.autosplit_reserve + [0] * (
@@ -788,6 +898,10 @@ class ExllamaV2Container:
                 tokenizer=self.tokenizer,
                 max_batch_size=self.max_batch_size,
                 paged=self.paged,
+                max_q_size=MAX_Q_SIZE,
+            )
+            self.speculation = SpeculationScheduler(
+                self.generator, max_q_size=MAX_Q_SIZE
             )
 
             # Update the state of the container var
@@ -867,11 +981,11 @@ class ExllamaV2Container:
                 # Wait for other jobs to finish
                 await self.wait_for_jobs(kwargs.get("skip_wait"))
 
-            # Delete references held in the grammar module
-            clear_grammar_func_cache()
-
-            # Clear the image embedding cache
-            clear_image_embedding_cache()
+            # Compiled profiles hold tokenizer-specific tensors
+            logger.info(
+                f"Generation profile cache stats: {self.generation_profiles.stats()}"
+            )
+            self.generation_profiles.clear()
 
             # Unload LoRAs
             if self.generator and self.generator.generator.current_loras:
@@ -896,6 +1010,15 @@ class ExllamaV2Container:
 
                 self.vision_model = None
 
+                # Embeddings are kept when only LoRAs are unloaded
+                if self.image_embedding_cache:
+                    logger.info(
+                        "Image embedding cache stats: "
+                        f"{self.image_embedding_cache.stats()}"
+                    )
+                    self.image_embedding_cache.clear()
+                self.image_embedding_cache = None
+
                 if self.draft_model:
                     self.draft_model.unload()
                 self.draft_model = None
@@ -903,6 +1026,16 @@ class ExllamaV2Container:
                 self.config = None
                 self.cache = None
                 self.tokenizer = None
+                self.id_to_piece = None
+
+                if self.token_cache:
+                    logger.info(f"Tokenizer cache stats: {self.token_cache.stats()}")
+                self.token_cache = None
+
+                # Compiled grammars and the vocabulary hold the tokenizer
+                if self.grammar_cache:
+                    logger.info(f"Grammar cache stats: {self.grammar_cache.stats()}")
+                self.grammar_cache = None
 
                 # Cleanup the generator from any pending jobs
                 if self.generator is not None:
@@ -929,12 +1062,18 @@ class ExllamaV2Container:
 
         mm_embeddings: MultimodalEmbeddingWrapper = kwargs.get("embeddings")
         mm_embeddings_content = mm_embeddings.content if mm_embeddings else []
+        add_bos_token = unwrap(kwargs.get("add_bos_token"), True)
+        encode_special_tokens = unwrap(kwargs.get("encode_special_tokens"), True)
+
+        # Cached segments are only valid for text split on special tokens
+        if self.token_cache and encode_special_tokens and not mm_embeddings_content:
+            return self.token_cache.encode(text, add_bos_token)
 
         return (
             self.tokenizer.encode(
                 text,
-                add_bos=unwrap(kwargs.get("add_bos_token"), True),
-                encode_special_tokens=unwrap(kwargs.get("encode_special_tokens"), True),
+                add_bos=add_bos_token,
+                encode_special_tokens=encode_special_tokens,
                 embeddings=mm_embeddings_content,
             )
             .flatten()
@@ -962,154 +1101,201 @@ class ExllamaV2Container:
         }
 
     def get_logprobs(self, token_ids: torch.Tensor, token_probs: torch.Tensor):
-        top_tokens = [
-            self.tokenizer.extended_id_to_piece.get(
-                index, self.tokenizer.get_id_to_piece_list(True)[index]
-            )
-            for index in token_ids.flatten().tolist()
-        ]
+        """
+        Converts a chunk of top-k tensors into logprob rows.
 
-        top_values = torch.log(token_probs).flatten().tolist()
+        Both tensors are (1, tokens, k). The first entry of each row is
+        the selected token.
+        """
 
-        # Cannot return -inf in JSON
-        cleaned_values = [
-            -1000 if value == float("-inf") else value for value in top_values
-        ]
+        # One host transfer per tensor for the whole chunk
+        id_rows = token_ids.flatten(end_dim=-2).tolist()
 
-        return dict(zip_longest(top_tokens, cleaned_values))
+        # Cannot return -inf in JSON
+        logprob_rows = (
+            torch.log(token_probs).flatten(end_dim=-2).nan_to_num(neginf=-1000.0)
+        ).tolist()
+
+        id_to_piece = self.id_to_piece
+        piece_rows = [[id_to_piece[index] for index in row] for row in id_rows]
+
+        return TokenLogprobs(
+            token_ids=[row[0] for row in id_rows],
+            tokens=[row[0] for row in piece_rows],
+            token_logprobs=[row[0] for row in logprob_rows],
+            top_tokens=piece_rows,
+            top_logprobs=logprob_rows,
+        )
 
     async def generate(
         self,
         prompt: str,
         request_id: str,
+        params: GenerationParams,
         abort_event: asyncio.Event = None,
-        **kwargs,
+        embeddings: Optional[MultimodalEmbeddingWrapper] = None,
+        context_ids: Optional[torch.Tensor] = None,
     ):
         """Generate a response to a prompt."""
-        generations = []
+
+        generations = await self.generate_choices(
+            prompt,
+            request_id,
+            params.replace(n=1, best_of=None),
+            abort_event,
+            embeddings,
+            context_ids,
+        )
+
+        return generations[0]
+
+    async def generate_choices(
+        self,
+        prompt: str,
+        request_id: str,
+        params: GenerationParams,
+        abort_event: asyncio.Event = None,
+        embeddings: Optional[MultimodalEmbeddingWrapper] = None,
+        context_ids: Optional[torch.Tensor] = None,
+    ):
+        """
+        Generate n responses to a prompt in a single batch.
+
+        If best_of is larger than n, best_of candidates are generated and
+        the n with the highest cumulative logprob are returned.
+        """
+
+        num_choices = unwrap(params.n, 1)
+        num_jobs = max(unwrap(params.best_of, num_choices), num_choices)
+
+        accumulators = [ResponseAccumulator() for _ in range(num_jobs)]
+        last_generations: List[Optional[dict]] = [None] * num_jobs
+        finish_generations: List[Optional[dict]] = [None] * num_jobs
         async for generation in self.generate_gen(
-            prompt, request_id, abort_event, **kwargs
+            prompt, request_id, params, abort_event, embeddings, context_ids
         ):
-            generations.append(generation)
-
-        joined_generation = {
-            "text": "",
-            "prompt_tokens": 0,
-            "generation_tokens": 0,
-            "tool_calls": None,
-            "offset": [],
-            "token_probs": {},
-            "logprobs": [],
-        }
+            index = generation.get("index", 0)
+
+            # The finish_reason generation is always the last one
+            if "finish_reason" in generation:
+                finish_generations[index] = generation
+                continue
+
+            accumulators[index].append(
+                generation.get("text"),
+                unwrap(generation.get("offset"), -1),
+                generation.get("logprobs"),
+            )
+            last_generations[index] = generation
 
-        if generations:
-            # Get finish_reason first and then shift where -1 points to
-            if "finish_reason" in generations[-1]:
-                finish_reason_gen = generations.pop()
-                joined_generation["finish_reason"] = finish_reason_gen.get(
+        joined_generations = []
+        for accumulator, last_generation, finish_generation in zip(
+            accumulators, last_generations, finish_generations, strict=True
+        ):
+            joined_generation = {
+                "text": accumulator.text,
+                "prompt_tokens": 0,
+                "generation_tokens": 0,
+                "tool_calls": None,
+                "offset": accumulator.offsets,
+                "logprobs": accumulator.logprobs,
+                "cumulative_logprob": 0.0,
+            }
+
+            if finish_generation:
+                joined_generation["finish_reason"] = finish_generation.get(
                     "finish_reason"
                 )
-                joined_generation["stop_str"] = finish_reason_gen.get("stop_str")
-            else:
+                joined_generation["stop_str"] = finish_generation.get("stop_str")
+                joined_generation["cumulative_logprob"] = finish_generation.get(
+                    "cumulative_logprob", 0.0
+                )
+
+                if "context_ids" in finish_generation:
+                    joined_generation["context_ids"] = finish_generation["context_ids"]
+            elif last_generation:
                 joined_generation["finish_reason"] = "stop"
 
-        if len(generations) > 0:
-            for generation in generations:
-                joined_generation["text"] += unwrap(generation.get("text"), "")
-                joined_generation["offset"].append(unwrap(generation.get("offset"), -1))
-                joined_generation["token_probs"].update(
-                    unwrap(generation.get("token_probs"), {})
+            if last_generation:
+                joined_generation["prompt_tokens"] = unwrap(
+                    last_generation.get("prompt_tokens"), 0
                 )
-
-                # Include empty logprob dicts for index preservation
-                joined_generation["logprobs"].append(
-                    unwrap(generation.get("logprobs"), {})
+                joined_generation["generated_tokens"] = unwrap(
+                    last_generation.get("generated_tokens"), 0
                 )
 
-            joined_generation["prompt_tokens"] = unwrap(
-                generations[-1].get("prompt_tokens"), 0
-            )
-            joined_generation["generated_tokens"] = unwrap(
-                generations[-1].get("generated_tokens"), 0
-            )
+            joined_generations.append(joined_generation)
 
-        return joined_generation
+        # Rank best_of candidates, highest cumulative logprob first
+        if num_jobs > num_choices:
+            joined_generations = sorted(
+                joined_generations,
+                key=lambda generation: generation["cumulative_logprob"],
+                reverse=True,
+            )[:num_choices]
 
-    def check_unsupported_settings(self, **kwargs):
+        return joined_generations
+
+    def check_unsupported_settings(self, params: GenerationParams):
         """
         Check and warn the user if a sampler is unsupported.
 
         Meant for dev wheels!
         """
 
-        if unwrap(kwargs.get("xtc_probability"), 0.0) > 0.0 and not hasattr(
+        if unwrap(params.xtc_probability, 0.0) > 0.0 and not hasattr(
             ExLlamaV2Sampler.Settings, "xtc_probability"
         ):
             logger.warning(
                 "XTC is not supported by the currently " "installed ExLlamaV2 version."
             )
 
-        return kwargs
+    def get_generation_profile(self, params: GenerationParams) -> GenerationProfile:
+        """Fetches a compiled generation profile or creates it on a cache miss."""
 
-    async def generate_gen(
-        self,
-        prompt: str,
-        request_id: str,
-        abort_event: Optional[asyncio.Event] = None,
-        **kwargs,
-    ):
-        """
-        Create generator function for prompt completion.
+        return self.generation_profiles.get_or_create(
+            profile_key(params), lambda: self.create_generation_profile(params)
+        )
 
-        for kwargs, check common/sampling.py
+    def create_generation_profile(self, params: GenerationParams) -> GenerationProfile:
         """
+        Compiles sampler params into reusable sampler settings.
 
-        # Wait for load lock to be freed before processing
-        async with self.load_condition:
-            await self.load_condition.wait_for(lambda: not self.load_lock.locked())
-
-        prompts = [prompt]
-
-        token_healing = unwrap(kwargs.get("token_healing"), False)
-        generate_window = max(
-            unwrap(kwargs.get("generate_window"), 512), self.config.max_seq_len // 8
-        )
+        Includes the token bias tensor, tokenized DRY sequence breakers
+        and stop conditions with the model's EOS tokens.
+        """
 
-        # Sampler settings
         gen_settings = ExLlamaV2Sampler.Settings()
 
-        # Check unsupported settings for dev wheels
-        kwargs = self.check_unsupported_settings(**kwargs)
-
         # Apply settings
-        gen_settings.temperature = unwrap(kwargs.get("temperature"), 1.0)
-        gen_settings.temperature_last = unwrap(kwargs.get("temperature_last"), False)
-        gen_settings.smoothing_factor = unwrap(kwargs.get("smoothing_factor"), 0.0)
-        gen_settings.top_k = unwrap(kwargs.get("top_k"), 0)
-        gen_settings.top_p = unwrap(kwargs.get("top_p"), 1.0)
-        gen_settings.top_a = unwrap(kwargs.get("top_a"), 0.0)
-        gen_settings.min_p = unwrap(kwargs.get("min_p"), 0.0)
-        gen_settings.tfs = unwrap(kwargs.get("tfs"), 1.0)
-        gen_settings.typical = unwrap(kwargs.get("typical"), 1.0)
-        gen_settings.mirostat = unwrap(kwargs.get("mirostat"), False)
-        gen_settings.skew = unwrap(kwargs.get("skew"), 0)
+        gen_settings.temperature = unwrap(params.temperature, 1.0)
+        gen_settings.temperature_last = unwrap(params.temperature_last, False)
+        gen_settings.smoothing_factor = unwrap(params.smoothing_factor, 0.0)
+        gen_settings.top_k = unwrap(params.top_k, 0)
+        gen_settings.top_p = unwrap(params.top_p, 1.0)
+        gen_settings.top_a = unwrap(params.top_a, 0.0)
+        gen_settings.min_p = unwrap(params.min_p, 0.0)
+        gen_settings.tfs = unwrap(params.tfs, 1.0)
+        gen_settings.typical = unwrap(params.typical, 1.0)
+        gen_settings.mirostat = unwrap(params.mirostat, False)
+        gen_settings.skew = unwrap(params.skew, 0)
 
         # XTC
-        xtc_probability = unwrap(kwargs.get("xtc_probability"), 0.0)
+        xtc_probability = unwrap(params.xtc_probability, 0.0)
         if xtc_probability > 0.0:
             gen_settings.xtc_probability = xtc_probability
 
             # 0.1 is the default for this value
-            gen_settings.xtc_threshold = unwrap(kwargs.get("xtc_threshold", 0.1))
+            gen_settings.xtc_threshold = unwrap(params.xtc_threshold, 0.1)
 
         # DynaTemp settings
-        max_temp = unwrap(kwargs.get("max_temp"), 1.0)
-        min_temp = unwrap(kwargs.get("min_temp"), 1.0)
+        max_temp = unwrap(params.max_temp, 1.0)
+        min_temp = unwrap(params.min_temp, 1.0)
 
         if max_temp > min_temp:
             gen_settings.max_temp = max_temp
             gen_settings.min_temp = min_temp
-            gen_settings.temp_exponent = unwrap(kwargs.get("temp_exponent"), 1.0)
+            gen_settings.temp_exponent = unwrap(params.temp_exponent, 1.0)
         else:
             # Force to default values
             gen_settings.max_temp = 1.0
@@ -1126,22 +1312,16 @@ class ExllamaV2Container:
             )
 
         # Default tau and eta fallbacks don't matter if mirostat is off
-        gen_settings.mirostat_tau = unwrap(kwargs.get("mirostat_tau"), 1.5)
-        gen_settings.mirostat_eta = unwrap(kwargs.get("mirostat_eta"), 0.1)
+        gen_settings.mirostat_tau = unwrap(params.mirostat_tau, 1.5)
+        gen_settings.mirostat_eta = unwrap(params.mirostat_eta, 0.1)
 
-        # Set CFG scale and negative prompt
-        cfg_scale = unwrap(kwargs.get("cfg_scale"), 1.0)
-        negative_prompt = None
+        # Set CFG scale. The negative prompt is added per-job
+        cfg_scale = unwrap(params.cfg_scale, 1.0)
+        use_cfg = False
         if cfg_scale not in [None, 1.0]:
             if self.paged:
                 gen_settings.cfg_scale = cfg_scale
-
-                # If the negative prompt is empty, use the BOS token
-                negative_prompt = unwrap(
-                    kwargs.get("negative_prompt"), self.tokenizer.bos_token
-                )
-
-                prompts.append(negative_prompt)
+                use_cfg = True
             else:
                 logger.warning(
                     "CFG is currently disabled because paged mode is disabled. "
@@ -1149,19 +1329,13 @@ class ExllamaV2Container:
                 )
 
         # Penalties
-        gen_settings.token_repetition_penalty = unwrap(
-            kwargs.get("repetition_penalty"), 1.0
-        )
-        gen_settings.token_frequency_penalty = unwrap(
-            kwargs.get("frequency_penalty"), 0.0
-        )
-        gen_settings.token_presence_penalty = unwrap(
-            kwargs.get("presence_penalty"), 0.0
-        )
+        gen_settings.token_repetition_penalty = unwrap(params.repetition_penalty, 1.0)
+        gen_settings.token_frequency_penalty = unwrap(params.frequency_penalty, 0.0)
+        gen_settings.token_presence_penalty = unwrap(params.presence_penalty, 0.0)
 
         # Applies for all penalties despite being called token_repetition_range
         gen_settings.token_repetition_range = unwrap(
-            kwargs.get("penalty_range"), self.config.max_seq_len
+            params.penalty_range, self.config.max_seq_len
         )
 
         # Dynamically scale penalty range to output tokens
@@ -1181,78 +1355,31 @@ class ExllamaV2Container:
         else:
             fallback_decay = gen_settings.token_repetition_range
         gen_settings.token_repetition_decay = coalesce(
-            kwargs.get("repetition_decay"), fallback_decay, 0
+            params.repetition_decay, fallback_decay, 0
         )
 
         # DRY options
-        dry_multiplier = unwrap(kwargs.get("dry_multiplier"), 0.0)
+        dry_multiplier = unwrap(params.dry_multiplier, 0.0)
 
         # < 0 = disabled
         if dry_multiplier > 0:
             gen_settings.dry_multiplier = dry_multiplier
 
             # TODO: Maybe set the "sane" defaults instead?
-            gen_settings.dry_allowed_length = unwrap(
-                kwargs.get("dry_allowed_length"), 0
-            )
-            gen_settings.dry_base = unwrap(kwargs.get("dry_base"), 0.0)
+            gen_settings.dry_allowed_length = unwrap(params.dry_allowed_length, 0)
+            gen_settings.dry_base = unwrap(params.dry_base, 0.0)
 
             # Exl2 has dry_range as 0 for unlimited unlike -1 for penalty_range
             # Use max_seq_len as the fallback to stay consistent
-            gen_settings.dry_range = unwrap(
-                kwargs.get("dry_range"), self.config.max_seq_len
-            )
+            gen_settings.dry_range = unwrap(params.dry_range, self.config.max_seq_len)
 
             # Tokenize sequence breakers
-            dry_sequence_breakers_json = kwargs.get("dry_sequence_breakers")
+            dry_sequence_breakers_json = params.dry_sequence_breakers
             if dry_sequence_breakers_json:
                 gen_settings.dry_sequence_breakers = {
                     self.encode_tokens(s)[-1] for s in dry_sequence_breakers_json
                 }
 
-        # Initialize grammar handler
-        grammar_handler = ExLlamaV2Grammar()
-
-        # Add JSON schema filter if it exists
-        json_schema = unwrap(kwargs.get("json_schema"))
-        if json_schema:
-            grammar_handler.add_json_schema_filter(
-                json_schema, self.model, self.tokenizer
-            )
-
-        # Add regex filter if it exists
-        regex_pattern = unwrap(kwargs.get("regex_pattern"))
-        if regex_pattern:
-            grammar_handler.add_regex_filter(regex_pattern, self.model, self.tokenizer)
-
-        # Add EBNF filter if it exists
-        grammar_string = unwrap(kwargs.get("grammar_string"))
-        if grammar_string:
-            grammar_handler.add_kbnf_filter(grammar_string, self.model, self.tokenizer)
-
-        # Set banned strings
-        banned_strings: List[str] = unwrap(kwargs.get("banned_strings"), [])
-        if banned_strings and len(grammar_handler.filters) > 0:
-            logger.warning(
-                "Disabling banned_strings because "
-                "they cannot be used with grammar filters."
-            )
-
-            banned_strings = []
-
-        stop_conditions: List[Union[str, int]] = unwrap(kwargs.get("stop"), [])
-        add_bos_token = unwrap(kwargs.get("add_bos_token"), True)
-        ban_eos_token = unwrap(kwargs.get("ban_eos_token"), False)
-        logit_bias = kwargs.get("logit_bias")
-
-        # Logprobs
-        request_logprobs = unwrap(kwargs.get("logprobs"), 0)
-
-        # Speculative Ngram
-        self.generator.speculative_ngram = unwrap(
-            kwargs.get("speculative_ngram"), False
-        )
-
         # Override sampler settings for temp = 0
         if gen_settings.temperature == 0:
             gen_settings.temperature = 1.0
@@ -1269,21 +1396,18 @@ class ExllamaV2Container:
                 )
             )
 
-        # Store the gen settings for logging purposes
-        # Deepcopy to save a snapshot of vars
-        gen_settings_log_dict = deepcopy(vars(gen_settings))
-
         # Set banned tokens
-        banned_tokens = unwrap(kwargs.get("banned_tokens"), [])
+        banned_tokens = unwrap(params.banned_tokens, [])
         if banned_tokens:
             gen_settings.disallow_tokens(self.tokenizer, banned_tokens)
 
         # Set allowed tokens
-        allowed_tokens = unwrap(kwargs.get("allowed_tokens"), [])
+        allowed_tokens = unwrap(params.allowed_tokens, [])
         if allowed_tokens:
             gen_settings.allow_tokens(self.tokenizer, allowed_tokens)
 
         # Set logit bias
+        logit_bias = params.logit_bias
         if logit_bias:
             # Create a vocab tensor if it doesn't exist for token biasing
             if gen_settings.token_bias is None:
@@ -1294,8 +1418,9 @@ class ExllamaV2Container:
                 )
 
             # Map logits to the tensor with their biases
+            vocab_len = len(self.tokenizer.get_id_to_piece_list(True))
             for token_id, bias in logit_bias.items():
-                if 0 <= token_id < len(self.tokenizer.get_id_to_piece_list(True)):
+                if 0 <= token_id < vocab_len:
                     gen_settings.token_bias[token_id] = bias
                 else:
                     logger.warning(
@@ -1313,25 +1438,176 @@ class ExllamaV2Container:
         # Ban the EOS token if specified. If not, append to stop conditions
         # as well.
         # Set this below logging to avoid polluting the stop strings array
-        if ban_eos_token:
+        stop_conditions: List[Union[str, int]] = list(unwrap(params.stop, []))
+        if unwrap(params.ban_eos_token, False):
             gen_settings.disallow_tokens(self.tokenizer, eos_tokens)
         else:
             stop_conditions += eos_tokens
 
+        return GenerationProfile(
+            gen_settings=gen_settings,
+            stop_conditions=stop_conditions,
+            eos_tokens=eos_tokens,
+            use_cfg=use_cfg,
+            auto_scale_penalty_range=auto_scale_penalty_range,
+        )
+
+    async def warm_grammar_cache(self, schemas: List[dict]):
+        """Compiles JSON schemas and the configured schemas ahead of requests."""
+
+        await self.grammar_cache.warm([*schemas, *self.grammar_schemas])
+
+    async def create_grammar_handler(
+        self, params: GenerationParams
+    ) -> ExLlamaV2Grammar:
+        """Creates the grammar filters of a job from request params."""
+
+        grammar_handler = ExLlamaV2Grammar()
+
+        # Add JSON schema filter if it exists
+        json_schema = unwrap(params.json_schema)
+        if json_schema:
+            await grammar_handler.add_json_schema_filter(
+                json_schema, self.grammar_cache
+            )
+
+        # Add regex filter if it exists
+        regex_pattern = unwrap(params.regex_pattern)
+        if regex_pattern:
+            await grammar_handler.add_regex_filter(regex_pattern, self.grammar_cache)
+
+        # Add EBNF filter if it exists
+        grammar_string = unwrap(params.grammar_string)
+        if grammar_string:
+            await grammar_handler.add_kbnf_filter(grammar_string, self.grammar_cache)
+
+        return grammar_handler
+
+    async def generate_gen(
+        self,
+        prompt: str,
+        request_id: str,
+        params: GenerationParams,
+        abort_event: Optional[asyncio.Event] = None,
+        embeddings: Optional[MultimodalEmbeddingWrapper] = None,
+        context_ids: Optional[torch.Tensor] = None,
+    ):
+        """
+        Create generator function for prompt completion.
+
+        The prompt is tokenized and validated once. With n > 1 or best_of,
+        all jobs are submitted together so they share the prompt's cache
+        pages, and every generation is tagged with its choice index.
+
+        A job that stops on a stop string or token returns the token ids of
+        its sequence as context_ids. Passing them back continues that
+        sequence without encoding the prompt, and the new job reuses the
+        cache pages of the finished one. The prompt is then only logged.
+
+        For params, check common/sampling.py
+        """
+
+        # Wait for load lock to be freed before processing
+        async with self.load_condition:
+            await self.load_condition.wait_for(lambda: not self.load_lock.locked())
+
+        prompts = [prompt]
+
+        token_healing = unwrap(params.token_healing, False)
+        generate_window = max(
+            unwrap(params.generate_window, 512), self.config.max_seq_len // 8
+        )
+
+        # Check unsupported settings for dev wheels
+        self.check_unsupported_settings(params)
+
+        # Sampler settings, biases and stop conditions are compiled once per
+        # unique set of sampler params and cloned for every job
+        profile = self.get_generation_profile(params)
+
+        # Add the negative prompt if CFG is enabled
+        negative_prompt = None
+        if profile.use_cfg:
+            # If the negative prompt is empty, use the BOS token
+            negative_prompt = unwrap(params.negative_prompt, self.tokenizer.bos_token)
+
+            prompts.append(negative_prompt)
+
+        # Grammar filters are stateful, so other jobs create their own
+        grammar_handler = await self.create_grammar_handler(params)
+
+        # Set banned strings
+        banned_strings: List[str] = unwrap(params.banned_strings, [])
+        if banned_strings and len(grammar_handler.filters) > 0:
+            logger.warning(
+                "Disabling banned_strings because "
+                "they cannot be used with grammar filters."
+            )
+
+            banned_strings = []
+
+        stop_conditions: List[Union[str, int]] = list(profile.stop_conditions)
+        eos_tokens = profile.eos_tokens
+        add_bos_token = unwrap(params.add_bos_token, True)
+        ban_eos_token = unwrap(params.ban_eos_token, False)
+        banned_tokens = unwrap(params.banned_tokens, [])
+        allowed_tokens = unwrap(params.allowed_tokens, [])
+        logit_bias = params.logit_bias
+
+        # Logprobs
+        request_logprobs = unwrap(params.logprobs, 0)
+
+        # Number of jobs to run. Extra best_of candidates are ranked by the
+        # caller using the cumulative logprob of their sampled tokens
+        num_choices = unwrap(params.n, 1)
+        num_jobs = max(unwrap(params.best_of, num_choices), num_choices)
+        rank_choices = num_jobs > num_choices
+        return_probs = request_logprobs > 0 or rank_choices
+
+        # Speculation is scheduled per job
+        # Jump-forward needs a grammar and doesn't support CFG
+        speculation = self.speculation
+        speculation_mode = speculation.get_mode(
+            unwrap(params.speculative_ngram, False),
+            unwrap(params.jump_forward, False)
+            and bool(grammar_handler.filters)
+            and not profile.use_cfg,
+        )
+
         # Get multimodal embeddings if present
-        mm_embeddings: MultimodalEmbeddingWrapper = kwargs.get("embeddings")
+        mm_embeddings: MultimodalEmbeddingWrapper = embeddings
         mm_embeddings_content = mm_embeddings.content if mm_embeddings else []
 
         # Encode both positive and negative prompts
-        input_ids = [
-            self.tokenizer.encode(
-                prompt,
-                add_bos=add_bos_token,
-                encode_special_tokens=True,
-                embeddings=mm_embeddings_content,
-            )
-            for prompt in prompts
-        ]
+        # Long prompts are encoded on the CPU worker pool
+        # A continued sequence is already encoded
+        encoded_prompts = prompts if context_ids is None else prompts[1:]
+
+        def encode_prompts():
+            if self.token_cache and not mm_embeddings_content:
+                return [
+                    torch.tensor(
+                        [self.token_cache.encode(prompt, add_bos_token)],
+                        dtype=torch.long,
+                    )
+                    for prompt in encoded_prompts
+                ]
+
+            return [
+                self.tokenizer.encode(
+                    prompt,
+                    add_bos=add_bos_token,
+                    encode_special_tokens=True,
+                    embeddings=mm_embeddings_content,
+                )
+                for prompt in encoded_prompts
+            ]
+
+        input_ids = await cpu_pool.run(
+            encode_prompts, size=sum(len(prompt) for prompt in encoded_prompts)
+        )
+        if context_ids is not None:
+            input_ids.insert(0, context_ids)
 
         # The first index will always be the positive prompt
         context_len = input_ids[0].size(dim=-1)
@@ -1342,7 +1618,7 @@ class ExllamaV2Container:
         # Automatically set max_tokens to fill up the context
         # This should be an OK default, but may be changed in the future
         max_tokens = unwrap(
-            kwargs.get("max_tokens"),
+            params.max_tokens,
             self.config.max_seq_len - max(context_len, negative_context_len),
         )
         if max_tokens < 1:
@@ -1380,180 +1656,312 @@ class ExllamaV2Container:
             )
 
         # Set min_tokens to generate while keeping EOS banned
-        min_tokens = unwrap(kwargs.get("min_tokens"), 0)
+        min_tokens = unwrap(params.min_tokens, 0)
 
         # This is an inverse of skip_special_tokens
-        decode_special_tokens = unwrap(not kwargs.get("skip_special_tokens"), False)
+        decode_special_tokens = unwrap(not params.skip_special_tokens, False)
 
         # Log prompt to console. Add the BOS token if specified
         log_prompt(
-            f"{self.tokenizer.bos_token if add_bos_token else ''}{prompt}",
+            prompt,
             request_id,
             negative_prompt,
+            prefix=self.tokenizer.bos_token if add_bos_token else "",
         )
 
-        # Create and add a new job
-        # Don't use the request ID here as there can be multiple jobs per request
-        job_id = uuid.uuid4().hex
-        job = ExLlamaV2DynamicJobAsync(
-            self.generator,
-            input_ids=input_ids,
-            max_new_tokens=max_tokens,
-            min_new_tokens=min_tokens,
-            gen_settings=gen_settings,
-            stop_conditions=stop_conditions,
-            decode_special_tokens=decode_special_tokens,
-            filters=grammar_handler.filters,
-            filter_prefer_eos=bool(grammar_handler.filters),
-            return_probs=request_logprobs > 0,
-            return_top_tokens=request_logprobs,
-            return_logits=request_logprobs > 0,
-            banned_strings=banned_strings,
-            token_healing=token_healing,
-            identifier=job_id,
-            embeddings=mm_embeddings_content,
-        )
-
-        # Save generated tokens and full response
         # Copy over max seq len incase model is unloaded and stored jobs can complete
-        # Full response is required for offset calculation
         max_seq_len = self.config.max_seq_len
-        generated_tokens = 0
-        full_response = ""
-        metrics_result = {}
 
-        # Get the generation status once it's ready
-        try:
-            async for result in job:
-                # Abort if the event is set while streaming
-                if abort_event and abort_event.is_set():
-                    await job.cancel()
-                    break
-
-                stage = result.get("stage")
-                result_id = result.get("identifier")
-
-                if stage == "streaming" and result_id == job_id:
-                    chunk = unwrap(result.get("text"), "")
-                    full_response += chunk
-
-                    chunk_tokens = result.get("token_ids")
-                    if chunk_tokens is not None:
-                        generated_tokens += chunk_tokens.size(dim=0)
-
-                    generation = {
-                        "text": chunk,
-                        "prompt_tokens": context_len,
-                        "generated_tokens": generated_tokens,
-                        "offset": len(full_response),
-                    }
+        # Unix timestamp when unfinished jobs are stopped
+        deadline = params.deadline
 
-                    if request_logprobs > 0:
-                        # Get top tokens and probs
-                        top_tokens = unwrap(
-                            result.get("top_k_tokens"),
-                            torch.empty((1, 0, 1), dtype=torch.long),
-                        )
+        async def job_gen(index: int):
+            """Runs a single job of the request and yields its generations."""
 
-                        top_probs = unwrap(
-                            result.get("top_k_probs"),
-                            torch.empty((1, 0, 1), dtype=torch.float),
-                        )
+            gen_settings = profile.create_settings()
+            job_grammar_handler = (
+                grammar_handler
+                if index == 0
+                else await self.create_grammar_handler(params)
+            )
 
-                        if top_tokens.numel() > 0 and top_probs.numel() > 0:
-                            logprobs = self.get_logprobs(top_tokens, top_probs)
-                            generation["logprobs"] = logprobs
+            # Create and add a new job
+            # Don't use the request ID here as there can be multiple jobs per request
+            job_id = uuid.uuid4().hex
 
-                            # The first logprob is the selected token prob
-                            generation["token_probs"] = {
-                                token: logprobs[token]
-                                for token in list(logprobs.keys())[:1]
-                            }
+            # Speculative jobs may run without drafts instead of waiting
+            job_mode = await speculation.acquire(speculation_mode, deadline)
+            try:
+                job = ExLlamaV2DynamicJobAsync(
+                    self.generator,
+                    input_ids=input_ids,
+                    max_new_tokens=max_tokens,
+                    min_new_tokens=min_tokens,
+                    gen_settings=gen_settings,
+                    stop_conditions=stop_conditions,
+                    decode_special_tokens=decode_special_tokens,
+                    filters=job_grammar_handler.filters,
+                    filter_prefer_eos=bool(job_grammar_handler.filters),
+                    return_probs=return_probs,
+                    return_top_tokens=request_logprobs,
+                    return_logits=request_logprobs > 0,
+                    banned_strings=banned_strings,
+                    token_healing=token_healing,
+                    identifier=job_id,
+                    embeddings=mm_embeddings_content,
+                )
+            except Exception:
+                speculation.release()
+                raise
 
-                    yield generation
+            # Save generated tokens and full response
+            # Full response is required for offset calculation
+            generated_tokens = 0
+            cumulative_logprob = 0.0
+            full_response = ResponseAccumulator()
+            metrics_result = {}
 
-                    # Second yield if eos is true
-                    if result.get("eos"):
-                        log_response(request_id, full_response)
+            # Token ids of the sequence, returned if it stops on a condition
+            sequence_ids = [input_ids[0]]
 
-                        eos_reason = result.get("eos_reason")
+            # Get the generation status once it's ready
+            try:
+                async for result in iterate_until(job, deadline):
+                    # Abort if the event is set while streaming
+                    if abort_event and abort_event.is_set():
+                        await job.cancel()
+                        break
 
-                        stop_str = None
-                        if eos_reason == "max_new_tokens":
-                            finish_reason = "length"
-                        else:
-                            finish_reason = "stop"
-                            # Grab stop string if stop was the reason
-                            if eos_reason == "stop_token":
-                                stop_str = result.get("eos_triggering_token_str")
-                            elif eos_reason == "stop_string":
-                                stop_str = result.get("eos_triggering_string")
+                    stage = result.get("stage")
+                    result_id = result.get("identifier")
 
-                        # Save the final result for metrics logging
-                        metrics_result = result
+                    if stage == "streaming" and result_id == job_id:
+                        chunk = unwrap(result.get("text"), "")
+                        full_response.append(chunk)
+
+                        chunk_tokens = result.get("token_ids")
+                        if chunk_tokens is not None:
+                            generated_tokens += chunk_tokens.size(dim=0)
+                            sequence_ids.append(chunk_tokens)
 
-                        # Remove the token text
                         generation = {
-                            "prompt_tokens": generation.get("prompt_tokens"),
-                            "generated_tokens": generation.get("generated_tokens"),
-                            "finish_reason": finish_reason,
-                            "stop_str": stop_str,
+                            "index": index,
+                            "text": chunk,
+                            "prompt_tokens": context_len,
+                            "generated_tokens": generated_tokens,
+                            "offset": full_response.length,
                         }
 
+                        if rank_choices:
+                            token_probs = result.get("token_probs")
+                            if token_probs is not None and token_probs.numel() > 0:
+                                cumulative_logprob += (
+                                    torch.log(token_probs).sum().item()
+                                )
+
+                        if request_logprobs > 0:
+                            # Get top tokens and probs
+                            top_tokens = unwrap(
+                                result.get("top_k_tokens"),
+                                torch.empty((1, 0, 1), dtype=torch.long),
+                            )
+
+                            top_probs = unwrap(
+                                result.get("top_k_probs"),
+                                torch.empty((1, 0, 1), dtype=torch.float),
+                            )
+
+                            if top_tokens.numel() > 0 and top_probs.numel() > 0:
+                                generation["logprobs"] = self.get_logprobs(
+                                    top_tokens, top_probs
+                                )
+
                         yield generation
-                        break
-        except asyncio.CancelledError:
-            await job.cancel()
-        except Exception as ex:
-            # Create a new generator since the current state is broken
-            # No need to wait for this to finish
-            logger.error(
-                "FATAL ERROR with generation. "
-                "Attempting to recreate the generator. "
-                "If this fails, please restart the server.\n"
-            )
-            asyncio.ensure_future(self.create_generator())
 
-            await HealthManager.add_unhealthy_event(ex)
+                        # Second yield if eos is true
+                        if result.get("eos"):
+                            log_response(request_id, full_response.text)
+
+                            eos_reason = result.get("eos_reason")
+
+                            stop_str = None
+                            if eos_reason == "max_new_tokens":
+                                finish_reason = "length"
+                            else:
+                                finish_reason = "stop"
+                                # Grab stop string if stop was the reason
+                                if eos_reason == "stop_token":
+                                    stop_str = result.get("eos_triggering_token_str")
+                                elif eos_reason == "stop_string":
+                                    stop_str = result.get("eos_triggering_string")
+
+                            # Save the final result for metrics logging
+                            metrics_result = result
+
+                            # Remove the token text
+                            generation = {
+                                "index": index,
+                                "prompt_tokens": generation.get("prompt_tokens"),
+                                "generated_tokens": generation.get("generated_tokens"),
+                                "finish_reason": finish_reason,
+                                "stop_str": stop_str,
+                            }
 
-            raise ex
-        finally:
-            # Log generation options to console
-            # Some options are too large, so log the args instead
-            log_generation_params(
-                request_id=request_id,
-                max_tokens=max_tokens,
-                min_tokens=min_tokens,
-                stream=kwargs.get("stream"),
-                **gen_settings_log_dict,
-                token_healing=token_healing,
-                auto_scale_penalty_range=auto_scale_penalty_range,
-                generate_window=generate_window,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=eos_tokens,
-                add_bos_token=add_bos_token,
-                ban_eos_token=ban_eos_token,
-                skip_special_tokens=not decode_special_tokens,
-                speculative_ngram=self.generator.speculative_ngram,
-                logprobs=request_logprobs,
-                stop_conditions=stop_conditions,
-                banned_tokens=banned_tokens,
-                allowed_tokens=allowed_tokens,
-                banned_strings=banned_strings,
-                logit_bias=logit_bias,
-                filters=grammar_handler.filters,
-            )
+                            if rank_choices:
+                                generation["cumulative_logprob"] = cumulative_logprob
+
+                            # Healed prompts don't start with the input ids
+                            if stop_str is not None and not token_healing:
+                                continuation_ids = get_continuation_ids(
+                                    sequence_ids, result
+                                )
+                                if continuation_ids is not None:
+                                    generation["context_ids"] = continuation_ids
+
+                            yield generation
+                            break
+            except asyncio.CancelledError:
+                await job.cancel()
+            except GeneratorExit:
+                # The consumer stopped reading, e.g. a stalled stream
+                await job.cancel()
+                raise
+            except asyncio.TimeoutError:
+                await job.cancel()
+
+                log_response(request_id, full_response.text)
+                logger.info(f"Job {job_id} of request {request_id} timed out")
+
+                # Return the partial output with a timeout finish reason
+                generation = {
+                    "index": index,
+                    "prompt_tokens": context_len,
+                    "generated_tokens": generated_tokens,
+                    "finish_reason": "timeout",
+                    "stop_str": None,
+                }
 
-            # Log the metrics if present
-            if metrics_result:
-                log_metrics(
-                    request_id,
-                    metrics_result.get("time_enqueued"),
-                    metrics_result.get("prompt_tokens"),
-                    metrics_result.get("cached_tokens"),
-                    metrics_result.get("time_prefill"),
-                    metrics_result.get("new_tokens"),
-                    metrics_result.get("time_generate"),
-                    context_len,
-                    max_seq_len,
+                if rank_choices:
+                    generation["cumulative_logprob"] = cumulative_logprob
+
+                yield generation
+            except Exception as ex:
+                # Create a new generator since the current state is broken
+                # No need to wait for this to finish
+                logger.error(
+                    "FATAL ERROR with generation. "
+                    "Attempting to recreate the generator. "
+                    "If this fails, please restart the server.\n"
                 )
+                asyncio.ensure_future(self.create_generator())
+
+                await HealthManager.add_unhealthy_event(ex)
+
+                raise ex
+            finally:
+                speculation.release()
+
+                # Forced tokens are always accepted unless the job ends first
+                jump_forward_tokens = min(
+                    speculation.pop_jump_forward_tokens(job_id),
+                    metrics_result.get("accepted_draft_tokens", 0),
+                )
+
+                draft_stats = None
+                if metrics_result:
+                    speculation.record(job_mode, metrics_result, jump_forward_tokens)
+
+                    # Draft counters are only returned if the job used drafts
+                    if "accepted_draft_tokens" in metrics_result:
+                        draft_stats = get_draft_stats(
+                            metrics_result.get("new_tokens"),
+                            metrics_result.get("accepted_draft_tokens"),
+                            metrics_result.get("rejected_draft_tokens"),
+                        )
+
+                        if job_mode == "jump_forward":
+                            draft_stats["jump_forward_tokens"] = jump_forward_tokens
+
+                # Log generation options to console
+                # Some options are too large, so log the args instead
+                # The dict is only built if param logging is enabled
+                log_generation_params(
+                    lambda: {
+                        "request_id": request_id,
+                        "max_tokens": max_tokens,
+                        "min_tokens": min_tokens,
+                        "stream": params.stream,
+                        **profile.get_log_params(),
+                        "token_healing": token_healing,
+                        "auto_scale_penalty_range": profile.auto_scale_penalty_range,
+                        "generate_window": generate_window,
+                        "bos_token_id": self.tokenizer.bos_token_id,
+                        "eos_token_id": eos_tokens,
+                        "add_bos_token": add_bos_token,
+                        "ban_eos_token": ban_eos_token,
+                        "skip_special_tokens": not decode_special_tokens,
+                        "speculation_mode": job_mode,
+                        "logprobs": request_logprobs,
+                        "stop_conditions": stop_conditions,
+                        "banned_tokens": banned_tokens,
+                        "allowed_tokens": allowed_tokens,
+                        "banned_strings": banned_strings,
+                        "logit_bias": logit_bias,
+                        "filters": job_grammar_handler.filters,
+                    }
+                )
+
+                # Log the metrics if present
+                if metrics_result:
+                    log_metrics(
+                        request_id,
+                        metrics_result.get("time_enqueued"),
+                        metrics_result.get("prompt_tokens"),
+                        metrics_result.get("cached_tokens"),
+                        metrics_result.get("time_prefill"),
+                        metrics_result.get("new_tokens"),
+                        metrics_result.get("time_generate"),
+                        context_len,
+                        max_seq_len,
+                        draft_stats,
+                    )
+
+        if num_jobs == 1:
+            job_stream = job_gen(0)
+            try:
+                async for generation in job_stream:
+                    yield generation
+            finally:
+                # Closing this generator early also closes the job
+                await job_stream.aclose()
+
+            return
+
+        # Fan the job streams into one stream
+        # None marks the end of a job's stream
+        gen_queue = asyncio.Queue()
+
+        async def collect(index: int):
+            try:
+                async for generation in job_gen(index):
+                    await gen_queue.put(generation)
+            except Exception as ex:
+                await gen_queue.put(ex)
+            finally:
+                gen_queue.put_nowait(None)
+
+        gen_tasks = [asyncio.create_task(collect(index)) for index in range(num_jobs)]
+
+        try:
+            remaining_jobs = num_jobs
+            while remaining_jobs > 0:
+                generation = await gen_queue.get()
+                if generation is None:
+                    remaining_jobs -= 1
+                elif isinstance(generation, Exception):
+                    raise generation
+                else:
+                    yield generation
+        finally:
+            for task in gen_tasks:
+                task.cancel()
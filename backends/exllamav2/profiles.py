@@ -0,0 +1,125 @@
+"""Compiled generation profiles for the ExLlamaV2 backend."""
+
+from collections import deque
+from exllamav2.generator import ExLlamaV2Sampler
+from typing import Any, Hashable, List, Union
+
+from common.sampling import GenerationParams
+
+# Request parameters which are compiled into a generation profile.
+# Everything else (prompt, grammar, max_tokens, etc.) is per-job.
+PROFILE_KEYS = (
+    "temperature",
+    "temperature_last",
+    "smoothing_factor",
+    "top_k",
+    "top_p",
+    "top_a",
+    "min_p",
+    "tfs",
+    "typical",
+    "mirostat",
+    "mirostat_tau",
+    "mirostat_eta",
+    "skew",
+    "xtc_probability",
+    "xtc_threshold",
+    "max_temp",
+    "min_temp",
+    "temp_exponent",
+    "cfg_scale",
+    "repetition_penalty",
+    "frequency_penalty",
+    "presence_penalty",
+    "penalty_range",
+    "repetition_decay",
+    "dry_multiplier",
+    "dry_allowed_length",
+    "dry_base",
+    "dry_range",
+    "dry_sequence_breakers",
+    "banned_tokens",
+    "allowed_tokens",
+    "logit_bias",
+    "stop",
+    "ban_eos_token",
+)
+
+
+def _freeze(value: Any) -> Hashable:
+    """Converts a request value into a hashable canonical form."""
+
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    elif isinstance(value, set):
+        return tuple(sorted(_freeze(item) for item in value))
+
+    return value
+
+
+def profile_key(params: GenerationParams) -> Hashable:
+    """Creates the cache key of a profile from request params."""
+
+    return tuple((key, _freeze(getattr(params, key))) for key in PROFILE_KEYS)
+
+
+class GenerationProfile:
+    """
+    Sampler state compiled from a set of request parameters.
+
+    Profiles are shared between requests, so never mutate one after creation.
+    Use create_settings to get a per-job copy of the sampler settings.
+    """
+
+    gen_settings: ExLlamaV2Sampler.Settings
+    stop_conditions: List[Union[str, int]]
+    eos_tokens: List[int]
+    use_cfg: bool
+    auto_scale_penalty_range: bool
+
+    def __init__(
+        self,
+        gen_settings: ExLlamaV2Sampler.Settings,
+        stop_conditions: List[Union[str, int]],
+        eos_tokens: List[int],
+        use_cfg: bool,
+        auto_scale_penalty_range: bool,
+    ):
+        self.gen_settings = gen_settings
+        self.stop_conditions = stop_conditions
+        self.eos_tokens = eos_tokens
+        self.use_cfg = use_cfg
+        self.auto_scale_penalty_range = auto_scale_penalty_range
+
+    def get_log_params(self) -> dict:
+        """
+        Returns the sampler settings for logging.
+
+        The bias tensor is vocab-sized, so biases are logged from the request
+        params instead.
+        """
+
+        return {
+            key: value
+            for key, value in vars(self.gen_settings).items()
+            if key != "token_bias"
+        }
+
+    def create_settings(self) -> ExLlamaV2Sampler.Settings:
+        """
+        Returns a shallow clone of the compiled settings for a single job.
+
+        The bias tensor and sequence breakers are read-only while sampling,
+        so they're shared. State that the sampler mutates is reset.
+        """
+
+        settings = self.gen_settings.clone()
+        settings.mirostat_mu = None
+        settings.ngram_trie = None
+        settings.ngram_index = 0
+        settings.ngram_history = deque()
+        settings.post_sampling_hooks = list(self.gen_settings.post_sampling_hooks)
+
+        return settings
@@ -0,0 +1,287 @@
+"""Per-job speculative decoding for the ExLlamaV2 backend."""
+
+import asyncio
+import time
+import torch
+from collections import deque
+from exllamav2.generator import ExLlamaV2DynamicGeneratorAsync
+from typing import Deque, Dict, Optional
+
+from backends.exllamav2.grammar import get_forced_tokens
+from common.scheduler import SchedulerRejection
+
+# Speculation modes a job can run under
+SPECULATION_MODES = ("none", "ngram", "jump_forward", "draft")
+
+# Seconds a speculative job waits for its mode before running without drafts
+MAX_MODE_WAIT = 1.0
+
+# Positions the generator computes logits for in one pass, exllamav2's default
+MAX_Q_SIZE = 8
+
+
+def get_draft_stats(new_tokens: int, accepted: int, rejected: int) -> dict:
+    """
+    Summarizes the draft counters of a finished job.
+
+    Each forward pass emits one sampled token plus the accepted drafts, so
+    the number of passes is approximated as new_tokens - accepted.
+    """
+
+    drafted = accepted + rejected
+    steps = max(new_tokens - accepted, 1)
+
+    return {
+        "acceptance_rate": round(accepted / drafted, 4) if drafted else 0.0,
+        "tokens_per_step": round(new_tokens / steps, 4) if new_tokens else 0.0,
+    }
+
+
+class SpeculationWaiter:
+    """A job waiting for its speculation mode."""
+
+    __slots__ = ("mode", "future", "fallback_time")
+
+    def __init__(self, mode: str, future: asyncio.Future, fallback_time: float):
+        self.mode = mode
+        self.future = future
+        self.fallback_time = fallback_time
+
+
+class SpeculationScheduler:
+    """
+    Admits generator jobs in groups that share a speculation mode.
+
+    The dynamic generator decodes the whole batch with one mode, and a job
+    stops short of max_new_tokens by the draft length it was running with.
+    Modes are therefore only switched while the generator is idle, and
+    waiting jobs are admitted in order with the running mode.
+
+    Speculation only speeds jobs up, so it never holds back other traffic
+    for long. While jobs without speculation run, later jobs without it
+    are admitted past waiting speculative jobs, and a speculative job that
+    waits longer than max_mode_wait runs without drafts instead of waiting
+    for the batch to drain. A job that arrives while a speculative group
+    runs waits for that group, which no longer admits new jobs.
+
+    A verify pass holds the sampled token and its drafts, so drafts are
+    capped at max_q_size - 1 tokens. Create the generator with the same
+    max_q_size.
+    """
+
+    def __init__(
+        self,
+        generator: ExLlamaV2DynamicGeneratorAsync,
+        num_draft_tokens: int = 4,
+        num_jump_tokens: int = MAX_Q_SIZE - 1,
+        max_mode_wait: float = MAX_MODE_WAIT,
+        max_q_size: int = MAX_Q_SIZE,
+    ):
+        self.generator = generator
+        self.num_draft_tokens = num_draft_tokens
+        self.num_jump_tokens = num_jump_tokens
+        self.max_mode_wait = max_mode_wait
+        self.max_q_size = max_q_size
+        self.has_draft_model = generator.generator.draft_model is not None
+
+        # Grammar-forced tokens drafted per job ID
+        self.jump_forward_tokens: Dict[str, int] = {}
+
+        # A draft model is part of the generator, so it can't be toggled
+        self.mode = "draft" if self.has_draft_model else "none"
+        self.active_jobs = 0
+        self.waiters: Deque[SpeculationWaiter] = deque()
+        self.counters: Dict[str, Dict[str, int]] = {
+            mode: {
+                "activations": 0,
+                "fallbacks": 0,
+                "jobs": 0,
+                "new_tokens": 0,
+                "accepted_draft_tokens": 0,
+                "rejected_draft_tokens": 0,
+                "jump_forward_tokens": 0,
+            }
+            for mode in SPECULATION_MODES
+        }
+
+        # Jump-forward drafts go through the generator's ngram draft path
+        inner_generator = generator.generator
+        self._iterate_ngram_gen = inner_generator.iterate_ngram_gen
+        inner_generator.iterate_ngram_gen = self._iterate_draft_gen
+
+        self._set_mode(self.mode)
+
+    def get_mode(self, speculative_ngram: bool, jump_forward: bool = False) -> str:
+        """Returns the speculation mode for a job's request params."""
+
+        if self.has_draft_model:
+            return "draft"
+
+        if jump_forward:
+            return "jump_forward"
+
+        return "ngram" if speculative_ngram else "none"
+
+    def _set_mode(self, mode: str):
+        # Draft model settings are fixed on generator creation
+        if mode != "draft":
+            inner_generator = self.generator.generator
+            inner_generator.use_ngram_draft = mode in ("ngram", "jump_forward")
+
+            if mode == "ngram":
+                num_draft_tokens = self.num_draft_tokens
+            elif mode == "jump_forward":
+                num_draft_tokens = self.num_jump_tokens
+            else:
+                num_draft_tokens = 0
+
+            # Longer drafts don't fit the generator's logits buffer
+            inner_generator.num_draft_tokens = min(
+                num_draft_tokens, self.max_q_size - 1
+            )
+
+        self.mode = mode
+        self.counters[mode]["activations"] += 1
+
+    def _can_admit(self, mode: str):
+        return self.active_jobs == 0 or self.mode == mode
+
+    def _admit(self, mode: str):
+        if mode != self.mode:
+            self._set_mode(mode)
+
+        self.active_jobs += 1
+
+    def _wake(self):
+        now = time.perf_counter()
+        remaining = deque()
+        for waiter in self.waiters:
+            if waiter.future.done():
+                continue
+
+            # Waiters of the running mode only pass others if no drain is needed
+            if self._can_admit(waiter.mode) and (not remaining or self.mode == "none"):
+                self._admit(waiter.mode)
+                waiter.future.set_result(waiter.mode)
+            elif self.mode == "none" and now >= waiter.fallback_time:
+                self.counters[waiter.mode]["fallbacks"] += 1
+                self._admit("none")
+                waiter.future.set_result("none")
+            else:
+                remaining.append(waiter)
+
+        self.waiters = remaining
+
+    async def acquire(self, mode: str, deadline: Optional[float] = None) -> str:
+        """
+        Waits until a job with the given mode can be enqueued.
+
+        Returns the mode the job was admitted with. Raises a 504
+        SchedulerRejection if the unix timestamp deadline passes first.
+        """
+
+        loop = asyncio.get_running_loop()
+        waiter = SpeculationWaiter(
+            mode, loop.create_future(), time.perf_counter() + self.max_mode_wait
+        )
+        self.waiters.append(waiter)
+        self._wake()
+
+        if waiter.future.done():
+            return waiter.future.result()
+
+        # Check again once the job can run without drafts
+        if mode != "none":
+            loop.call_later(self.max_mode_wait, self._wake)
+
+        try:
+            if deadline is None:
+                return await asyncio.shield(waiter.future)
+
+            return await asyncio.wait_for(
+                asyncio.shield(waiter.future), deadline - time.time()
+            )
+        except (asyncio.CancelledError, asyncio.TimeoutError) as exc:
+            if waiter.future.done():
+                # Admitted right before the cancel landed
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._wake()
+
+            if isinstance(exc, asyncio.TimeoutError):
+                raise SchedulerRejection(
+                    504, "The request deadline passed while it was queued.", 1
+                ) from exc
+
+            raise
+
+    def _iterate_draft_gen(self, results: list):
+        """
+        Drafts the grammar-forced tokens of each job in jump-forward mode.
+
+        When a job's grammar allows exactly one continuation, those tokens
+        replace the start of its ngram draft. The generator verifies drafts
+        in a single forward pass, and forced tokens are the only tokens the
+        filter allows, so they're always accepted.
+        """
+
+        draft_ids = self._iterate_ngram_gen(results)
+        if self.mode != "jump_forward" or draft_ids is None:
+            return draft_ids
+
+        # Rows follow the order of jobs that finished prefill
+        jobs = [
+            job for job in self.generator.generator.active_jobs if job.is_prefill_done()
+        ]
+        for row, job in enumerate(jobs):
+            if job.new_tokens < 0 or not job.filters:
+                continue
+
+            forced_tokens = get_forced_tokens(job.filters, draft_ids.shape[-1])
+            if forced_tokens:
+                draft_ids[row, : len(forced_tokens)] = torch.tensor(
+                    forced_tokens, dtype=torch.long
+                )
+
+                self.jump_forward_tokens[job.identifier] = self.jump_forward_tokens.get(
+                    job.identifier, 0
+                ) + len(forced_tokens)
+
+        return draft_ids
+
+    def pop_jump_forward_tokens(self, job_id: str) -> int:
+        """Returns the number of grammar-forced tokens drafted for a job."""
+
+        return self.jump_forward_tokens.pop(job_id, 0)
+
+    def release(self):
+        """Marks a job as finished and admits waiting jobs."""
+
+        self.active_jobs -= 1
+        self._wake()
+
+    def record(self, mode: str, result: dict, jump_forward_tokens: int = 0):
+        """Adds the counters of a finished job's eos result."""
+
+        counters = self.counters[mode]
+        counters["jobs"] += 1
+        counters["new_tokens"] += result.get("new_tokens", 0)
+        counters["accepted_draft_tokens"] += result.get("accepted_draft_tokens", 0)
+        counters["rejected_draft_tokens"] += result.get("rejected_draft_tokens", 0)
+        counters["jump_forward_tokens"] += jump_forward_tokens
+
+    def stats(self) -> dict:
+        """Returns counters and draft efficiency per speculation mode."""
+
+        return {
+            mode: {
+                **counters,
+                **get_draft_stats(
+                    counters["new_tokens"],
+                    counters["accepted_draft_tokens"],
+                    counters["rejected_draft_tokens"],
+                ),
+            }
+            for mode, counters in self.counters.items()
+        }
@@ -0,0 +1,94 @@
+"""Prefix tokenization cache for the ExLlamaV2 backend."""
+
+import re
+import threading
+from array import array
+from exllamav2 import ExLlamaV2Tokenizer
+from hashlib import blake2b
+from typing import List
+
+from common.lru_cache import LRUCache
+
+
+class PrefixTokenCache:
+    """
+    Caches the token ids of prompt segments, keyed by their text prefix.
+
+    With special tokens enabled, ExLlamaV2 splits text on special token
+    pieces and encodes each run of plain text on its own. Splitting at the
+    same chat template boundaries is therefore exact. A segment is cached
+    under a digest of all text up to and including it, so repeated system
+    prompts and conversation history are reused and only the new suffix
+    of a prompt gets encoded.
+    """
+
+    # Shorter segments are cheaper to encode than to look up
+    min_segment_length: int = 64
+
+    def __init__(self, tokenizer: ExLlamaV2Tokenizer, max_bytes: int):
+        self.tokenizer = tokenizer
+        self.cache: LRUCache[array] = LRUCache(
+            max_size=None,
+            max_bytes=max_bytes,
+            get_size=lambda ids: ids.itemsize * len(ids),
+        )
+
+        # Worker pool threads share the cache
+        self._lock = threading.Lock()
+
+        special_pieces = tokenizer.extended_piece_to_id.keys()
+        self.special_delimiters = (
+            re.compile("(" + "|".join(map(re.escape, special_pieces)) + ")")
+            if special_pieces
+            else None
+        )
+
+    def encode(self, text: str, add_bos: bool = True) -> List[int]:
+        """Encodes text with special tokens, reusing cached segments."""
+
+        tokenizer = self.tokenizer
+        ids = []
+
+        if add_bos and tokenizer.bos_token_id is not None:
+            ids.append(tokenizer.bos_token_id)
+
+        # Odd indices are special token pieces
+        pieces = (
+            self.special_delimiters.split(text) if self.special_delimiters else [text]
+        )
+
+        prefix_hash = blake2b(digest_size=16)
+        for index, piece in enumerate(pieces):
+            if not piece:
+                continue
+
+            # Length prefix keeps the digest unambiguous across boundaries
+            encoded_piece = piece.encode("utf-8", "surrogatepass")
+            prefix_hash.update(len(encoded_piece).to_bytes(8, "little"))
+            prefix_hash.update(encoded_piece)
+
+            if index % 2 == 1:
+                ids.append(tokenizer.extended_piece_to_id[piece])
+            elif len(piece) < self.min_segment_length:
+                ids.extend(tokenizer.tokenizer_model.encode(piece))
+            else:
+                key = prefix_hash.digest()
+
+                with self._lock:
+                    segment_ids = self.cache.get(key)
+
+                if segment_ids is None:
+                    segment_ids = array("i", tokenizer.tokenizer_model.encode(piece))
+
+                    with self._lock:
+                        self.cache.put(key, segment_ids)
+
+                ids.extend(segment_ids)
+
+        return ids
+
+    def stats(self) -> dict:
+        """Returns the cache counters."""
+
+        with self._lock:
+            return self.cache.stats()
@@ -3,6 +3,7 @@ import torch
 from packaging import version
 from importlib.metadata import PackageNotFoundError, version as package_version
 from loguru import logger
+from typing import List, Optional
 
 
 def hardware_supports_flash_attn(gpu_device_list: list[int]):
@@ -82,3 +83,36 @@ def exllama_disabled_flash_attn(no_flash_attn: bool):
         logger.warning(unsupported_message)
 
     return no_flash_attn
+
+
+def get_continuation_ids(
+    sequence_ids: List[torch.Tensor], result: dict
+) -> Optional[torch.Tensor]:
+    """
+    Returns the token ids of a job that ended on a stop condition.
+
+    sequence_ids are the prompt ids followed by every streamed chunk of
+    token ids. The ids end with the stop condition, so a job continuing
+    from them matches the cache pages of the finished job. Returns None
+    if tokens past the stop condition were held back, since the ids can't
+    be cut inside a token.
+    """
+
+    held = result.get("held", {})
+    eos_reason = result.get("eos_reason")
+
+    if eos_reason == "stop_token":
+        # The stop token isn't streamed
+        if "token_ids" in held:
+            return None
+
+        sequence_ids = [
+            *sequence_ids,
+            torch.tensor([result.get("eos_triggering_token_id")], dtype=torch.long),
+        ]
+    elif eos_reason != "stop_string" or held.get("text") != result.get(
+        "eos_triggering_string"
+    ):
+        return None
+
+    return torch.cat([ids.flatten() for ids in sequence_ids]).unsqueeze(0)
@@ -1,77 +1,143 @@
 """Vision utilities for ExLlamaV2."""
 
-import aiohttp
-import base64
-import io
-import re
-from async_lru import alru_cache
-from fastapi import HTTPException
+import asyncio
+import hashlib
 from PIL import Image
+from typing import Dict, List, Optional
 
 from common import model
-from common.networking import (
-    handle_request_error,
-)
+from common.concurrency import cpu_pool
+from common.images import ImagePreprocessPolicy, image_fetcher
+from common.lru_cache import LRUCache
 from common.optional_dependencies import dependencies
-from common.tabby_config import config
 
 # Since this is used outside the Exl2 backend, the dependency
 # may be optional
 if dependencies.exllamav2:
+    from exllamav2 import ExLlamaV2, ExLlamaV2Tokenizer, ExLlamaV2VisionTower
     from exllamav2.generator import ExLlamaV2MMEmbedding
 
 
 async def get_image(url: str) -> Image:
-    if url.startswith("data:image"):
-        # Handle base64 image
-        match = re.match(r"^data:image\/[a-zA-Z0-9]+;base64,(.*)$", url)
-        if match:
-            base64_image = match.group(1)
-            bytes_image = base64.b64decode(base64_image)
-        else:
-            error_message = handle_request_error(
-                "Failed to read base64 image input.",
-                exc_info=False,
-            ).error.message
-
-            raise HTTPException(400, error_message)
-
-    else:
-        # Handle image URL
-        if config.network.disable_fetch_requests:
-            error_message = handle_request_error(
-                f"Failed to fetch image from {url} as fetch requests are disabled.",
-                exc_info=False,
-            ).error.message
-
-            raise HTTPException(400, error_message)
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    bytes_image = await response.read()
-                else:
-                    error_message = handle_request_error(
-                        f"Failed to fetch image from {url}.",
-                        exc_info=False,
-                    ).error.message
-
-                    raise HTTPException(400, error_message)
-
-    return Image.open(io.BytesIO(bytes_image))
-
-
-# Fetch the return type on runtime
-@alru_cache(20)
-async def get_image_embedding(url: str) -> "ExLlamaV2MMEmbedding":
-    image = await get_image(url)
-    return model.container.vision_model.get_image_embeddings(
-        model=model.container.model,
-        tokenizer=model.container.tokenizer,
-        image=image,
-        text_alias=None,
-    )
-
-
-def clear_image_embedding_cache():
-    get_image_embedding.cache_clear()
+    images = await image_fetcher.get_images([url])
+    return images[0]
+
+
+def get_image_key(data: bytes, preprocess_params: tuple = ()) -> str:
+    """
+    Hashes the file bytes of an image with its preprocessing params.
+
+    The same image sent as a URL or as base64 data has the same key.
+    """
+
+    digest = hashlib.sha256(repr(preprocess_params).encode())
+    digest.update(data)
+
+    return digest.hexdigest()
+
+
+class ImageEmbeddingCache:
+    """
+    Image embeddings of a vision model, keyed by a hash of the image.
+
+    The cache is bounded by the size of the embedding tensors. Images are
+    fetched and hashed before the lookup, but only decoded and embedded on
+    a miss. Identical images in a request are embedded once, and
+    concurrent requests for the same image wait on the same embedding.
+    Cached embeddings keep their token ids, so prompts that repeat an
+    image can also reuse the generator's prefix cache.
+    """
+
+    def __init__(
+        self,
+        vision_model: "ExLlamaV2VisionTower",
+        model: "ExLlamaV2",
+        tokenizer: "ExLlamaV2Tokenizer",
+        max_bytes: int,
+    ):
+        self.vision_model = vision_model
+        self.model = model
+        self.tokenizer = tokenizer
+        self.embeddings: LRUCache["ExLlamaV2MMEmbedding"] = LRUCache(
+            max_size=None,
+            max_bytes=max_bytes,
+            get_size=lambda embedding: embedding.get_size_in_bytes(),
+        )
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    async def get_embeddings(
+        self, urls: List[str], policy: Optional[ImagePreprocessPolicy] = None
+    ) -> List["ExLlamaV2MMEmbedding"]:
+        """Returns the embeddings of a request's images in order."""
+
+        images = await image_fetcher.fetch_all(urls)
+
+        # Preprocessing changes the embedding, so it's part of the key
+        preprocess_params = policy.key() if policy else ()
+        keys = await asyncio.gather(
+            *(
+                cpu_pool.run(get_image_key, data, preprocess_params, size=len(data))
+                for data in images
+            )
+        )
+
+        # Misses are decoded together and embedded once per unique image
+        embeddings: Dict[str, "ExLlamaV2MMEmbedding"] = {}
+        misses: Dict[str, asyncio.Future] = {}
+        for url, data, key in zip(urls, images, keys, strict=True):
+            if key in embeddings or key in misses:
+                continue
+
+            embedding = self.embeddings.get(key)
+            if embedding is not None:
+                embeddings[key] = embedding
+                continue
+
+            task = self.pending.get(key)
+            if task is None:
+                task = asyncio.create_task(self._embed(key, url, data, policy))
+                self.pending[key] = task
+
+            # Don't cancel a shared embedding if this request disconnects
+            misses[key] = asyncio.shield(task)
+
+        results = await asyncio.gather(*misses.values())
+        embeddings.update(zip(misses, results, strict=True))
+
+        return [embeddings[key] for key in keys]
+
+    async def _embed(
+        self,
+        key: str,
+        url: str,
+        data: bytes,
+        policy: Optional[ImagePreprocessPolicy],
+    ):
+        try:
+            image = await image_fetcher.decode(url, data, policy)
+            embedding = self.vision_model.get_image_embeddings(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                image=image,
+                text_alias=None,
+            )
+
+            self.embeddings.put(key, embedding)
+
+            return embedding
+        finally:
+            self.pending.pop(key, None)
+
+    def clear(self):
+        self.embeddings.clear()
+
+    def stats(self):
+        return self.embeddings.stats()
+
+
+async def get_image_embeddings(
+    urls: List[str], policy: Optional[ImagePreprocessPolicy] = None
+) -> List["ExLlamaV2MMEmbedding"]:
+    """Returns the embeddings of a request's images using the model's cache."""
+
+    return await model.container.image_embedding_cache.get_embeddings(urls, policy)
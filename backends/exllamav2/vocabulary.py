@@ -0,0 +1,194 @@
+"""Engine vocabulary for grammar filters, persisted between restarts."""
+
+import hashlib
+import mmap
+import os
+import pathlib
+import struct
+from array import array
+from importlib.metadata import version as package_version
+from typing import Dict, Optional, Tuple
+
+import kbnf
+from exllamav2 import ExLlamaV2Tokenizer
+from formatron.integrations.utils import get_original_characters
+from loguru import logger
+
+# Built vocabularies are stored here, one file per tokenizer
+VOCABULARY_DIR = pathlib.Path("cache") / "vocabulary"
+
+# Files that change the vocabulary if they change
+TOKENIZER_FILES = (
+    "tokenizer.json",
+    "tokenizer.model",
+    "tokenizer_config.json",
+    "added_tokens.json",
+    "special_tokens_map.json",
+)
+
+# Bump when the file layout changes
+_MAGIC = b"TABBYVOC"
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sII")
+
+
+def get_vocabulary_key(model_dir: pathlib.Path) -> str:
+    """
+    Hashes the tokenizer files of a model.
+
+    The formatron version is included since it decides how tokens are
+    converted to bytes.
+    """
+
+    digest = hashlib.sha256(
+        f"{_FORMAT_VERSION}:{package_version('formatron')}".encode()
+    )
+
+    for file_name in TOKENIZER_FILES:
+        file_path = model_dir / file_name
+        if not file_path.exists():
+            continue
+
+        digest.update(file_name.encode())
+        with open(file_path, "rb") as tokenizer_file:
+            for chunk in iter(lambda: tokenizer_file.read(1024**2), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _build_tokens(tokenizer: ExLlamaV2Tokenizer):
+    """
+    Converts every token to its raw bytes.
+
+    Same as formatron.integrations.exllamav2.create_engine_vocabulary, which
+    is the slow part of creating a vocabulary.
+    """
+
+    tokenizer_model = tokenizer.tokenizer_model
+    vocab = {
+        tokenizer_model.id_to_piece(token_id): token_id
+        for token_id in range(tokenizer_model.vocab_size())
+    }
+
+    token_bytes = get_original_characters(vocab)
+    pieces = {token_id: piece for piece, token_id in vocab.items()}
+
+    return token_bytes, pieces
+
+
+def _write_tokens(
+    path: pathlib.Path, token_bytes: Dict[int, bytes], pieces: Dict[int, str]
+):
+    """
+    Writes tokens as a header, token ids, two offset tables and two blobs.
+
+    The file is written next to its destination and renamed, so readers
+    never see a partial file.
+    """
+
+    token_ids = array("I", sorted(token_bytes))
+    encoded_pieces = [pieces[token_id].encode() for token_id in token_ids]
+
+    blobs = []
+    offset_tables = []
+    for values in ([token_bytes[token_id] for token_id in token_ids], encoded_pieces):
+        offsets = array("I", [0])
+        for value in values:
+            offsets.append(offsets[-1] + len(value))
+
+        offset_tables.append(offsets)
+        blobs.append(b"".join(values))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(temp_path, "wb") as vocab_file:
+        vocab_file.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(token_ids)))
+        vocab_file.write(token_ids.tobytes())
+        for offsets in offset_tables:
+            vocab_file.write(offsets.tobytes())
+        for blob in blobs:
+            vocab_file.write(blob)
+
+    os.replace(temp_path, path)
+
+
+def _read_tokens(
+    path: pathlib.Path,
+) -> Optional[Tuple[Dict[int, bytes], Dict[int, str]]]:
+    """Reads tokens from a memory-mapped vocabulary file."""
+
+    with (
+        open(path, "rb") as vocab_file,
+        mmap.mmap(vocab_file.fileno(), 0, access=mmap.ACCESS_READ) as vocab_map,
+    ):
+        magic, format_version, count = _HEADER.unpack_from(vocab_map)
+        if magic != _MAGIC or format_version != _FORMAT_VERSION:
+            return None
+
+        position = _HEADER.size
+        tables = []
+        for length in (count, count + 1, count + 1):
+            table = array("I")
+            table.frombytes(vocab_map[position : position + length * 4])
+            tables.append(table)
+            position += length * 4
+
+        token_ids, byte_offsets, piece_offsets = tables
+        if position + byte_offsets[-1] + piece_offsets[-1] != len(vocab_map):
+            return None
+
+        bytes_blob = vocab_map[position : position + byte_offsets[-1]]
+        position += byte_offsets[-1]
+        pieces_blob = vocab_map[position : position + piece_offsets[-1]]
+
+    token_bytes = {
+        token_id: bytes_blob[start:end]
+        for token_id, start, end in zip(
+            token_ids, byte_offsets[:-1], byte_offsets[1:], strict=True
+        )
+    }
+    pieces = {
+        token_id: pieces_blob[start:end].decode()
+        for token_id, start, end in zip(
+            token_ids, piece_offsets[:-1], piece_offsets[1:], strict=True
+        )
+    }
+
+    return token_bytes, pieces
+
+
+def load_engine_vocabulary(
+    tokenizer: ExLlamaV2Tokenizer, model_dir: pathlib.Path
+) -> kbnf.Vocabulary:
+    """
+    Creates the kbnf vocabulary of a tokenizer.
+
+    Tokens are read from the vocabulary cache if the tokenizer files match.
+    Otherwise they're built and saved for the next start.
+    """
+
+    path = VOCABULARY_DIR / f"{get_vocabulary_key(model_dir)}.bin"
+
+    tokens = None
+    if path.exists():
+        try:
+            tokens = _read_tokens(path)
+        except Exception as exc:
+            logger.warning(
+                f"Rebuilding the grammar vocabulary, {path} is invalid: {exc}"
+            )
+
+    if tokens is None:
+        tokens = _build_tokens(tokenizer)
+
+        try:
+            _write_tokens(path, *tokens)
+        except OSError as exc:
+            logger.warning(f"Couldn't save the grammar vocabulary to {path}: {exc}")
+
+    token_bytes, pieces = tokens
+    return kbnf.Vocabulary(
+        {token_id: kbnf.Token(value) for token_id, value in token_bytes.items()},
+        pieces,
+    )
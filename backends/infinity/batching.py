@@ -0,0 +1,176 @@
+"""Batching and caching of embedding requests."""
+
+import asyncio
+import hashlib
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from common.concurrency import cpu_pool
+from common.lru_cache import LRUCache
+from common.optional_dependencies import dependencies
+
+if dependencies.extras:
+    from infinity_emb import AsyncEmbeddingEngine
+
+
+def get_embedding_keys(model_name: str, sentences: List[str]) -> List[str]:
+    """Hashes each sentence with the model name."""
+
+    prefix = hashlib.sha256(f"{model_name}\0".encode())
+    keys = []
+    for sentence in sentences:
+        digest = prefix.copy()
+        digest.update(sentence.encode())
+        keys.append(digest.hexdigest())
+
+    return keys
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces the sentences of concurrent requests into larger batches.
+
+    Sentences wait for up to batch_window seconds, or until max_batch_size
+    sentences are queued, and are then embedded with one engine call.
+    Embeddings are cached by a hash of the sentence and model, bounded by
+    their size in bytes. Identical sentences in a batch or in concurrent
+    requests are embedded once.
+    """
+
+    def __init__(
+        self,
+        engine: "AsyncEmbeddingEngine",
+        model_name: str,
+        max_batch_size: int,
+        batch_window: float,
+        cache_bytes: int,
+    ):
+        self.engine = engine
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.embeddings: LRUCache[np.ndarray] = LRUCache(
+            max_size=None, max_bytes=cache_bytes, get_size=lambda value: value.nbytes
+        )
+
+        self.queue: List[Tuple[str, str]] = []
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.tasks = set()
+        self.batches = 0
+        self.batched_sentences = 0
+
+    async def embed(self, sentences: List[str]) -> np.ndarray:
+        """Returns the embeddings of the sentences as one float32 matrix."""
+
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys = await cpu_pool.run(
+            get_embedding_keys,
+            self.model_name,
+            sentences,
+            size=sum(len(sentence) for sentence in sentences),
+        )
+
+        embeddings: Dict[str, np.ndarray] = {}
+        misses: Dict[str, asyncio.Future] = {}
+        for key, sentence in zip(keys, sentences, strict=True):
+            if key in embeddings or key in misses:
+                continue
+
+            embedding = self.embeddings.get(key)
+            if embedding is not None:
+                embeddings[key] = embedding
+                continue
+
+            future = self.pending.get(key)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                self.pending[key] = future
+                self.queue.append((key, sentence))
+
+            # Don't cancel a shared embedding if this request disconnects
+            misses[key] = asyncio.shield(future)
+
+        self.schedule_flush()
+
+        results = await asyncio.gather(*misses.values())
+        embeddings.update(zip(misses, results, strict=True))
+
+        return np.stack([embeddings[key] for key in keys])
+
+    def schedule_flush(self):
+        """Starts full batches now and the rest after the batch window."""
+
+        while len(self.queue) >= self.max_batch_size:
+            self.start_batch(self.queue[: self.max_batch_size])
+            del self.queue[: self.max_batch_size]
+
+        if self.queue and self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_window, self.flush
+            )
+
+    def flush(self):
+        self.flush_handle = None
+
+        if self.queue:
+            self.start_batch(self.queue)
+            self.queue = []
+
+    def start_batch(self, batch: List[Tuple[str, str]]):
+        task = asyncio.create_task(self.embed_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def embed_batch(self, batch: List[Tuple[str, str]]):
+        keys, sentences = zip(*batch, strict=True)
+        self.batches += 1
+        self.batched_sentences += len(batch)
+
+        try:
+            results, _ = await self.engine.embed(list(sentences))
+        except Exception as exc:
+            for key in keys:
+                future = self.pending.pop(key)
+                if not future.done():
+                    future.set_exception(exc)
+
+            return
+
+        for key, result in zip(keys, results, strict=True):
+            embedding = np.asarray(result, dtype=np.float32)
+            embedding.flags.writeable = False
+            self.embeddings.put(key, embedding)
+
+            future = self.pending.pop(key)
+            if not future.done():
+                future.set_result(embedding)
+
+    async def close(self):
+        """Cancels queued sentences and batches that are running."""
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        self.queue.clear()
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.embeddings.clear()
+
+    def stats(self):
+        return {
+            **self.embeddings.stats(),
+            "batches": self.batches,
+            "avg_batch_size": (
+                round(self.batched_sentences / self.batches, 2) if self.batches else 0
+            ),
+        }
@@ -4,6 +4,7 @@ import torch
 from loguru import logger
 from typing import List, Optional
 
+from backends.infinity.batching import EmbeddingBatcher
 from common.utils import unwrap
 from common.optional_dependencies import dependencies
 
@@ -19,6 +20,7 @@ class InfinityContainer:
 
     # Use a runtime type hint here
     engine: Optional["AsyncEmbeddingEngine"] = None
+    batcher: Optional[EmbeddingBatcher] = None
 
     def __init__(self, model_directory: pathlib.Path):
         self.model_dir = model_directory
@@ -28,11 +30,13 @@ class InfinityContainer:
 
         # Use cpu by default
         device = unwrap(kwargs.get("embeddings_device"), "cpu")
+        max_batch_size = unwrap(kwargs.get("embeddings_max_batch_size"), 32)
 
         engine_args = EngineArgs(
             model_name_or_path=str(self.model_dir),
             engine="torch",
             device=device,
+            batch_size=max_batch_size,
             bettertransformer=False,
             model_warmup=False,
         )
@@ -40,10 +44,23 @@ class InfinityContainer:
         self.engine = AsyncEmbeddingEngine.from_args(engine_args)
         await self.engine.astart()
 
+        self.batcher = EmbeddingBatcher(
+            self.engine,
+            self.model_dir.name,
+            max_batch_size,
+            unwrap(kwargs.get("embeddings_batch_window"), 0.005),
+            unwrap(kwargs.get("embeddings_cache_bytes"), 67108864),
+        )
+
         self.model_loaded = True
         logger.info("Embedding model successfully loaded.")
 
     async def unload(self):
+        if self.batcher:
+            logger.info(f"Embedding cache stats on unload: {self.batcher.stats()}")
+            await self.batcher.close()
+            self.batcher = None
+
         await self.engine.astop()
         self.engine = None
 
@@ -53,6 +70,10 @@ class InfinityContainer:
         logger.info("Embedding model unloaded.")
 
     async def generate(self, sentence_input: List[str]):
-        result_embeddings, usage = await self.engine.embed(sentence_input)
+        embeddings = await self.batcher.embed(sentence_input)
+
+        # Infinity counts the characters of each sentence as its usage,
+        # so cached and batched sentences are counted the same way
+        usage = sum(len(sentence) for sentence in sentence_input)
 
-        return {"embeddings": result_embeddings, "usage": usage}
+        return {"embeddings": embeddings, "usage": usage}
@@ -0,0 +1,56 @@
+"""Append-only buffer for assembling streamed generations."""
+
+from typing import List, Optional
+
+from common.logprobs import TokenLogprobs
+
+
+class ResponseAccumulator:
+    """
+    Collects the chunks of a generation without repeated concatenation.
+
+    Text is joined lazily on read, and only the chunks appended since the
+    previous read are copied. This keeps assembly linear in the response
+    length while still allowing cheap snapshots of an in-progress stream.
+    """
+
+    __slots__ = ("chunks", "offsets", "logprobs", "length", "_text", "_joined")
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.offsets: List[int] = []
+        self.logprobs: Optional[TokenLogprobs] = None
+        self.length = 0
+        self._text = ""
+        self._joined = 0
+
+    def append(
+        self,
+        text: Optional[str],
+        offset: Optional[int] = None,
+        logprobs: Optional[TokenLogprobs] = None,
+    ):
+        """Adds a chunk along with its offset and logprobs if provided."""
+
+        if text:
+            self.chunks.append(text)
+            self.length += len(text)
+
+        if offset is not None:
+            self.offsets.append(offset)
+
+        if logprobs:
+            if self.logprobs is None:
+                self.logprobs = TokenLogprobs()
+
+            self.logprobs.extend(logprobs)
+
+    @property
+    def text(self) -> str:
+        """Returns the text received so far."""
+
+        if self._joined < len(self.chunks):
+            self._text = "".join([self._text, *self.chunks[self._joined :]])
+            self._joined = len(self.chunks)
+
+        return self._text
@@ -86,6 +86,22 @@ async def load_auth_keys(disable_from_config: bool):
     )
 
 
+def get_request_key(request: Request):
+    """Gets the authentication key provided in a request's headers."""
+
+    # Hyphens are okay here
+    test_key = coalesce(
+        request.headers.get("x-admin-key"),
+        request.headers.get("x-api-key"),
+        request.headers.get("authorization"),
+    )
+
+    if test_key and test_key.lower().startswith("bearer"):
+        test_key = test_key.split(" ")[1]
+
+    return test_key
+
+
 def get_key_permission(request: Request):
     """
     Gets the key permission from a request.
@@ -97,19 +113,11 @@ def get_key_permission(request: Request):
     if DISABLE_AUTH:
         return "admin"
 
-    # Hyphens are okay here
-    test_key = coalesce(
-        request.headers.get("x-admin-key"),
-        request.headers.get("x-api-key"),
-        request.headers.get("authorization"),
-    )
+    test_key = get_request_key(request)
 
     if test_key is None:
         raise ValueError("The provided authentication key is missing.")
 
-    if test_key.lower().startswith("bearer"):
-        test_key = test_key.split(" ")[1]
-
     if AUTH_KEYS.verify_key(test_key, "admin_key"):
         return "admin"
     elif AUTH_KEYS.verify_key(test_key, "api_key"):
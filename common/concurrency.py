@@ -1,8 +1,12 @@
 """Concurrency handling"""
 
 import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.concurrency import run_in_threadpool  # noqa
-from typing import AsyncGenerator, Generator
+from typing import AsyncGenerator, AsyncIterable, Callable, Generator, Optional
+
+from common.tabby_config import config
 
 
 # Originally from https://github.com/encode/starlette/blob/master/starlette/concurrency.py
@@ -30,3 +34,112 @@ async def iterate_in_threadpool(generator: Generator) -> AsyncGenerator:
             yield await asyncio.to_thread(gen_next, generator)
         except _StopIteration:
             break
+
+
+async def iterate_until(iterable: AsyncIterable, deadline: Optional[float]):
+    """
+    Iterates an async iterable until a unix timestamp.
+
+    Raises asyncio.TimeoutError if the next value isn't ready by the deadline.
+    """
+
+    if deadline is None:
+        async for value in iterable:
+            yield value
+
+        return
+
+    iterator = aiter(iterable)
+    while True:
+        try:
+            value = await asyncio.wait_for(
+                anext(iterator), max(deadline - time.time(), 0)
+            )
+        except StopAsyncIteration:
+            break
+
+        yield value
+
+
+class CPUWorkerPool:
+    """
+    Thread pool for CPU-bound request preparation.
+
+    Tokenization and prompt template rendering of long inputs run here so
+    the event loop keeps streaming tokens to other clients. Inputs below
+    the inline threshold are cheaper to handle in place.
+    """
+
+    def __init__(self):
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.inline_calls = 0
+        self.pooled_calls = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        self.run_time_total = 0.0
+
+    def should_offload(self, size: Optional[int] = None):
+        """Checks if an input of the given size should run on the pool."""
+
+        if config.developer.cpu_worker_threads < 1:
+            return False
+
+        return size is None or size >= config.developer.cpu_inline_threshold
+
+    async def run(self, func: Callable, *args, size: Optional[int] = None, **kwargs):
+        """
+        Runs a function on the pool and awaits the result.
+
+        If a size is provided and it's below the inline threshold, the
+        function runs directly on the event loop.
+        """
+
+        if not self.should_offload(size):
+            self.inline_calls += 1
+            return func(*args, **kwargs)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=config.developer.cpu_worker_threads,
+                thread_name_prefix="cpu_worker",
+            )
+
+        submit_time = time.perf_counter()
+
+        def timed_call():
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            return result, start_time - submit_time, time.perf_counter() - start_time
+
+        loop = asyncio.get_running_loop()
+        result, queue_time, run_time = await loop.run_in_executor(
+            self.executor, timed_call
+        )
+
+        self.pooled_calls += 1
+        self.queue_time_total += queue_time
+        self.queue_time_max = max(self.queue_time_max, queue_time)
+        self.run_time_total += run_time
+
+        return result
+
+    def stats(self) -> dict:
+        """Returns call counts and queue times in seconds."""
+
+        pooled_calls = self.pooled_calls
+        return {
+            "workers": config.developer.cpu_worker_threads,
+            "inline_calls": self.inline_calls,
+            "pooled_calls": pooled_calls,
+            "queue_time_avg": (
+                round(self.queue_time_total / pooled_calls, 6) if pooled_calls else 0.0
+            ),
+            "queue_time_max": round(self.queue_time_max, 6),
+            "run_time_avg": (
+                round(self.run_time_total / pooled_calls, 6) if pooled_calls else 0.0
+            ),
+        }
+
+
+# Global CPU worker pool
+cpu_pool = CPUWorkerPool()
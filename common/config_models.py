@@ -9,6 +9,9 @@ from typing import List, Literal, Optional, Union
 
 
 CACHE_SIZES = Literal["FP16", "Q8", "Q6", "Q4"]
+IMAGE_RESAMPLE_FILTERS = Literal[
+    "nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"
+]
 
 
 class Metadata(BaseModel):
@@ -76,6 +79,135 @@ class NetworkConfig(BaseConfigModel):
             "Possible values: OAI, Kobold."
         ),
     )
+    max_active_jobs: Optional[int] = Field(
+        None,
+        description=(
+            "Maximum number of generator jobs admitted at once (default: None).\n"
+            "Additional requests wait in a priority queue.\n"
+            "If this isn't set, the model's max batch size is used."
+        ),
+        ge=1,
+    )
+    max_queued_requests: Optional[int] = Field(
+        64,
+        description=(
+            "Maximum number of queued requests per priority class (default: 64).\n"
+            "New requests are rejected with 429 when the queue is full.\n"
+            "Set to 0 to disable this limit."
+        ),
+        ge=0,
+    )
+    max_queue_wait: Optional[float] = Field(
+        None,
+        description=(
+            "Reject requests with 503 when their estimated queue wait (in seconds)\n"
+            "is larger than this value (default: None)."
+        ),
+        gt=0,
+    )
+    default_priority: Optional[Literal["interactive", "batch"]] = Field(
+        "interactive",
+        description=(
+            "Priority class of requests that don't set one (default: interactive).\n"
+            "Queued interactive requests always start before batch requests.\n"
+            "Possible values: interactive, batch."
+        ),
+    )
+    key_requests_per_second: Optional[float] = Field(
+        None,
+        description=(
+            "Default request rate limit of each API key (default: None).\n"
+            "Limits can be adjusted per key with the /v1/auth/limits endpoint."
+        ),
+        gt=0,
+    )
+    key_concurrent_jobs: Optional[int] = Field(
+        None,
+        description=(
+            "Default number of generator jobs each API key can run at once "
+            "(default: None).\n"
+            "Further requests of the key wait in the queue."
+        ),
+        ge=1,
+    )
+    key_tokens_per_minute: Optional[int] = Field(
+        None,
+        description=(
+            "Default prompt + generated tokens per minute of each API key "
+            "(default: None)."
+        ),
+        ge=1,
+    )
+    key_timeout: Optional[float] = Field(
+        None,
+        description=(
+            "Default timeout in seconds of requests without a timeout or deadline "
+            "(default: None).\n"
+            "Unfinished generations stop with a finish_reason of timeout."
+        ),
+        gt=0,
+    )
+    stream_flush_interval: Optional[float] = Field(
+        0.05,
+        description=(
+            "Max seconds to merge streamed tokens while a client is behind "
+            "(default: 0.05).\n"
+            "Clients that keep up get every token as its own event. "
+            "Set to 0 to disable merging."
+        ),
+        ge=0,
+    )
+    stream_flush_bytes: Optional[int] = Field(
+        4096,
+        description=(
+            "Merged stream text is sent once it reaches this many bytes "
+            "(default: 4096)."
+        ),
+        ge=1,
+    )
+    stream_buffer_bytes: Optional[int] = Field(
+        262144,
+        description=(
+            "Max bytes of generated text buffered for a streaming client "
+            "(default: 262144).\n"
+            "Once full, the stream stops reading from the model until the "
+            "client catches up."
+        ),
+        ge=1,
+    )
+    stream_stall_timeout: Optional[float] = Field(
+        60.0,
+        description=(
+            "Seconds a stream's buffer can stay full before its generation is "
+            "cancelled (default: 60).\n"
+            "Set to null to wait for the client indefinitely."
+        ),
+        gt=0,
+    )
+    image_fetch_timeout: Optional[float] = Field(
+        30.0,
+        description=(
+            "Seconds to wait for an image URL to download (default: 30).\n"
+            "Set to null to wait indefinitely."
+        ),
+        gt=0,
+    )
+    image_fetch_max_bytes: Optional[int] = Field(
+        20971520,
+        description=(
+            "Max total bytes of the images in one request (default: 20971520).\n"
+            "Larger requests are rejected. Set to null to disable this limit."
+        ),
+        ge=1,
+    )
+    image_fetch_concurrency: Optional[int] = Field(
+        4,
+        description=(
+            "Number of images of one request that are downloaded at once "
+            "(default: 4)."
+        ),
+        ge=1,
+    )
 
     # Converts all strings in the api_servers list to lowercase
     # NOTE: Expand if more models need this validator
@@ -104,6 +236,14 @@ class LoggingConfig(BaseConfigModel):
             "NOTE: Only use this for debugging!"
         ),
     )
+    log_background_writer: Optional[bool] = Field(
+        False,
+        description=(
+            "Format and write prompt, response and metric logs "
+            "on a background thread (default: False).\n"
+            "Reduces request latency when prompt logging is enabled."
+        ),
+    )
 
 
 class ModelConfig(BaseConfigModel):
@@ -255,6 +395,32 @@ class ModelConfig(BaseConfigModel):
         ),
         ge=1,
     )
+    tokenizer_cache_size: Optional[int] = Field(
+        64,
+        description=(
+            "Memory budget in MB for cached prompt prefix tokens (default: 64).\n"
+            "Repeated system prompts and chat history are tokenized once.\n"
+            "Set to 0 to disable."
+        ),
+        ge=0,
+    )
+    grammar_cache_size: Optional[int] = Field(
+        32,
+        description=(
+            "Number of compiled grammars to keep in memory (default: 32).\n"
+            "JSON schemas, regex patterns and KBNF grammars are compiled once.\n"
+            "Set to 0 to disable."
+        ),
+        ge=0,
+    )
+    grammar_schemas: Optional[List[str]] = Field(
+        default_factory=list,
+        description=(
+            "Paths of JSON schema files to compile when the model loads "
+            "(default: None).\n"
+            "The tool call schema is always compiled."
+        ),
+    )
     prompt_template: Optional[str] = Field(
         None,
         description=(
@@ -271,6 +437,38 @@ class ModelConfig(BaseConfigModel):
             "Enables vision support if the model supports it. (default: False)"
         ),
     )
+    vision_cache_bytes: Optional[int] = Field(
+        268435456,
+        description=(
+            "Max bytes of image embeddings kept in memory (default: 268435456).\n"
+            "Identical images are only embedded once. Set to 0 to disable."
+        ),
+        ge=0,
+    )
+    vision_max_pixels: Optional[int] = Field(
+        None,
+        description=(
+            "Images with more pixels are downscaled before embedding (default: None).\n"
+            "Lowers the number of tokens per image. Requests can set a lower limit."
+        ),
+        gt=0,
+    )
+    vision_max_side: Optional[int] = Field(
+        None,
+        description=(
+            "Images with a longer side are downscaled before embedding "
+            "(default: None).\n"
+            "Capped by the max image size of the vision model."
+        ),
+        gt=0,
+    )
+    vision_resample: Optional[IMAGE_RESAMPLE_FILTERS] = Field(
+        "bicubic",
+        description=(
+            "Resampling filter used to downscale images (default: bicubic).\n"
+            f"Possible values: {str(IMAGE_RESAMPLE_FILTERS)[15:-1]}."
+        ),
+    )
 
     _metadata: Metadata = PrivateAttr(Metadata())
     model_config = ConfigDict(protected_namespaces=())
@@ -378,6 +576,31 @@ class EmbeddingsConfig(BaseConfigModel):
         None,
         description=("An initial embedding model to load on the infinity backend."),
     )
+    embeddings_max_batch_size: Optional[int] = Field(
+        32,
+        description=(
+            "Max sentences embedded together (default: 32).\n"
+            "Sentences of concurrent requests are batched up to this size."
+        ),
+        ge=1,
+    )
+    embeddings_batch_window: Optional[float] = Field(
+        0.005,
+        description=(
+            "Seconds to wait for more sentences before embedding a batch "
+            "(default: 0.005).\n"
+            "Full batches don't wait. Set to 0 to only batch concurrent requests."
+        ),
+        ge=0,
+    )
+    embeddings_cache_bytes: Optional[int] = Field(
+        67108864,
+        description=(
+            "Max bytes of embeddings kept in memory (default: 67108864).\n"
+            "Repeated sentences are only embedded once. Set to 0 to disable."
+        ),
+        ge=0,
+    )
 
 
 class SamplingConfig(BaseConfigModel):
@@ -419,6 +642,24 @@ class DeveloperConfig(BaseConfigModel):
             "Otherwise, the priority will be set to high."
         ),
     )
+    cpu_worker_threads: Optional[int] = Field(
+        4,
+        description=(
+            "Number of threads for tokenization and prompt template rendering "
+            "(default: 4).\n"
+            "Keeps long prompts from blocking the event loop. "
+            "Set to 0 to run these on the event loop."
+        ),
+        ge=0,
+    )
+    cpu_inline_threshold: Optional[int] = Field(
+        2048,
+        description=(
+            "Inputs shorter than this many characters are tokenized and rendered "
+            "on the event loop (default: 2048)."
+        ),
+        ge=0,
+    )
 
 
 class TabbyConfigModel(BaseModel):
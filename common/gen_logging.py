@@ -1,13 +1,63 @@
 """
 Functions for logging generation events.
+
+Log payloads are only built and formatted when their sink is enabled.
+Prompt, response and metric logs can optionally be written on a
+background thread to keep formatting off the request path.
 """
 
+import queue
+import threading
 from loguru import logger
-from typing import Optional
+from typing import Callable, Optional
 
 from common.tabby_config import config
 
 
+class BackgroundLogWriter:
+    """Formats and writes log records on a daemon thread."""
+
+    def __init__(self):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, func: Callable, *args):
+        """Queues a log function to run on the writer thread."""
+
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="tabby-log-writer", daemon=True
+                    )
+                    self._thread.start()
+
+        self._queue.put((func, args))
+
+    def _run(self):
+        while True:
+            func, args = self._queue.get()
+
+            try:
+                func(*args)
+            except Exception as exc:
+                logger.error(f"Background log writer failed: {exc}")
+
+
+# Global log writer
+background_writer = BackgroundLogWriter()
+
+
+def _write(func: Callable, *args):
+    """Runs a log function inline or on the background writer."""
+
+    if config.logging.log_background_writer:
+        background_writer.submit(func, *args)
+    else:
+        func(*args)
+
+
 def broadcast_status():
     """Broadcasts the current logging status"""
     enabled = []
@@ -23,36 +73,53 @@ def broadcast_status():
         logger.info("Generation logging is disabled")
 
 
-def log_generation_params(**kwargs):
-    """Logs generation parameters to console."""
+def log_generation_params(get_params: Callable[[], dict]):
+    """
+    Logs generation parameters to console.
+
+    Params are passed as a callable since snapshotting them is expensive.
+    """
+
     if config.logging.log_generation_params:
-        logger.info(f"Generation options: {kwargs}\n")
+        logger.info(f"Generation options: {get_params()}\n")
+
 
+def _write_prompt(
+    prompt: str, request_id: str, negative_prompt: Optional[str], prefix: str
+):
+    formatted_prompt = "\n" + prefix + prompt
+    logger.info(
+        f"Prompt (ID: {request_id}): {formatted_prompt if prompt else 'Empty'}\n"
+    )
 
-def log_prompt(prompt: str, request_id: str, negative_prompt: Optional[str]):
-    """Logs the prompt to console."""
+    if negative_prompt:
+        formatted_negative_prompt = "\n" + negative_prompt
+        logger.info(f"Negative Prompt: {formatted_negative_prompt}\n")
+
+
+def log_prompt(
+    prompt: str, request_id: str, negative_prompt: Optional[str], prefix: str = ""
+):
+    """Logs the prompt to console. The prefix is usually the BOS token."""
     if config.logging.log_prompt:
-        formatted_prompt = "\n" + prompt
-        logger.info(
-            f"Prompt (ID: {request_id}): {formatted_prompt if prompt else 'Empty'}\n"
-        )
+        _write(_write_prompt, prompt, request_id, negative_prompt, prefix)
+
 
-        if negative_prompt:
-            formatted_negative_prompt = "\n" + negative_prompt
-            logger.info(f"Negative Prompt: {formatted_negative_prompt}\n")
+def _write_response(request_id: str, response: str):
+    formatted_response = "\n" + response
+    logger.info(
+        f"Response (ID: {request_id}): "
+        f"{formatted_response if response else 'Empty'}\n"
+    )
 
 
 def log_response(request_id: str, response: str):
     """Logs the response to console."""
     if config.logging.log_prompt:
-        formatted_response = "\n" + response
-        logger.info(
-            f"Response (ID: {request_id}): "
-            f"{formatted_response if response else 'Empty'}\n"
-        )
+        _write(_write_response, request_id, response)
 
 
-def log_metrics(
+def _write_metrics(
     request_id: str,
     queue_time: float,
     prompt_tokens: int,
@@ -62,6 +129,7 @@ def log_metrics(
     generate_time: float,
     context_len: Optional[int],
     max_seq_len: int,
+    draft_stats: Optional[dict] = None,
 ):
     initial_response = (
         f"Metrics (ID: {request_id}): {generated_tokens} tokens generated in "
@@ -89,6 +157,18 @@ def log_metrics(
     )
     itemization.append(f"Generate: {generate_ts} T/s")
 
+    # Only present if the job ran with draft tokens
+    if draft_stats:
+        itemization.append(
+            f"Draft: {round(draft_stats['acceptance_rate'] * 100, 2)}% accepted, "
+            f"{draft_stats['tokens_per_step']} tokens/step"
+        )
+
+        if "jump_forward_tokens" in draft_stats:
+            itemization.append(
+                f"Jump-forward: {draft_stats['jump_forward_tokens']} tokens"
+            )
+
     # Add context (original token count)
     if context_len:
         itemization.append(f"Context: {context_len} tokens")
@@ -100,3 +180,32 @@ def log_metrics(
     logger.info(
         initial_response + " (" + ", ".join(itemization) + ") " + " ".join(extra_parts)
     )
+
+
+def log_metrics(
+    request_id: str,
+    queue_time: float,
+    prompt_tokens: int,
+    cached_tokens: int,
+    prompt_time: float,
+    generated_tokens: int,
+    generate_time: float,
+    context_len: Optional[int],
+    max_seq_len: int,
+    draft_stats: Optional[dict] = None,
+):
+    """Logs the metrics of a finished generation to console."""
+
+    _write(
+        _write_metrics,
+        request_id,
+        queue_time,
+        prompt_tokens,
+        cached_tokens,
+        prompt_time,
+        generated_tokens,
+        generate_time,
+        context_len,
+        max_seq_len,
+        draft_stats,
+    )
@@ -0,0 +1,278 @@
+"""Fetching and decoding of images referenced by requests."""
+
+import aiohttp
+import asyncio
+import base64
+import binascii
+import io
+import math
+import re
+from fastapi import HTTPException
+from PIL import Image, ImageOps
+from typing import List, Optional, Tuple
+
+from common.concurrency import cpu_pool
+from common.networking import handle_request_error
+from common.tabby_config import config
+
+DATA_URL_PATTERN = re.compile(r"^data:image\/[a-zA-Z0-9.+-]+;base64,(.*)$", re.DOTALL)
+
+# Cached DNS results are reused for this many seconds
+DNS_CACHE_TTL = 300
+
+READ_CHUNK_SIZE = 65536
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+def raise_image_error(message: str):
+    """Logs an image error and raises it as a bad request."""
+
+    error_message = handle_request_error(message, exc_info=False).error.message
+    raise HTTPException(400, error_message)
+
+
+class ImageByteBudget:
+    """Bytes that the images of one request can still use."""
+
+    __slots__ = ("remaining",)
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.remaining = max_bytes
+
+    def consume(self, size: int, url: str):
+        if self.remaining is None:
+            return
+
+        self.remaining -= size
+        if self.remaining < 0:
+            raise_image_error(
+                f"Failed to fetch image from {url[:64]}, the images of the request "
+                f"are larger than {config.network.image_fetch_max_bytes} bytes."
+            )
+
+
+def min_limit(limit: Optional[int], other: Optional[int]):
+    """Returns the lower of two optional limits."""
+
+    if limit is None:
+        return other
+
+    return limit if other is None else min(limit, other)
+
+
+class ImagePreprocessPolicy:
+    """
+    Limits applied to images before they're embedded.
+
+    The number of embedding tokens of an image grows with its resolution,
+    so images larger than max_side or max_pixels are downscaled with the
+    given resampling filter, keeping their aspect ratio.
+    """
+
+    __slots__ = ("max_pixels", "max_side", "resample")
+
+    def __init__(
+        self,
+        max_pixels: Optional[int] = None,
+        max_side: Optional[int] = None,
+        resample: str = "bicubic",
+    ):
+        self.max_pixels = max_pixels
+        self.max_side = max_side
+        self.resample = resample
+
+    def restrict(
+        self,
+        max_pixels: Optional[int] = None,
+        max_side: Optional[int] = None,
+        resample: Optional[str] = None,
+    ):
+        """Returns a policy with a request's limits, which can only be lower."""
+
+        return ImagePreprocessPolicy(
+            min_limit(self.max_pixels, max_pixels),
+            min_limit(self.max_side, max_side),
+            resample or self.resample,
+        )
+
+    def key(self) -> tuple:
+        return (self.max_pixels, self.max_side, self.resample)
+
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Returns the size of an image after downscaling."""
+
+        scale = 1.0
+        if self.max_side:
+            scale = min(scale, self.max_side / max(width, height))
+        if self.max_pixels:
+            scale = min(scale, math.sqrt(self.max_pixels / (width * height)))
+
+        if scale >= 1.0:
+            return width, height
+
+        return max(int(width * scale), 1), max(int(height * scale), 1)
+
+
+def decode_image(
+    data: bytes, policy: Optional[ImagePreprocessPolicy] = None
+) -> Image.Image:
+    """
+    Decodes an image, normalizes it to upright RGB and applies a policy.
+
+    Transparent areas become white, like the vision processors do. JPEGs
+    that will be downscaled are decoded at a reduced scale, which is much
+    faster than decoding all pixels.
+    """
+
+    image = Image.open(io.BytesIO(data))
+
+    if policy:
+        size = policy.get_size(*image.size)
+        if size != image.size:
+            image.draft("RGB", size)
+
+    image.load()
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode != "RGB":
+        image = image.convert("RGBA")
+        rgb_image = Image.new("RGB", image.size, "WHITE")
+        rgb_image.paste(image, mask=image.getchannel("A"))
+        image = rgb_image
+
+    if policy:
+        size = policy.get_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, RESAMPLE_FILTERS[policy.resample])
+
+    return image
+
+
+class ImageFetcher:
+    """
+    Fetches the images of requests over a shared connection pool.
+
+    The HTTP session is created on first use and kept for the process
+    lifetime, so connections and DNS results are reused between requests.
+    All images of a request are fetched concurrently, limited by the
+    per-request concurrency and byte limits. Images are decoded on the
+    CPU worker pool.
+    """
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ttl_dns_cache=DNS_CACHE_TTL),
+                timeout=aiohttp.ClientTimeout(total=config.network.image_fetch_timeout),
+            )
+
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url: str, budget: ImageByteBudget) -> bytes:
+        """Returns the file bytes of an image URL or base64 data URL."""
+
+        if url.startswith("data:image"):
+            match = DATA_URL_PATTERN.match(url)
+            if not match:
+                raise_image_error("Failed to read base64 image input.")
+
+            encoded_image = match.group(1)
+            budget.consume(len(encoded_image) * 3 // 4, "data URL")
+
+            try:
+                return await cpu_pool.run(
+                    base64.b64decode,
+                    encoded_image,
+                    validate=True,
+                    size=len(encoded_image),
+                )
+            except binascii.Error:
+                raise_image_error("Failed to read base64 image input.")
+
+        if config.network.disable_fetch_requests:
+            raise_image_error(
+                f"Failed to fetch image from {url} as fetch requests are disabled."
+            )
+
+        try:
+            async with self.get_session().get(url) as response:
+                if response.status != 200:
+                    raise_image_error(
+                        f"Failed to fetch image from {url}. "
+                        f"Status code: {response.status}"
+                    )
+
+                # Fail before reading if the size is known
+                if response.content_length is not None:
+                    budget.consume(response.content_length, url)
+                    return await response.read()
+
+                chunks = []
+                async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                    budget.consume(len(chunk), url)
+                    chunks.append(chunk)
+
+                return b"".join(chunks)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise_image_error(f"Failed to fetch image from {url}: {repr(exc)}")
+
+    async def fetch_all(self, urls: List[str]) -> List[bytes]:
+        """Fetches the images of a request concurrently, in order."""
+
+        budget = ImageByteBudget(config.network.image_fetch_max_bytes)
+        semaphore = asyncio.Semaphore(config.network.image_fetch_concurrency)
+
+        async def fetch_limited(url: str):
+            async with semaphore:
+                return await self.fetch(url, budget)
+
+        tasks = [asyncio.create_task(fetch_limited(url)) for url in urls]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # Stop the other fetches if one fails
+            for task in tasks:
+                task.cancel()
+
+    async def decode(
+        self, url: str, data: bytes, policy: Optional[ImagePreprocessPolicy] = None
+    ) -> Image.Image:
+        """Decodes and preprocesses a fetched image on the CPU worker pool."""
+
+        try:
+            return await cpu_pool.run(decode_image, data, policy, size=len(data))
+        except (OSError, ValueError) as exc:
+            raise_image_error(f"Failed to decode image from {url[:64]}: {exc}")
+
+    async def get_images(
+        self, urls: List[str], policy: Optional[ImagePreprocessPolicy] = None
+    ) -> List[Image.Image]:
+        """Fetches and decodes the images of a request."""
+
+        images = await self.fetch_all(urls)
+        return await asyncio.gather(
+            *(
+                self.decode(url, data, policy)
+                for url, data in zip(urls, images, strict=True)
+            )
+        )
+
+
+# Global image fetcher
+image_fetcher = ImageFetcher()
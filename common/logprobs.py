@@ -0,0 +1,49 @@
+"""Backend-agnostic container for token logprobs."""
+
+from typing import Dict, List
+
+
+class TokenLogprobs:
+    """
+    Column-oriented logprobs for a run of generated tokens.
+
+    Row i holds the selected token and its top-k alternatives. Rows are
+    kept as parallel lists so chunks can be joined without rebuilding
+    per-token dicts, and duplicate token strings are preserved.
+    """
+
+    __slots__ = ("token_ids", "tokens", "token_logprobs", "top_tokens", "top_logprobs")
+
+    def __init__(
+        self,
+        token_ids: List[int] = None,
+        tokens: List[str] = None,
+        token_logprobs: List[float] = None,
+        top_tokens: List[List[str]] = None,
+        top_logprobs: List[List[float]] = None,
+    ):
+        self.token_ids = token_ids if token_ids is not None else []
+        self.tokens = tokens if tokens is not None else []
+        self.token_logprobs = token_logprobs if token_logprobs is not None else []
+        self.top_tokens = top_tokens if top_tokens is not None else []
+        self.top_logprobs = top_logprobs if top_logprobs is not None else []
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def extend(self, other: "TokenLogprobs"):
+        """Append the rows of another chunk."""
+
+        self.token_ids.extend(other.token_ids)
+        self.tokens.extend(other.tokens)
+        self.token_logprobs.extend(other.token_logprobs)
+        self.top_tokens.extend(other.top_tokens)
+        self.top_logprobs.extend(other.top_logprobs)
+
+    def top_logprob_dicts(self) -> List[Dict[str, float]]:
+        """Top-k rows as token -> logprob mappings (OAI completions format)."""
+
+        return [
+            dict(zip(tokens, logprobs, strict=True))
+            for tokens, logprobs in zip(self.top_tokens, self.top_logprobs, strict=True)
+        ]
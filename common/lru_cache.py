@@ -0,0 +1,120 @@
+"""Bounded LRU cache with hit/miss accounting."""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LRUCache(Generic[T]):
+    """
+    Small least-recently-used cache.
+
+    Unlike functools.lru_cache, entries are explicitly inserted and the
+    cache can be inspected and cleared at runtime.
+
+    If max_bytes is set, get_size is used to measure entries and the least
+    recently used ones are evicted once the total goes over budget.
+    """
+
+    def __init__(
+        self,
+        max_size: Optional[int] = 64,
+        max_bytes: Optional[int] = None,
+        get_size: Optional[Callable[[T], int]] = None,
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, T] = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[T]:
+        """Get a value and mark it as recently used."""
+
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: T):
+        """Insert a value and evict the least recently used entries."""
+
+        if self.max_bytes is not None:
+            size = self.get_size(value)
+
+            # Never cache a single entry that's over budget
+            if size > self.max_bytes:
+                self.pop(key)
+                return
+
+            self.current_bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while (self.max_size is not None and len(self._entries) > self.max_size) or (
+            self.max_bytes is not None and self.current_bytes > self.max_bytes
+        ):
+            evicted_key, _ = self._entries.popitem(last=False)
+            self.current_bytes -= self._sizes.pop(evicted_key, 0)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[T]:
+        """Remove and return a value if it exists."""
+
+        self.current_bytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, None)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], T]) -> T:
+        """Get a value or create and store it on a miss."""
+
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+
+        return value
+
+    def clear(self):
+        """Remove all entries. Counters are kept for the process lifetime."""
+
+        self._entries.clear()
+        self._sizes.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict:
+        """Returns the cache counters."""
+
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+        if self.max_size is not None:
+            stats["max_size"] = self.max_size
+
+        if self.max_bytes is not None:
+            stats["bytes"] = self.current_bytes
+            stats["max_bytes"] = self.max_bytes
+
+        return stats
@@ -8,11 +8,13 @@ import pathlib
 from enum import Enum
 from fastapi import HTTPException
 from loguru import logger
-from typing import Optional
+from typing import List, Optional
 
 from common.logger import get_loading_progress_bar
 from common.networking import handle_request_error
+from common.scheduler import configure_scheduler
 from common.tabby_config import config
+from common.utils import unwrap
 from common.optional_dependencies import dependencies
 
 if dependencies.exllamav2:
@@ -34,6 +36,7 @@ class ModelType(Enum):
     DRAFT = "draft"
     EMBEDDING = "embedding"
     VISION = "vision"
+    VOCABULARY = "vocabulary"
 
 
 def load_progress(module, modules):
@@ -49,8 +52,16 @@ async def unload_model(skip_wait: bool = False, shutdown: bool = False):
     container = None
 
 
-async def load_model_gen(model_path: pathlib.Path, **kwargs):
-    """Generator to load a model"""
+async def load_model_gen(
+    model_path: pathlib.Path, warm_schemas: Optional[List[dict]] = None, **kwargs
+):
+    """
+    Generator to load a model
+
+    warm_schemas are JSON schemas the caller always uses for constrained
+    generation, their grammars are compiled with the configured
+    grammar_schemas once the model is loaded.
+    """
     global container
 
     # Check if the model is already loaded
@@ -72,7 +83,8 @@ async def load_model_gen(model_path: pathlib.Path, **kwargs):
     container = await ExllamaV2Container.create(model_path.resolve(), False, **kwargs)
 
     # Add possible types of models that can be loaded
-    model_type = [ModelType.MODEL]
+    # The grammar vocabulary is prepared last
+    model_type = [ModelType.MODEL, ModelType.VOCABULARY]
 
     if container.use_vision:
         model_type.insert(0, ModelType.VISION)
@@ -104,6 +116,11 @@ async def load_model_gen(model_path: pathlib.Path, **kwargs):
                     progress.stop()
                 else:
                     index += 1
+
+        # Admission limits follow the generator's batch size
+        configure_scheduler(container.max_batch_size)
+
+        await container.warm_grammar_cache(unwrap(warm_schemas, []))
     finally:
         progress.stop()
 
@@ -1,8 +1,9 @@
-from backends.exllamav2.vision import get_image_embedding
+from backends.exllamav2.vision import get_image_embeddings
 from common import model
+from common.images import ImagePreprocessPolicy
 from loguru import logger
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 
 from common.optional_dependencies import dependencies
 
@@ -17,15 +18,22 @@ class MultimodalEmbeddingWrapper(BaseModel):
     content: list = Field(default_factory=list)
     text_alias: List[str] = Field(default_factory=list)
 
-    async def add(self, url: str):
+    async def add(self, url: str, policy: Optional[ImagePreprocessPolicy] = None):
+        await self.extend([url], policy)
+
+    async def extend(
+        self, urls: List[str], policy: Optional[ImagePreprocessPolicy] = None
+    ):
+        """Adds the images of a request. Images are fetched concurrently."""
+
         # Determine the type of vision embedding to use
         if not self.type:
             if isinstance(model.container.vision_model, ExLlamaV2VisionTower):
                 self.type = "ExLlamaV2MMEmbedding"
 
         if self.type == "ExLlamaV2MMEmbedding":
-            embedding = await get_image_embedding(url)
-            self.content.append(embedding)
-            self.text_alias.append(embedding.text_alias)
+            for embedding in await get_image_embeddings(urls, policy):
+                self.content.append(embedding)
+                self.text_alias.append(embedding.text_alias)
         else:
             logger.error("No valid vision model to create embedding")
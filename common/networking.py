@@ -7,7 +7,8 @@ import traceback
 from fastapi import Depends, HTTPException, Request
 from loguru import logger
 from pydantic import BaseModel
-from typing import Optional
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import List, Optional
 from uuid import uuid4
 
 from common.tabby_config import config
@@ -19,6 +20,9 @@ class TabbyRequestErrorMessage(BaseModel):
     message: str
     trace: Optional[str] = None
 
+    # HTTP status of errors sent after a stream started
+    code: Optional[int] = None
+
 
 class TabbyRequestError(BaseModel):
     """Common request error type."""
@@ -61,11 +65,109 @@ def handle_request_disconnect(message: str):
     logger.error(message)
 
 
-async def request_disconnect_loop(request: Request):
-    """Polls for a starlette request disconnect."""
+class RequestDisconnect:
+    """
+    Disconnect state of a request, set by DisconnectMiddleware.
+
+    Abort events registered with watch are set as soon as the client
+    disconnects, so generation stops without waiting on a poll.
+    """
+
+    __slots__ = ("event", "abort_events")
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.abort_events: List[asyncio.Event] = []
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        self.event.set()
+
+        for abort_event in self.abort_events:
+            abort_event.set()
+
+    def watch(self, abort_event: asyncio.Event):
+        """Sets an abort event when the client disconnects."""
+
+        if self.event.is_set():
+            abort_event.set()
+        else:
+            self.abort_events.append(abort_event)
+
+    async def wait(self):
+        await self.event.wait()
+
+
+class DisconnectMiddleware:
+    """
+    ASGI middleware which watches HTTP requests for client disconnects.
+
+    One task per request reads the receive channel and hands messages to
+    the app through a queue. An http.disconnect message sets the request's
+    RequestDisconnect right away. The task sleeps on the server's receive
+    call, so idle requests don't wake up the event loop.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        disconnect = RequestDisconnect()
+        scope["request_disconnect"] = disconnect
+
+        messages = asyncio.Queue()
+        response_complete = False
+        channel_closed = False
+
+        async def read_messages():
+            nonlocal channel_closed
+
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+
+                if message["type"] == "http.disconnect":
+                    channel_closed = True
+
+                    # Servers also send this once the response is finished
+                    if not response_complete:
+                        disconnect.set()
+
+                    break
+
+        async def wrapped_receive():
+            if channel_closed and messages.empty():
+                return {"type": "http.disconnect"}
+
+            return await messages.get()
+
+        async def wrapped_send(message: Message):
+            nonlocal response_complete
+
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                response_complete = True
+
+            await send(message)
+
+        reader_task = asyncio.create_task(read_messages())
+        try:
+            await self.app(scope, wrapped_receive, wrapped_send)
+        finally:
+            reader_task.cancel()
+
+
+def get_request_disconnect(request: Request) -> RequestDisconnect:
+    """Returns the disconnect state of a request."""
 
-    while not await request.is_disconnected():
-        await asyncio.sleep(0.5)
+    return request.scope["request_disconnect"]
 
 
 async def run_with_request_disconnect(
@@ -76,7 +178,7 @@ async def run_with_request_disconnect(
     _, unfinished = await asyncio.wait(
         [
             call_task,
-            asyncio.create_task(request_disconnect_loop(request)),
+            asyncio.create_task(get_request_disconnect(request).wait()),
         ],
         return_when=asyncio.FIRST_COMPLETED,
     )
@@ -0,0 +1,289 @@
+"""Per API key accounting and rate limits."""
+
+import math
+import time
+from fastapi import Request
+from hashlib import blake2b
+from typing import Dict, Optional
+
+from common import auth
+from common.tabby_config import config
+
+# Limits which can be set per key
+LIMIT_KEYS = (
+    "requests_per_second",
+    "concurrent_jobs",
+    "tokens_per_minute",
+    "weight",
+    "timeout",
+)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when an API key is over one of its limits."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Refills at a constant rate up to its capacity.
+
+    The level is updated lazily on access, so there are no timers. It can
+    go negative when usage is charged after the fact.
+    """
+
+    __slots__ = ("rate", "capacity", "level", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1.0):
+        """Removes an amount if it's available."""
+
+        self._refill()
+        if self.level < amount:
+            return False
+
+        self.level -= amount
+        return True
+
+    def charge(self, amount: float):
+        """Removes an amount even if it isn't available."""
+
+        self._refill()
+        self.level -= amount
+
+    def is_empty(self):
+        self._refill()
+        return self.level <= 0
+
+    def wait_time(self, amount: float = 1.0):
+        """Returns the seconds until an amount is available."""
+
+        self._refill()
+        return max(amount - self.level, 0) / self.rate
+
+
+class KeyAccount:
+    """Usage counters and limits of one API key."""
+
+    __slots__ = (
+        "key_id",
+        "permission",
+        "custom_limits",
+        "requests_per_second",
+        "concurrent_jobs",
+        "tokens_per_minute",
+        "weight",
+        "timeout",
+        "request_bucket",
+        "token_bucket",
+        "active_jobs",
+        "virtual_time",
+        "requests",
+        "rejected",
+        "prompt_tokens",
+        "generated_tokens",
+    )
+
+    def __init__(self, key_id: str, permission: str, limits: dict):
+        self.key_id = key_id
+        self.permission = permission
+        self.custom_limits = False
+
+        self.active_jobs = 0
+        self.virtual_time = 0.0
+        self.requests = 0
+        self.rejected = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+
+        self.set_limits(**limits)
+
+    def set_limits(
+        self,
+        requests_per_second: Optional[float] = None,
+        concurrent_jobs: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        weight: float = 1.0,
+        timeout: Optional[float] = None,
+    ):
+        """Replaces the limits of this key and resets its buckets."""
+
+        self.requests_per_second = requests_per_second
+        self.concurrent_jobs = concurrent_jobs
+        self.tokens_per_minute = tokens_per_minute
+        self.weight = weight
+
+        # Default timeout of requests that don't set one
+        self.timeout = timeout
+
+        # Allow bursts of up to a second of requests
+        self.request_bucket = (
+            TokenBucket(requests_per_second, max(requests_per_second, 1.0))
+            if requests_per_second
+            else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+            if tokens_per_minute
+            else None
+        )
+
+    def get_limits(self):
+        return {key: getattr(self, key) for key in LIMIT_KEYS}
+
+    def check(self):
+        """Counts a new request and raises RateLimitExceeded if it's over a limit."""
+
+        if self.request_bucket and not self.request_bucket.take():
+            self.rejected += 1
+
+            raise RateLimitExceeded(
+                "Request rate limit exceeded. Please try again later.",
+                max(math.ceil(self.request_bucket.wait_time()), 1),
+            )
+
+        # Token usage is charged after generation, so only reject on a deficit
+        if self.token_bucket and self.token_bucket.is_empty():
+            self.rejected += 1
+
+            raise RateLimitExceeded(
+                "Token rate limit exceeded. Please try again later.",
+                max(math.ceil(self.token_bucket.wait_time()), 1),
+            )
+
+        self.requests += 1
+
+    def can_start(self, jobs: int):
+        """Checks if the key can start more jobs."""
+
+        return (
+            self.concurrent_jobs is None
+            or self.active_jobs == 0
+            or self.active_jobs + jobs <= self.concurrent_jobs
+        )
+
+    def record_usage(self, prompt_tokens: int, generated_tokens: int):
+        """Adds the tokens of a finished request."""
+
+        self.prompt_tokens += prompt_tokens
+        self.generated_tokens += generated_tokens
+
+        if self.token_bucket:
+            self.token_bucket.charge(prompt_tokens + generated_tokens)
+
+    def stats(self):
+        return {
+            "permission": self.permission,
+            **self.get_limits(),
+            "active_jobs": self.active_jobs,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+        }
+
+
+class RateLimiter:
+    """
+    Tracks the accounts of API keys seen by the server.
+
+    Keys are identified by a short digest so raw keys never show up in
+    stats. If auth is disabled, requests are grouped by client host.
+    Everything runs on the event loop, so counters aren't locked.
+    """
+
+    def __init__(self):
+        self.accounts: Dict[str, KeyAccount] = {}
+        self.default_limits: Optional[dict] = None
+
+    @staticmethod
+    def get_key_id(key: str):
+        """Returns the account ID of a raw API key."""
+
+        return blake2b(key.encode(), digest_size=8).hexdigest()
+
+    def get_default_limits(self):
+        # Config is loaded after import, so read it on first use
+        if self.default_limits is None:
+            self.default_limits = {
+                "requests_per_second": config.network.key_requests_per_second,
+                "concurrent_jobs": config.network.key_concurrent_jobs,
+                "tokens_per_minute": config.network.key_tokens_per_minute,
+                "weight": 1.0,
+                "timeout": config.network.key_timeout,
+            }
+
+        return self.default_limits
+
+    def get_account(self, request: Request):
+        """Gets or creates the account of a request's API key."""
+
+        # Arbitrary keys are accepted without auth, so group by host instead
+        key = None if auth.DISABLE_AUTH else auth.get_request_key(request)
+        if key:
+            key_id = self.get_key_id(key)
+        else:
+            key_id = f"host:{request.client.host if request.client else 'unknown'}"
+
+        account = self.accounts.get(key_id)
+        if account is None:
+            permission = auth.get_key_permission(request)
+            account = KeyAccount(key_id, permission, self.get_default_limits())
+            self.accounts[key_id] = account
+        elif account.permission == "unknown":
+            # Limits were set through the admin endpoint before first use
+            account.permission = auth.get_key_permission(request)
+
+        return account
+
+    def update_limits(self, key_id: Optional[str] = None, **limits):
+        """
+        Updates the limits of a key, or the defaults if no key is given.
+
+        Keys without custom limits follow the defaults.
+        """
+
+        if key_id is None:
+            self.default_limits = {**self.get_default_limits(), **limits}
+
+            for account in self.accounts.values():
+                if not account.custom_limits:
+                    account.set_limits(**self.default_limits)
+
+            return self.default_limits
+
+        account = self.accounts.get(key_id)
+        if account is None:
+            account = KeyAccount(key_id, "unknown", self.get_default_limits())
+            self.accounts[key_id] = account
+
+        account.set_limits(**{**account.get_limits(), **limits})
+        account.custom_limits = True
+
+        return account.get_limits()
+
+    def stats(self):
+        return {
+            "defaults": self.get_default_limits(),
+            "keys": {
+                key_id: account.stats() for key_id, account in self.accounts.items()
+            },
+        }
+
+
+# Global rate limiter
+rate_limiter = RateLimiter()
@@ -5,7 +5,6 @@ import json
 import pathlib
 from pydantic_core import ValidationError
 from ruamel.yaml import YAML
-from copy import deepcopy
 from loguru import logger
 from pydantic import (
     AliasChoices,
@@ -14,7 +13,8 @@ from pydantic import (
     field_validator,
     model_validator,
 )
-from typing import Dict, List, Optional, Union
+from types import MappingProxyType
+from typing import Any, Dict, List, Literal, Optional, Union
 
 from common.utils import filter_none_values, unwrap
 
@@ -75,6 +75,30 @@ class BaseSamplerRequest(BaseModel):
         default_factory=lambda: get_default_sampler_value("token_healing", False)
     )
 
+    priority: Optional[Literal["interactive", "batch"]] = Field(
+        default_factory=lambda: get_default_sampler_value("priority"),
+        description=(
+            "Scheduling priority class. Queued interactive requests start "
+            "before batch requests."
+        ),
+    )
+
+    timeout: Optional[float] = Field(
+        default_factory=lambda: get_default_sampler_value("timeout"),
+        description=(
+            "Seconds until the request is stopped. "
+            'Partial output is returned with finish_reason "timeout".'
+        ),
+        examples=[60.0],
+        gt=0,
+    )
+
+    deadline: Optional[float] = Field(
+        default_factory=lambda: get_default_sampler_value("deadline"),
+        description="Unix timestamp when the request is stopped.",
+        examples=[1735689600.0],
+    )
+
     temperature: Optional[float] = Field(
         default_factory=lambda: get_default_sampler_value("temperature", 1.0),
         examples=[1.0],
@@ -252,6 +276,14 @@ class BaseSamplerRequest(BaseModel):
         default_factory=lambda: get_default_sampler_value("speculative_ngram"),
     )
 
+    jump_forward: Optional[bool] = Field(
+        default_factory=lambda: get_default_sampler_value("jump_forward", False),
+        description=(
+            "Appends tokens that a JSON schema, regex or grammar allows as the "
+            "only continuation in one step instead of sampling them one by one."
+        ),
+    )
+
     cfg_scale: Optional[float] = Field(
         default_factory=lambda: get_default_sampler_value("cfg_scale", 1.0),
         validation_alias=AliasChoices("cfg_scale", "guidance_scale"),
@@ -350,20 +382,128 @@ class BaseSamplerRequest(BaseModel):
         return self
 
 
+class GenerationParams:
+    """
+    Read-only generation parameters of a request.
+
+    Built once per request from the sampler fields of the request model and
+    passed to the backend by reference. Unlike model_dump, nothing else in
+    the request (messages, tools, template vars) is serialized, and values
+    are shared with the request instead of copied, so never mutate them.
+    """
+
+    # Sampler fields and the generation fields of API requests
+    __slots__ = (*BaseSamplerRequest.model_fields, "n", "best_of", "logprobs", "stream")
+
+    def __init__(self, **params):
+        for key in self.__slots__:
+            object.__setattr__(self, key, params.get(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Generation params are read-only")
+
+    def __repr__(self):
+        params = ", ".join(
+            f"{key}={getattr(self, key)!r}"
+            for key in self.__slots__
+            if getattr(self, key) is not None
+        )
+
+        return f"GenerationParams({params})"
+
+    @classmethod
+    def from_request(cls, data: BaseModel, **overrides):
+        """Creates params from the fields of a request model."""
+
+        params = cls.__new__(cls)
+        for key in cls.__slots__:
+            value = overrides[key] if key in overrides else getattr(data, key, None)
+            object.__setattr__(params, key, value)
+
+        return params
+
+    def replace(self, **changes):
+        """Returns a copy with some params changed."""
+
+        return self.from_request(self, **changes)
+
+
 class SamplerOverridesContainer(BaseModel):
     selected_preset: Optional[str] = None
     overrides: dict = {}
 
 
+def _freeze_override(value):
+    """Converts an override value into an immutable one."""
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_override(item) for item in value)
+    elif isinstance(value, dict):
+        return MappingProxyType(
+            {key: _freeze_override(item) for key, item in value.items()}
+        )
+    else:
+        return value
+
+
+def _thaw_override(value):
+    """Returns a mutable copy of a frozen override value."""
+
+    if isinstance(value, tuple):
+        return [_thaw_override(item) for item in value]
+    elif isinstance(value, MappingProxyType):
+        return {key: _thaw_override(item) for key, item in value.items()}
+    else:
+        return value
+
+
+class SamplerDefaults:
+    """
+    Sampler overrides compiled when a preset is loaded.
+
+    Override values are frozen, so scalars are shared between requests as is
+    and only list or dict values are copied. Forced and additive overrides
+    are split out, so request validation only visits the keys they apply to.
+    """
+
+    __slots__ = ("defaults", "forced", "additive")
+
+    def __init__(self, overrides: dict):
+        self.defaults: Dict[str, Any] = {}
+        self.forced: Dict[str, Any] = {}
+        self.additive: Dict[str, tuple] = {}
+
+        for key, value in overrides.items():
+            override = value.get("override")
+            if override is None:
+                continue
+
+            frozen_override = _freeze_override(override)
+            self.defaults[key] = frozen_override
+
+            # Force takes precedence over additive
+            # Additive only works on lists and doesn't remove duplicates
+            if not override:
+                continue
+            elif unwrap(value.get("force"), False):
+                self.forced[key] = frozen_override
+            elif unwrap(value.get("additive"), False) and isinstance(override, list):
+                self.additive[key] = frozen_override
+
+
 # Global for default overrides
 overrides_container = SamplerOverridesContainer()
+sampler_defaults = SamplerDefaults({})
 
 
 def overrides_from_dict(new_overrides: dict):
     """Wrapper function to update sampler overrides"""
 
+    global sampler_defaults
+
     if isinstance(new_overrides, dict):
         overrides_container.overrides = filter_none_values(new_overrides)
+        sampler_defaults = SamplerDefaults(overrides_container.overrides)
     else:
         raise TypeError("New sampler overrides must be a dict!")
 
@@ -406,29 +546,20 @@ def get_all_presets():
 def get_default_sampler_value(key, fallback=None):
     """Gets an overridden default sampler value"""
 
-    default_value = unwrap(
-        deepcopy(overrides_container.overrides.get(key, {}).get("override")),
-        fallback,
-    )
+    default_value = sampler_defaults.defaults.get(key)
+    if default_value is None:
+        return fallback
 
-    return default_value
+    return _thaw_override(default_value)
 
 
 def apply_forced_sampler_overrides(params: BaseSamplerRequest):
     """Forcefully applies overrides if specified by the user"""
 
-    for var, value in overrides_container.overrides.items():
-        override = deepcopy(value.get("override"))
-        original_value = getattr(params, var, None)
+    for var, override in sampler_defaults.forced.items():
+        setattr(params, var, _thaw_override(override))
 
-        # Force takes precedence over additive
-        # Additive only works on lists and doesn't remove duplicates
-        if override:
-            if unwrap(value.get("force"), False):
-                setattr(params, var, override)
-            elif (
-                unwrap(value.get("additive"), False)
-                and isinstance(override, list)
-                and isinstance(original_value, list)
-            ):
-                setattr(params, var, override + original_value)
+    for var, override in sampler_defaults.additive.items():
+        original_value = getattr(params, var, None)
+        if isinstance(original_value, list):
+            setattr(params, var, _thaw_override(override) + original_value)
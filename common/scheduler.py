@@ -0,0 +1,523 @@
+"""Admission control and priority scheduling for generation requests."""
+
+import asyncio
+import math
+import time
+from collections import deque
+from fastapi import HTTPException, Request
+from typing import Deque, Dict, Optional
+
+from common.networking import handle_request_error
+from common.rate_limit import KeyAccount, RateLimitExceeded, rate_limiter
+from common.sampling import BaseSamplerRequest
+from common.tabby_config import config
+from common.utils import unwrap
+
+# Queues are drained in this order
+PRIORITY_CLASSES = ("interactive", "batch")
+
+# Rough prompt size estimate, tokenization happens after admission
+CHARS_PER_TOKEN = 4
+
+
+class SchedulerRejection(Exception):
+    """Raised when a request can't be queued."""
+
+    def __init__(self, status_code: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class SchedulerTicket:
+    """A request waiting for, or holding, generator job slots."""
+
+    __slots__ = (
+        "request_id",
+        "priority",
+        "budget",
+        "jobs",
+        "account",
+        "deadline",
+        "future",
+        "admitted",
+        "enqueue_time",
+        "queue_time",
+        "prompt_tokens",
+        "generated_tokens",
+    )
+
+    def __init__(
+        self,
+        request_id: str,
+        priority: str,
+        budget: int,
+        jobs: int = 1,
+        account: Optional[KeyAccount] = None,
+        deadline: Optional[float] = None,
+    ):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Invalid request priority: {priority}")
+
+        self.request_id = request_id
+        self.priority = priority
+        self.budget = budget
+        self.jobs = jobs
+        self.account = account
+
+        # Unix timestamp
+        self.deadline = deadline
+        self.future: Optional[asyncio.Future] = None
+        self.admitted = False
+        self.enqueue_time = 0.0
+        self.queue_time = 0.0
+        self.prompt_tokens: Optional[int] = None
+        self.generated_tokens = 0
+
+    def record_usage(self, generation: dict):
+        """Adds the token counts of a finished choice."""
+
+        # Choices share the prompt
+        self.prompt_tokens = max(
+            unwrap(self.prompt_tokens, 0), unwrap(generation.get("prompt_tokens"), 0)
+        )
+        self.generated_tokens += unwrap(generation.get("generated_tokens"), 0)
+
+
+class RequestScheduler:
+    """
+    Admits generation requests to the model in priority order.
+
+    Each priority class has a bounded FIFO queue, and queued interactive
+    requests are always admitted before batch requests. Requests are
+    rejected up front when their queue is full or their estimated wait is
+    too long, so a burst turns into fast 429/503 responses instead of an
+    unbounded time to first token.
+
+    Within a class, requests are ordered by start-time fair queuing: the
+    next one comes from the API key that received the fewest job slots
+    relative to its weight, and keys at their concurrent job limit are
+    skipped.
+
+    Waits are estimated from token budgets (prompt + max_tokens) and the
+    budget throughput of finished requests. Both use the same units, so
+    requests that stop well before max_tokens are accounted for. Requests
+    that can't start before their deadline are rejected, up front or when
+    the deadline passes in the queue.
+    """
+
+    def __init__(
+        self,
+        max_active_jobs: Optional[int] = None,
+        max_queued: Optional[int] = 64,
+        max_queue_wait: Optional[float] = None,
+    ):
+        self.max_active_jobs = max_active_jobs
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+
+        self.queues: Dict[str, Deque[SchedulerTicket]] = {
+            priority: deque() for priority in PRIORITY_CLASSES
+        }
+        self.queued_budget: Dict[str, int] = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.active_jobs = 0
+        self.active_budget = 0
+
+        # Start tag of the last admitted request for fair queuing
+        self.virtual_time = 0.0
+
+        # Throughput is measured over time with at least one active job
+        self.busy_time = 0.0
+        self.last_update = time.perf_counter()
+        self.finished_budget = 0
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_wait = 0
+        self.rejected_deadline = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def _update_busy_time(self):
+        now = time.perf_counter()
+        if self.active_jobs > 0:
+            self.busy_time += now - self.last_update
+
+        self.last_update = now
+
+    def throughput(self) -> Optional[float]:
+        """Returns finished budget tokens per busy second, if measured."""
+
+        if self.finished_budget == 0 or self.busy_time <= 0:
+            return None
+
+        return self.finished_budget / self.busy_time
+
+    def _can_admit_ticket(self, ticket: SchedulerTicket):
+        return self._can_admit(ticket.jobs) and (
+            ticket.account is None or ticket.account.can_start(ticket.jobs)
+        )
+
+    def _can_admit(self, jobs: int):
+        # An idle generator always takes a request, even if it's oversized
+        return (
+            self.max_active_jobs is None
+            or self.active_jobs == 0
+            or self.active_jobs + jobs <= self.max_active_jobs
+        )
+
+    def _has_waiters(self, priority: str):
+        """Checks for queued requests that would be admitted first."""
+
+        for queue_priority in PRIORITY_CLASSES:
+            if self.queues[queue_priority]:
+                return True
+
+            if queue_priority == priority:
+                return False
+
+        return False
+
+    def estimate_wait(self, priority: str, jobs: int = 1) -> Optional[float]:
+        """
+        Estimates the seconds a new request would wait before starting.
+
+        Returns None if there's no throughput measurement yet.
+        """
+
+        if self._can_admit(jobs) and not self._has_waiters(priority):
+            return 0.0
+
+        throughput = self.throughput()
+        if throughput is None:
+            return None
+
+        budget_ahead = self.active_budget
+        for queue_priority in PRIORITY_CLASSES:
+            budget_ahead += self.queued_budget[queue_priority]
+
+            if queue_priority == priority:
+                break
+
+        return budget_ahead / throughput
+
+    def check(self, ticket: SchedulerTicket):
+        """Raises a SchedulerRejection if a ticket can't be queued."""
+
+        if ticket.deadline is not None and ticket.deadline <= time.time():
+            self.rejected_deadline += 1
+
+            raise SchedulerRejection(504, "The request deadline has passed.", 1)
+
+        if self._can_admit_ticket(ticket) and not self._has_waiters(ticket.priority):
+            return
+
+        estimated_wait = self.estimate_wait(ticket.priority, ticket.jobs)
+        retry_after = max(math.ceil(unwrap(estimated_wait, 1.0)), 1)
+
+        if self.max_queued and len(self.queues[ticket.priority]) >= self.max_queued:
+            self.rejected_full += 1
+
+            raise SchedulerRejection(
+                429,
+                f"Too many queued {ticket.priority} requests. Please try again later.",
+                retry_after,
+            )
+
+        if (
+            self.max_queue_wait
+            and estimated_wait is not None
+            and estimated_wait > self.max_queue_wait
+        ):
+            self.rejected_wait += 1
+
+            raise SchedulerRejection(
+                503,
+                f"Server is overloaded (estimated wait of {estimated_wait:.1f}s). "
+                "Please try again later.",
+                retry_after,
+            )
+
+        if (
+            ticket.deadline is not None
+            and estimated_wait is not None
+            and time.time() + estimated_wait > ticket.deadline
+        ):
+            self.rejected_deadline += 1
+
+            raise SchedulerRejection(
+                503,
+                f"The request can't start before its deadline "
+                f"(estimated wait of {estimated_wait:.1f}s).",
+                retry_after,
+            )
+
+    def _admit(self, ticket: SchedulerTicket):
+        self._update_busy_time()
+
+        self.active_jobs += ticket.jobs
+        self.active_budget += ticket.budget
+        self.admitted += 1
+        ticket.admitted = True
+
+        account = ticket.account
+        if account:
+            account.active_jobs += ticket.jobs
+
+            start_tag = max(account.virtual_time, self.virtual_time)
+            account.virtual_time = start_tag + ticket.jobs / account.weight
+            self.virtual_time = start_tag
+
+        self.queue_time_total += ticket.queue_time
+        self.queue_time_max = max(self.queue_time_max, ticket.queue_time)
+
+    def _next_ticket(self, queue: Deque[SchedulerTicket]):
+        """Picks the oldest ticket with the smallest fair queuing start tag."""
+
+        next_ticket = None
+        next_start_tag = None
+        for ticket in queue:
+            account = ticket.account
+            if account is None:
+                start_tag = self.virtual_time
+            elif account.can_start(ticket.jobs):
+                start_tag = max(account.virtual_time, self.virtual_time)
+            else:
+                continue
+
+            if next_start_tag is None or start_tag < next_start_tag:
+                next_ticket = ticket
+                next_start_tag = start_tag
+
+        return next_ticket
+
+    def _wake(self):
+        # Classes are admitted strictly in priority order
+        for priority in PRIORITY_CLASSES:
+            queue = self.queues[priority]
+
+            for ticket in [ticket for ticket in queue if ticket.future.cancelled()]:
+                queue.remove(ticket)
+                self.queued_budget[priority] -= ticket.budget
+
+            while queue:
+                ticket = self._next_ticket(queue)
+
+                # Every waiting key is at its concurrent job limit
+                if ticket is None:
+                    break
+
+                if not self._can_admit(ticket.jobs):
+                    return
+
+                queue.remove(ticket)
+                self.queued_budget[priority] -= ticket.budget
+                ticket.queue_time = time.perf_counter() - ticket.enqueue_time
+                self._admit(ticket)
+                ticket.future.set_result(None)
+
+    async def acquire(self, ticket: SchedulerTicket):
+        """Waits until a ticket is admitted to the generator."""
+
+        self.check(ticket)
+
+        if self._can_admit_ticket(ticket) and not self._has_waiters(ticket.priority):
+            self._admit(ticket)
+            return
+
+        ticket.enqueue_time = time.perf_counter()
+        ticket.future = asyncio.get_running_loop().create_future()
+        self.queues[ticket.priority].append(ticket)
+        self.queued_budget[ticket.priority] += ticket.budget
+
+        # Waiters ahead may be held back by their key's job limit
+        self._wake()
+
+        try:
+            if ticket.deadline is None:
+                await ticket.future
+            else:
+                await asyncio.wait_for(ticket.future, ticket.deadline - time.time())
+        except (asyncio.CancelledError, asyncio.TimeoutError) as exc:
+            if ticket.admitted:
+                # Admitted right before the cancel landed
+                self.release(ticket)
+            elif ticket in self.queues[ticket.priority]:
+                self.queues[ticket.priority].remove(ticket)
+                self.queued_budget[ticket.priority] -= ticket.budget
+                self._wake()
+
+            if isinstance(exc, asyncio.TimeoutError):
+                self.rejected_deadline += 1
+
+                raise SchedulerRejection(
+                    504, "The request deadline passed while it was queued.", 1
+                ) from exc
+
+            raise
+
+    def release(self, ticket: SchedulerTicket):
+        """Frees the slots of an admitted ticket and admits queued requests."""
+
+        if not ticket.admitted:
+            return
+
+        self._update_busy_time()
+
+        ticket.admitted = False
+        self.active_jobs -= ticket.jobs
+        self.active_budget -= ticket.budget
+        self.finished_budget += ticket.budget
+
+        if ticket.account:
+            ticket.account.active_jobs -= ticket.jobs
+
+            # Charge the full budget if the request never reported usage
+            if ticket.prompt_tokens is None:
+                ticket.account.record_usage(ticket.budget, 0)
+            else:
+                ticket.account.record_usage(
+                    ticket.prompt_tokens, ticket.generated_tokens
+                )
+
+        self._wake()
+
+    def stats(self) -> dict:
+        """Returns queue depths, counters and throughput."""
+
+        throughput = self.throughput()
+        admitted = self.admitted
+
+        return {
+            "active_jobs": self.active_jobs,
+            **{
+                f"queued_{priority}": len(queue)
+                for priority, queue in self.queues.items()
+            },
+            "admitted": admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_wait": self.rejected_wait,
+            "rejected_deadline": self.rejected_deadline,
+            "queue_time_avg": (
+                round(self.queue_time_total / admitted, 6) if admitted else 0.0
+            ),
+            "queue_time_max": round(self.queue_time_max, 6),
+            "budget_per_second": round(throughput, 2) if throughput else 0.0,
+        }
+
+
+def get_deadline(
+    timeout: Optional[float],
+    deadline: Optional[float],
+    account: Optional[KeyAccount] = None,
+):
+    """
+    Resolves the deadline of a request as a unix timestamp.
+
+    The earliest of the deadline and the timeout is used. Requests without
+    a timeout fall back to the default timeout of their API key.
+    """
+
+    if account:
+        timeout = unwrap(timeout, account.timeout)
+
+    if timeout:
+        timeout_deadline = time.time() + timeout
+        deadline = min(deadline, timeout_deadline) if deadline else timeout_deadline
+
+    return deadline
+
+
+def create_ticket(
+    request: Request,
+    data: BaseSamplerRequest,
+    prompt: str,
+    max_seq_len: int,
+    jobs: int = 1,
+):
+    """
+    Creates the scheduler ticket of a generation request.
+
+    The token budget uses an estimate of the prompt length. The request's
+    deadline is resolved and written back to its params, so the model
+    container stops generation at the same time.
+    """
+
+    account = rate_limiter.get_account(request)
+    prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+
+    # Generation fills up the context if max_tokens isn't provided
+    max_tokens = data.max_tokens
+    if not max_tokens:
+        max_tokens = max(max_seq_len - prompt_tokens, 1)
+
+    data.deadline = get_deadline(data.timeout, data.deadline, account)
+
+    return SchedulerTicket(
+        request.state.id,
+        unwrap(data.priority, config.network.default_priority),
+        prompt_tokens + max_tokens * jobs,
+        jobs,
+        account,
+        data.deadline,
+    )
+
+
+def configure_scheduler(max_batch_size: Optional[int] = None):
+    """Applies the config limits, called when a model is loaded."""
+
+    scheduler.max_active_jobs = unwrap(config.network.max_active_jobs, max_batch_size)
+    scheduler.max_queued = config.network.max_queued_requests
+    scheduler.max_queue_wait = config.network.max_queue_wait
+
+
+def get_rejection_error(
+    ticket: SchedulerTicket, exc: SchedulerRejection | RateLimitExceeded
+):
+    """Creates an HTTP error with a Retry-After header for a rejection."""
+
+    status_code = exc.status_code if isinstance(exc, SchedulerRejection) else 429
+    error_message = handle_request_error(
+        f"Request {ticket.request_id} rejected: {exc.message}",
+        exc_info=False,
+    ).error.message
+
+    return HTTPException(
+        status_code,
+        error_message,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def get_rejection_generator_error(
+    ticket: SchedulerTicket, exc: SchedulerRejection | RateLimitExceeded
+):
+    """Same as get_rejection_error, as an error event for a started stream."""
+
+    request_error = handle_request_error(
+        f"Request {ticket.request_id} rejected: {exc.message}",
+        exc_info=False,
+    )
+    request_error.error.code = (
+        exc.status_code if isinstance(exc, SchedulerRejection) else 429
+    )
+
+    return request_error.model_dump_json()
+
+
+def check_admission(ticket: SchedulerTicket):
+    """Rejects a request with 429, 503 or 504 if it can't be queued."""
+
+    try:
+        # Requests the scheduler rejects don't use the key's rate budget
+        scheduler.check(ticket)
+
+        if ticket.account:
+            ticket.account.check()
+    except (SchedulerRejection, RateLimitExceeded) as exc:
+        raise get_rejection_error(ticket, exc) from exc
+
+
+# Global request scheduler, limits are set from the config
+scheduler = RequestScheduler()
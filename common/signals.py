@@ -5,6 +5,7 @@ from loguru import logger
 from types import FrameType
 
 from common import model
+from common.images import image_fetcher
 
 
 SHUTTING_DOWN: bool = False
@@ -43,6 +44,8 @@ async def signal_handler_async():
     if model.embeddings_container:
         await model.unload_embedding_model()
 
+    await image_fetcher.close()
+
 
 def uvicorn_signal_handler(signal_event: signal.Signals):
     """Overrides uvicorn's signal handler."""
@@ -13,6 +13,7 @@ from packaging import version
 from datetime import datetime
 
 
+from common.concurrency import cpu_pool
 from common.utils import unwrap
 
 
@@ -80,8 +81,13 @@ class PromptTemplate:
         self.metadata = template_metadata
         return template_metadata
 
-    async def render(self, template_vars: dict):
-        """Get a prompt from a template and a list of messages."""
+    async def render(self, template_vars: dict, size: int = 0):
+        """
+        Get a prompt from a template and a list of messages.
+
+        Size is the approximate length of the messages. Large inputs are
+        rendered on the CPU worker pool.
+        """
         if version.parse(package_version("jinja2")) < version.parse("3.0.0"):
             raise ImportError(
                 "Parsing these chat completion messages requires jinja2 3.0.0 "
@@ -90,7 +96,13 @@ class PromptTemplate:
                 "pip install --upgrade jinja2"
             )
 
-        rendered_template = await self.template.render_async(**template_vars)
+        # Synchronous render runs the async template on the worker's own loop
+        if cpu_pool.should_offload(size):
+            rendered_template = await cpu_pool.run(
+                self.template.render, **template_vars
+            )
+        else:
+            rendered_template = await self.template.render_async(**template_vars)
 
         return rendered_template
 
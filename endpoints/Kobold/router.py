@@ -4,7 +4,9 @@ from sse_starlette import EventSourceResponse
 
 from common import model
 from common.auth import check_api_key
+from common.concurrency import cpu_pool
 from common.model import check_model_container
+from common.scheduler import check_admission, create_ticket
 from common.utils import unwrap
 from endpoints.core.utils.model import get_current_model
 from endpoints.Kobold.types.generation import (
@@ -48,7 +50,15 @@ def setup():
     dependencies=[Depends(check_api_key), Depends(check_model_container)],
 )
 async def generate(request: Request, data: GenerateRequest) -> GenerateResponse:
-    response = await get_generation(data, request)
+    ticket = create_ticket(
+        request,
+        data,
+        data.prompt,
+        model.container.config.max_seq_len,
+    )
+    check_admission(ticket)
+
+    response = await get_generation(data, request, ticket)
 
     return response
 
@@ -58,7 +68,17 @@ async def generate(request: Request, data: GenerateRequest) -> GenerateResponse:
     dependencies=[Depends(check_api_key), Depends(check_model_container)],
 )
 async def generate_stream(request: Request, data: GenerateRequest) -> GenerateResponse:
-    response = EventSourceResponse(stream_generation(data, request), ping=maxsize)
+    ticket = create_ticket(
+        request,
+        data,
+        data.prompt,
+        model.container.config.max_seq_len,
+    )
+    check_admission(ticket)
+
+    response = EventSourceResponse(
+        stream_generation(data, request, ticket), ping=maxsize
+    )
 
     return response
 
@@ -102,7 +122,9 @@ async def current_model() -> CurrentModelResponse:
     dependencies=[Depends(check_api_key), Depends(check_model_container)],
 )
 async def get_tokencount(data: TokenCountRequest) -> TokenCountResponse:
-    raw_tokens = model.container.encode_tokens(data.prompt)
+    raw_tokens = await cpu_pool.run(
+        model.container.encode_tokens, data.prompt, size=len(data.prompt)
+    )
     tokens = unwrap(raw_tokens, [])
     return TokenCountResponse(value=len(tokens), ids=tokens)
 
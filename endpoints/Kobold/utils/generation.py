@@ -5,11 +5,20 @@ from loguru import logger
 from sse_starlette.event import ServerSentEvent
 
 from common import model
+from common.accumulator import ResponseAccumulator
 from common.networking import (
     get_generator_error,
+    get_request_disconnect,
     handle_request_disconnect,
     handle_request_error,
-    request_disconnect_loop,
+)
+from common.sampling import GenerationParams
+from common.scheduler import (
+    SchedulerRejection,
+    SchedulerTicket,
+    get_rejection_error,
+    get_rejection_generator_error,
+    scheduler,
 )
 from common.utils import unwrap
 from endpoints.Kobold.types.generation import (
@@ -40,24 +49,32 @@ def _create_stream_chunk(text: str):
     return StreamGenerateChunk(token=text)
 
 
-async def _stream_collector(data: GenerateRequest, request: Request):
+async def _stream_collector(
+    data: GenerateRequest, request: Request, ticket: SchedulerTicket
+):
     """Common async generator for generation streams."""
 
     abort_event = asyncio.Event()
-    disconnect_task = asyncio.create_task(request_disconnect_loop(request))
+    disconnect = get_request_disconnect(request)
+    disconnect.watch(abort_event)
 
     # Create a new entry in the cache
-    generation_cache[data.genkey] = {"abort": abort_event, "text": ""}
+    response = ResponseAccumulator()
+    generation_cache[data.genkey] = {"abort": abort_event, "response": response}
 
     try:
         logger.info(f"Received Kobold generation request {data.genkey}")
 
+        await scheduler.acquire(ticket)
+
         generator = model.container.generate_gen(
-            request_id=data.genkey, abort_event=abort_event, **data.model_dump()
+            data.prompt,
+            data.genkey,
+            GenerationParams.from_request(data),
+            abort_event,
         )
         async for generation in generator:
-            if disconnect_task.done():
-                abort_event.set()
+            if disconnect.is_set():
                 handle_request_disconnect(
                     f"Kobold generation {data.genkey} cancelled by user."
                 )
@@ -66,25 +83,27 @@ async def _stream_collector(data: GenerateRequest, request: Request):
 
             # Update the generation cache with the new chunk
             if text:
-                generation_cache[data.genkey]["text"] += text
+                response.append(text)
                 yield text
 
             if "finish_reason" in generation:
+                ticket.record_usage(generation)
                 logger.info(f"Finished streaming Kobold request {data.genkey}")
                 break
     except CancelledError:
         # If the request disconnects, break out
-        if not disconnect_task.done():
-            abort_event.set()
-            handle_request_disconnect(
-                f"Kobold generation {data.genkey} cancelled by user."
-            )
+        abort_event.set()
+        handle_request_disconnect(f"Kobold generation {data.genkey} cancelled by user.")
     finally:
+        scheduler.release(ticket)
+
         # Cleanup the cache
         del generation_cache[data.genkey]
 
 
-async def stream_generation(data: GenerateRequest, request: Request):
+async def stream_generation(
+    data: GenerateRequest, request: Request, ticket: SchedulerTicket
+):
     """Wrapper for stream generations."""
 
     # If the genkey doesn't exist, set it to the request ID
@@ -92,11 +111,14 @@ async def stream_generation(data: GenerateRequest, request: Request):
         data.genkey = request.state.id
 
     try:
-        async for chunk in _stream_collector(data, request):
+        async for chunk in _stream_collector(data, request, ticket):
             response = _create_stream_chunk(chunk)
             yield ServerSentEvent(
                 event="message", data=response.model_dump_json(), sep="\n"
             )
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        yield get_rejection_generator_error(ticket, exc)
     except Exception:
         yield get_generator_error(
             f"Kobold generation {data.genkey} aborted. "
@@ -104,7 +126,9 @@ async def stream_generation(data: GenerateRequest, request: Request):
         )
 
 
-async def get_generation(data: GenerateRequest, request: Request):
+async def get_generation(
+    data: GenerateRequest, request: Request, ticket: SchedulerTicket
+):
     """Wrapper to get a static generation."""
 
     # If the genkey doesn't exist, set it to the request ID
@@ -112,12 +136,15 @@ async def get_generation(data: GenerateRequest, request: Request):
         data.genkey = request.state.id
 
     try:
-        full_text = ""
-        async for chunk in _stream_collector(data, request):
-            full_text += chunk
+        full_response = ResponseAccumulator()
+        async for chunk in _stream_collector(data, request, ticket):
+            full_response.append(chunk)
 
-        response = _create_response(full_text)
+        response = _create_response(full_response.text)
         return response
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        raise get_rejection_error(ticket, exc) from exc
     except Exception as exc:
         error_message = handle_request_error(
             f"Completion {request.state.id} aborted. Maybe the model was unloaded? "
@@ -142,9 +169,9 @@ async def abort_generation(genkey: str):
 async def generation_status(genkey: str):
     """Fetches the status of a generation from the cache."""
 
-    current_text = unwrap(generation_cache.get(genkey), {}).get("text")
-    if current_text:
-        response = _create_response(current_text)
+    current_response = unwrap(generation_cache.get(genkey), {}).get("response")
+    if current_response and current_response.length:
+        response = _create_response(current_response.text)
     else:
         response = GenerateResponse()
 
@@ -7,6 +7,7 @@ from common import model
 from common.auth import check_api_key
 from common.model import check_embeddings_container, check_model_container
 from common.networking import handle_request_error, run_with_request_disconnect
+from common.scheduler import check_admission, create_ticket
 from common.tabby_config import config
 from endpoints.OAI.types.completion import CompletionRequest, CompletionResponse
 from endpoints.OAI.types.chat_completion import (
@@ -70,6 +71,16 @@ async def completion_request(
     if isinstance(data.prompt, list):
         data.prompt = "\n".join(data.prompt)
 
+    # Reject early if the request can't be queued
+    ticket = create_ticket(
+        request,
+        data,
+        data.prompt,
+        model.container.config.max_seq_len,
+        jobs=max(data.best_of or data.n, data.n),
+    )
+    check_admission(ticket)
+
     disable_request_streaming = config.developer.disable_request_streaming
 
     # Set an empty JSON schema if the request wants a JSON response
@@ -78,12 +89,12 @@ async def completion_request(
 
     if data.stream and not disable_request_streaming:
         return EventSourceResponse(
-            stream_generate_completion(data, request, model_path),
+            stream_generate_completion(data, request, model_path, ticket),
             ping=maxsize,
         )
     else:
         generate_task = asyncio.create_task(
-            generate_completion(data, request, model_path)
+            generate_completion(data, request, model_path, ticket)
         )
 
         response = await run_with_request_disconnect(
@@ -125,6 +136,16 @@ async def chat_completion_request(
 
     prompt, embeddings = await apply_chat_template(data)
 
+    # Reject early if the request can't be queued
+    ticket = create_ticket(
+        request,
+        data,
+        prompt,
+        model.container.config.max_seq_len,
+        jobs=max(data.best_of or data.n, data.n),
+    )
+    check_admission(ticket)
+
     # Set an empty JSON schema if the request wants a JSON response
     if data.response_format.type == "json":
         data.json_schema = {"type": "object"}
@@ -134,13 +155,15 @@ async def chat_completion_request(
     if data.stream and not disable_request_streaming:
         return EventSourceResponse(
             stream_generate_chat_completion(
-                prompt, embeddings, data, request, model_path
+                prompt, embeddings, data, request, model_path, ticket
             ),
             ping=maxsize,
         )
     else:
         generate_task = asyncio.create_task(
-            generate_chat_completion(prompt, embeddings, data, request, model_path)
+            generate_chat_completion(
+                prompt, embeddings, data, request, model_path, ticket
+            )
         )
 
         response = await run_with_request_disconnect(
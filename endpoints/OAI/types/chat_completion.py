@@ -4,8 +4,17 @@ from time import time
 from typing import Literal, Union, List, Optional, Dict
 from uuid import uuid4
 
-from endpoints.OAI.types.common import UsageStats, CommonCompletionRequest
-from endpoints.OAI.types.tools import ToolSpec, ToolCall, tool_call_schema
+from endpoints.OAI.types.common import (
+    CommonCompletionRequest,
+    ImagePreprocessOptions,
+    UsageStats,
+)
+from endpoints.OAI.types.tools import (
+    ToolSpec,
+    ToolCall,
+    ToolCallDelta,
+    tool_call_schema,
+)
 
 
 class ChatCompletionLogprob(BaseModel):
@@ -35,6 +44,11 @@ class ChatCompletionMessage(BaseModel):
     tool_calls_json: SkipJsonSchema[Optional[str]] = None
 
 
+class ChatCompletionToolCallsDelta(BaseModel):
+    role: str = "assistant"
+    tool_calls: List[ToolCallDelta]
+
+
 class ChatCompletionRespChoice(BaseModel):
     # Index is 0 since we aren't using multiple choices
     index: int = 0
@@ -50,12 +64,12 @@ class ChatCompletionStreamChoice(BaseModel):
     # Index is 0 since we aren't using multiple choices
     index: int = 0
     finish_reason: Optional[str] = None
-    delta: Union[ChatCompletionMessage, dict] = {}
+    delta: Union[ChatCompletionMessage, ChatCompletionToolCallsDelta, dict] = {}
     logprobs: Optional[ChatCompletionLogprobs] = None
 
 
 # Inherited from common request
-class ChatCompletionRequest(CommonCompletionRequest):
+class ChatCompletionRequest(CommonCompletionRequest, ImagePreprocessOptions):
     # Messages
     # Take in a string as well even though it's not part of the OAI spec
     # support messages.content as a list of dict
@@ -1,8 +1,11 @@
 """Common types for OAI."""
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import Optional
 
+from common.config_models import IMAGE_RESAMPLE_FILTERS
+from common.images import ImagePreprocessPolicy
+from common.utils import unwrap
 from common.sampling import BaseSamplerRequest, get_default_sampler_value
 
 
@@ -20,6 +23,41 @@ class CompletionResponseFormat(BaseModel):
 
 class ChatCompletionStreamOptions(BaseModel):
     include_usage: Optional[bool] = False
+    coalesce: Optional[bool] = Field(
+        default=True,
+        description=(
+            "Merge tokens into fewer events while the client is behind. "
+            "Set to false to always get one event per chunk."
+        ),
+    )
+
+
+class ImagePreprocessOptions(BaseModel):
+    """Image downscaling limits of a request, lower than the model's limits."""
+
+    image_max_pixels: Optional[int] = Field(
+        default=None,
+        description="Images with more pixels are downscaled before embedding.",
+        gt=0,
+    )
+    image_max_side: Optional[int] = Field(
+        default=None,
+        description="Images with a longer side are downscaled before embedding.",
+        gt=0,
+    )
+    image_resample: Optional[IMAGE_RESAMPLE_FILTERS] = Field(
+        default=None,
+        description="Resampling filter used to downscale images.",
+    )
+
+    def get_image_policy(
+        self, policy: Optional[ImagePreprocessPolicy]
+    ) -> ImagePreprocessPolicy:
+        """Applies the request's limits to a model's image policy."""
+
+        return unwrap(policy, ImagePreprocessPolicy()).restrict(
+            self.image_max_pixels, self.image_max_side, self.image_resample
+        )
 
 
 class CommonCompletionRequest(BaseSamplerRequest):
@@ -44,10 +82,16 @@ class CommonCompletionRequest(BaseSamplerRequest):
         ge=1,
     )
 
-    # Extra OAI request stuff
     best_of: Optional[int] = Field(
-        description="Not parsed. Only used for OAI compliance.", default=None
+        description=(
+            "Generates best_of choices and returns the n with the "
+            "highest cumulative logprob. Cannot be streamed."
+        ),
+        default=None,
+        ge=1,
     )
+
+    # Extra OAI request stuff
     echo: Optional[bool] = Field(
         description="Not parsed. Only used for OAI compliance.", default=False
     )
@@ -57,3 +101,16 @@ class CommonCompletionRequest(BaseSamplerRequest):
     user: Optional[str] = Field(
         description="Not parsed. Only used for OAI compliance.", default=None
     )
+
+    @model_validator(mode="after")
+    def validate_best_of(self):
+        """best_of candidates are ranked after generation finishes."""
+
+        if self.best_of is not None:
+            if self.best_of < self.n:
+                raise ValueError("best_of must be greater than or equal to n")
+
+            if self.stream and self.best_of > self.n:
+                raise ValueError("best_of cannot be larger than n when streaming")
+
+        return self
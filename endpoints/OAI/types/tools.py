@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Dict, Literal
+from typing import Dict, Literal, Optional
 
 tool_call_schema = {
     "$schema": "http://json-schema.org/draft-07/schema#",
@@ -56,3 +56,23 @@ class ToolCall(BaseModel):
     id: str
     function: Tool
     type: Literal["function"]
+
+
+class FunctionDelta(BaseModel):
+    """Represents part of a streamed tool function."""
+
+    name: Optional[str] = None
+
+    # Fragment of the arguments JSON, fragments are concatenated by clients
+    arguments: str = ""
+
+
+class ToolCallDelta(BaseModel):
+    """Represents part of a streamed OAI tool call."""
+
+    index: int
+
+    # Only sent with the first part of a call
+    id: Optional[str] = None
+    type: Optional[Literal["function"]] = None
+    function: FunctionDelta
@@ -4,18 +4,30 @@ import asyncio
 import json
 import pathlib
 from asyncio import CancelledError
-from typing import List, Optional
+from typing import Dict, List, Optional
 from fastapi import HTTPException, Request
 from jinja2 import TemplateError
+from json.encoder import encode_basestring
 from loguru import logger
 
 from common import model
+from common.accumulator import ResponseAccumulator
+from common.images import ImagePreprocessPolicy
+from common.logprobs import TokenLogprobs
 from common.multimodal import MultimodalEmbeddingWrapper
 from common.networking import (
     get_generator_error,
+    get_request_disconnect,
     handle_request_disconnect,
     handle_request_error,
-    request_disconnect_loop,
+)
+from common.sampling import GenerationParams
+from common.scheduler import (
+    SchedulerRejection,
+    SchedulerTicket,
+    get_rejection_error,
+    get_rejection_generator_error,
+    scheduler,
 )
 from common.utils import unwrap
 from endpoints.OAI.types.chat_completion import (
@@ -27,10 +39,36 @@ from endpoints.OAI.types.chat_completion import (
     ChatCompletionStreamChunk,
     ChatCompletionResponse,
     ChatCompletionStreamChoice,
+    ChatCompletionToolCallsDelta,
 )
 from endpoints.OAI.types.common import UsageStats
-from endpoints.OAI.utils.completion import _stream_collector
-from endpoints.OAI.utils.tools import ToolCallProcessor
+from endpoints.OAI.utils.completion import _create_stream_queue, _stream_collector
+from endpoints.OAI.utils.stream import StreamChunkEncoder
+from endpoints.OAI.utils.tools import ToolCallProcessor, ToolCallStreamer
+
+
+def _create_logprobs(logprobs: TokenLogprobs):
+    """Create chat completion logprobs from token logprob rows."""
+
+    content = [
+        ChatCompletionLogprob(
+            token=token,
+            logprob=token_logprob,
+            top_logprobs=[
+                ChatCompletionLogprob(token=top_token, logprob=top_logprob)
+                for top_token, top_logprob in zip(top_tokens, top_logprobs, strict=True)
+            ],
+        )
+        for token, token_logprob, top_tokens, top_logprobs in zip(
+            logprobs.tokens,
+            logprobs.token_logprobs,
+            logprobs.top_tokens,
+            logprobs.top_logprobs,
+            strict=True,
+        )
+    ]
+
+    return ChatCompletionLogprobs(content=content)
 
 
 def _create_response(
@@ -53,26 +91,9 @@ def _create_response(
 
         logprob_response = None
 
-        token_probs = unwrap(generation.get("token_probs"), {})
-        if token_probs:
-            logprobs = unwrap(generation.get("logprobs"), [])
-
-            collected_token_probs = []
-            for index, token in enumerate(token_probs.keys()):
-                top_logprobs = [
-                    ChatCompletionLogprob(token=token, logprob=logprob)
-                    for token, logprob in logprobs[index].items()
-                ]
-
-                collected_token_probs.append(
-                    ChatCompletionLogprob(
-                        token=token,
-                        logprob=token_probs[token],
-                        top_logprobs=top_logprobs,
-                    )
-                )
-
-            logprob_response = ChatCompletionLogprobs(content=collected_token_probs)
+        logprobs = generation.get("logprobs")
+        if logprobs:
+            logprob_response = _create_logprobs(logprobs)
 
         # Initialize finish_reason with a default value or from generation data
         finish_reason = generation.get("finish_reason", "stop")
@@ -127,22 +148,9 @@ def _create_stream_chunk(
             total_tokens=prompt_tokens + completion_tokens,
         )
     elif "finish_reason" in generation:
-        # Get the finish reason from the generation
-        finish_reason = generation.get("finish_reason")
-        choice = ChatCompletionStreamChoice(index=index, finish_reason=finish_reason)
-
-        # lets check if we have tool calls since we are at the end of the generation
-        # Mark finish_reason as tool_calls since this is the last chunk
-        if "tool_calls" in generation:
-            tool_calls = generation["tool_calls"]
-            message = ChatCompletionMessage(
-                tool_calls=ToolCallProcessor.from_json(tool_calls)
-            )
-            choice.delta = message
-            choice.finish_reason = "tool_calls"
-
-        choices.append(choice)
-
+        choices.append(_create_stream_finish_choice(generation))
+    elif "tool_calls_delta" in generation:
+        choices.append(_create_stream_tool_calls_choice(generation))
     else:
         message = ChatCompletionMessage(
             role="assistant", content=unwrap(generation.get("text"), "")
@@ -150,22 +158,9 @@ def _create_stream_chunk(
 
         logprob_response = None
 
-        token_probs = unwrap(generation.get("token_probs"), {})
-        if token_probs:
-            logprobs = unwrap(generation.get("logprobs"), {})
-            top_logprobs = [
-                ChatCompletionLogprob(token=token, logprob=logprob)
-                for token, logprob in logprobs.items()
-            ]
-
-            generated_token = next(iter(token_probs))
-            token_prob_response = ChatCompletionLogprob(
-                token=generated_token,
-                logprob=token_probs[generated_token],
-                top_logprobs=top_logprobs,
-            )
-
-            logprob_response = ChatCompletionLogprobs(content=[token_prob_response])
+        logprobs = generation.get("logprobs")
+        if logprobs:
+            logprob_response = _create_logprobs(logprobs)
 
         choice = ChatCompletionStreamChoice(
             index=index,
@@ -185,6 +180,69 @@ def _create_stream_chunk(
     return chunk
 
 
+def _create_stream_finish_choice(generation: dict):
+    """Create the last stream choice of a generation."""
+
+    # Get the finish reason from the generation
+    finish_reason = generation.get("finish_reason")
+    choice = ChatCompletionStreamChoice(
+        index=generation.get("index"), finish_reason=finish_reason
+    )
+
+    # lets check if we have tool calls since we are at the end of the generation
+    # Mark finish_reason as tool_calls since this is the last chunk
+    if "tool_calls" in generation:
+        tool_calls = generation["tool_calls"]
+        message = ChatCompletionMessage(
+            tool_calls=ToolCallProcessor.from_json(tool_calls)
+        )
+        choice.delta = message
+        choice.finish_reason = "tool_calls"
+
+    return choice
+
+
+def _create_stream_tool_calls_choice(generation: dict):
+    """Create a stream choice with parts of streamed tool calls."""
+
+    return ChatCompletionStreamChoice(
+        index=generation.get("index"),
+        delta=ChatCompletionToolCallsDelta(tool_calls=generation["tool_calls_delta"]),
+    )
+
+
+def _encode_stream_chunk(encoder: StreamChunkEncoder, generation: dict):
+    """
+    Encode a chat completion stream chunk.
+
+    Same output as _create_stream_chunk. Text chunks are formatted
+    directly since they are sent for every token.
+    """
+
+    if "finish_reason" in generation:
+        return encoder.encode(
+            _create_stream_finish_choice(generation).model_dump_json()
+        )
+
+    if "tool_calls_delta" in generation:
+        return encoder.encode(
+            _create_stream_tool_calls_choice(generation).model_dump_json()
+        )
+
+    logprobs = generation.get("logprobs")
+    logprob_json = _create_logprobs(logprobs).model_dump_json() if logprobs else "null"
+
+    choice = (
+        f'{{"index":{generation.get("index")},"finish_reason":null,'
+        f'"delta":{{"role":"assistant",'
+        f'"content":{encode_basestring(unwrap(generation.get("text"), ""))},'
+        f'"tool_calls":null,"tool_calls_json":null}},'
+        f'"logprobs":{logprob_json}}}'
+    )
+
+    return encoder.encode(choice)
+
+
 async def _append_template_metadata(data: ChatCompletionRequest, template_vars: dict):
     """Adding metadata is a one-time process."""
 
@@ -212,12 +270,27 @@ async def format_messages_with_template(
     existing_template_vars: Optional[dict] = None,
     add_bos_token: bool = True,
     ban_eos_token: bool = False,
+    image_policy: Optional[ImagePreprocessPolicy] = None,
 ):
     """Barebones function to format chat completion messages into a prompt."""
 
     template_vars = unwrap(existing_template_vars, {})
+    messages_size = 0
     mm_embeddings = MultimodalEmbeddingWrapper() if model.container.use_vision else None
 
+    # Images of all messages are fetched together
+    image_urls = [
+        content.image_url.url
+        for message in messages
+        if isinstance(message.content, list)
+        for content in message.content
+        if content.type == "image_url"
+    ]
+    if mm_embeddings and image_urls:
+        await mm_embeddings.extend(image_urls, image_policy)
+
+    image_aliases = iter(mm_embeddings.text_alias if mm_embeddings else ())
+
     for message in messages:
         if isinstance(message.content, list):
             concatenated_content = ""
@@ -225,12 +298,14 @@ async def format_messages_with_template(
                 if content.type == "text":
                     concatenated_content += content.text
                 elif content.type == "image_url" and mm_embeddings:
-                    await mm_embeddings.add(content.image_url.url)
-                    concatenated_content += mm_embeddings.text_alias[-1]
+                    concatenated_content += next(image_aliases, "")
 
             # Convert the message content into a concatenated string
             message.content = concatenated_content
 
+        if message.content:
+            messages_size += len(message.content)
+
         if message.tool_calls:
             message.tool_calls_json = ToolCallProcessor.to_json(message.tool_calls)
 
@@ -240,7 +315,9 @@ async def format_messages_with_template(
 
     template_vars.update({"messages": messages, **special_tokens_dict})
 
-    prompt = await model.container.prompt_template.render(template_vars)
+    prompt = await model.container.prompt_template.render(
+        template_vars, size=messages_size
+    )
     return prompt, mm_embeddings, template_vars
 
 
@@ -263,7 +340,11 @@ async def apply_chat_template(
         )
 
         prompt, mm_embeddings, template_vars = await format_messages_with_template(
-            data.messages, data.template_vars, data.add_bos_token, data.ban_eos_token
+            data.messages,
+            data.template_vars,
+            data.add_bos_token,
+            data.ban_eos_token,
+            data.get_image_policy(model.container.image_policy),
         )
 
         # Append response prefix if present
@@ -307,75 +388,57 @@ async def stream_generate_chat_completion(
     data: ChatCompletionRequest,
     request: Request,
     model_path: pathlib.Path,
+    ticket: SchedulerTicket,
 ):
     """Generator for the generation process."""
     abort_event = asyncio.Event()
-    gen_queue = asyncio.Queue()
-    gen_tasks: List[asyncio.Task] = []
-    disconnect_task = asyncio.create_task(request_disconnect_loop(request))
+    stream_queue = _create_stream_queue(request.state.id, data)
+    disconnect = get_request_disconnect(request)
+    disconnect.watch(abort_event)
+    encoder = StreamChunkEncoder(
+        f"chatcmpl-{request.state.id}", model_path.name, "chat.completion.chunk"
+    )
 
     try:
         logger.info(f"Received chat completion streaming request {request.state.id}")
 
-        for n in range(0, data.n):
-            task_gen_params = data.model_copy(deep=True)
+        await scheduler.acquire(ticket)
 
-            gen_task = asyncio.create_task(
-                _stream_collector(
-                    n,
-                    gen_queue,
-                    prompt,
-                    request.state.id,
-                    abort_event,
-                    embeddings=embeddings,
-                    **task_gen_params.model_dump(exclude={"prompt"}),
-                )
+        asyncio.create_task(
+            _stream_collector(
+                stream_queue.buffer,
+                prompt,
+                request.state.id,
+                abort_event,
+                GenerationParams.from_request(data),
+                embeddings,
             )
-
-            gen_tasks.append(gen_task)
+        )
 
         # We need to keep track of the text generated so we can resume the tool calls
-        current_generation_text = ""
+        # Each choice index has its own text
+        current_generation_texts: Dict[int, ResponseAccumulator] = {}
+
+        # Usage is taken from the last generation
+        last_generation = None
 
         # Consumer loop
         while True:
-            if disconnect_task.done():
-                abort_event.set()
+            if disconnect.is_set():
                 handle_request_disconnect(
                     f"Chat completion generation {request.state.id} cancelled by user."
                 )
+                break
 
-            generation = await gen_queue.get()
-            # lets only append the text if we need it for tool calls later
-            if data.tool_call_start and "text" in generation:
-                current_generation_text += generation["text"]
-
-            # check if we are running a tool model, and that we are at stop
-            if data.tool_call_start and "stop_str" in generation:
-                generations = await generate_tool_calls(
-                    data,
-                    [generation],
-                    request,
-                    current_generations=current_generation_text,
-                )
-                generation = generations[0]  # We only have one generation in this case
-
-            # Stream collector will push an exception to the queue if it fails
-            if isinstance(generation, Exception):
-                raise generation
+            generation = await stream_queue.get()
 
-            response = _create_stream_chunk(
-                request.state.id, generation, model_path.name
-            )
-            yield response.model_dump_json()
-
-            # Check if all tasks are completed
-            if all(task.done() for task in gen_tasks) and gen_queue.empty():
+            # The stream collector is finished
+            if generation is None:
                 # Send a usage chunk
                 if data.stream_options and data.stream_options.include_usage:
                     usage_chunk = _create_stream_chunk(
                         request.state.id,
-                        generation,
+                        last_generation,
                         model_path.name,
                         is_usage_chunk=True,
                     )
@@ -387,16 +450,58 @@ async def stream_generate_chat_completion(
 
                 yield "[DONE]"
                 break
+
+            # Stream collector will push an exception to the queue if it fails
+            if isinstance(generation, Exception):
+                raise generation
+
+            if "finish_reason" in generation:
+                ticket.record_usage(generation)
+
+            # lets only append the text if we need it for tool calls later
+            if data.tool_call_start and "text" in generation:
+                current_generation_texts.setdefault(
+                    generation.get("index"), ResponseAccumulator()
+                ).append(generation["text"])
+
+            # check if we are running a tool model, and that we are at stop
+            if (
+                data.tool_call_start
+                and generation.get("stop_str") in data.tool_call_start
+            ):
+                current_generation_text = current_generation_texts.get(
+                    generation.get("index")
+                )
+
+                # Tool call arguments are streamed as they're generated
+                async for tool_generation in stream_tool_calls(
+                    prompt,
+                    embeddings,
+                    data,
+                    generation,
+                    request,
+                    abort_event,
+                    current_generation_text.text if current_generation_text else "",
+                ):
+                    yield _encode_stream_chunk(encoder, tool_generation)
+
+            last_generation = generation
+            yield _encode_stream_chunk(encoder, generation)
     except CancelledError:
         # Get out if the request gets disconnected
-
-        if not disconnect_task.done():
-            abort_event.set()
-            handle_request_disconnect("Chat completion generation cancelled by user.")
+        # The abort event is already set if the client disconnected
+        abort_event.set()
+        handle_request_disconnect("Chat completion generation cancelled by user.")
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        yield get_rejection_generator_error(ticket, exc)
     except Exception:
         yield get_generator_error(
             "Chat completion aborted. Please check the server console."
         )
+    finally:
+        scheduler.release(ticket)
+        stream_queue.buffer.close()
 
 
 async def generate_chat_completion(
@@ -405,33 +510,34 @@ async def generate_chat_completion(
     data: ChatCompletionRequest,
     request: Request,
     model_path: pathlib.Path,
+    ticket: SchedulerTicket,
 ):
-    gen_tasks: List[asyncio.Task] = []
-
     try:
-        for _ in range(0, data.n):
-            gen_tasks.append(
-                asyncio.create_task(
-                    model.container.generate(
-                        prompt,
-                        request.state.id,
-                        embeddings=embeddings,
-                        **data.model_dump(exclude={"prompt"}),
-                    )
-                )
-            )
+        await scheduler.acquire(ticket)
 
-        generations = await asyncio.gather(*gen_tasks)
+        generations = await model.container.generate_choices(
+            prompt,
+            request.state.id,
+            GenerationParams.from_request(data),
+            embeddings=embeddings,
+        )
+        for generation in generations:
+            ticket.record_usage(generation)
 
         # Let's not waste our time if we arn't running a tool model
         if data.tool_call_start:
-            generations = await generate_tool_calls(data, generations, request)
+            generations = await generate_tool_calls(
+                prompt, embeddings, data, generations, request
+            )
 
         response = _create_response(request.state.id, generations, model_path.name)
 
         logger.info(f"Finished chat completion request {request.state.id}")
 
         return response
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        raise get_rejection_error(ticket, exc) from exc
     except Exception as exc:
         error_message = handle_request_error(
             f"Chat completion {request.state.id} aborted. "
@@ -441,44 +547,61 @@ async def generate_chat_completion(
 
         # Server error if there's a generation exception
         raise HTTPException(503, error_message) from exc
+    finally:
+        scheduler.release(ticket)
+
+
+async def _get_tool_call_context(
+    prompt: str,
+    embeddings: MultimodalEmbeddingWrapper,
+    data: ChatCompletionRequest,
+    generation: dict,
+    precursor: str,
+):
+    """
+    Returns the prompt, embeddings and token ids to generate tool calls from.
+
+    If the generation returned the token ids of its sequence, the tool calls
+    continue that sequence and reuse its cache pages. Otherwise the template
+    is rendered again with the generated text as the tool precursor.
+    """
+
+    context_ids = generation.pop("context_ids", None)
+    if context_ids is not None:
+        # The prompt is only logged
+        return prompt + precursor + generation["stop_str"], embeddings, context_ids
+
+    pre_tool_prompt, mm_embeddings = await apply_chat_template(data, precursor)
+    return pre_tool_prompt, mm_embeddings, None
 
 
 async def generate_tool_calls(
+    prompt: str,
+    embeddings: MultimodalEmbeddingWrapper,
     data: ChatCompletionRequest,
-    generations: List[str],
+    generations: List[dict],
     request: Request,
-    current_generations: str = None,
 ):
     gen_tasks: List[asyncio.Task] = []
     tool_idx: List[int] = []
 
-    # Copy to make sure the parent JSON schema doesn't get modified
-    # FIXME: May not be necessary depending on how the codebase evolves
-    tool_data = data.model_copy(deep=True)
-    tool_data.json_schema = tool_data.tool_call_schema
-    gen_params = tool_data.model_dump()
+    # Params are read-only, so the request's JSON schema is left untouched
+    gen_params = GenerationParams.from_request(data, json_schema=data.tool_call_schema)
 
     for idx, gen in enumerate(generations):
-        if gen["stop_str"] in tool_data.tool_call_start:
-            if "text" in gen:
-                # non streaming, all generations will have the text they generated
-                pre_tool_prompt, mm_embeddings = await apply_chat_template(
-                    data, gen["text"]
-                )
-            elif current_generations is not None:
-                # streaming, we wont have text in the generation,
-                # we'll have to use the current_generations
-                pre_tool_prompt, mm_embeddings = await apply_chat_template(
-                    data, current_generations
-                )
+        if gen["stop_str"] in data.tool_call_start:
+            tool_prompt, tool_embeddings, context_ids = await _get_tool_call_context(
+                prompt, embeddings, data, gen, gen["text"]
+            )
 
             gen_tasks.append(
                 asyncio.create_task(
                     model.container.generate(
-                        pre_tool_prompt,
+                        tool_prompt,
                         request.state.id,
-                        embeddings=mm_embeddings,
-                        **gen_params,
+                        gen_params,
+                        embeddings=tool_embeddings,
+                        context_ids=context_ids,
                     )
                 )
             )
@@ -490,3 +613,49 @@ async def generate_tool_calls(
         generations[gen_idx]["tool_calls"] = tool_calls[outer_idx]["text"]
 
     return generations
+
+
+async def stream_tool_calls(
+    prompt: str,
+    embeddings: MultimodalEmbeddingWrapper,
+    data: ChatCompletionRequest,
+    generation: dict,
+    request: Request,
+    abort_event: asyncio.Event,
+    precursor: str,
+):
+    """
+    Generates the tool calls of a streamed choice that stopped on a tool start.
+
+    Parts of the calls are yielded as they're generated. Once they're done,
+    the finish reason of the choice's generation is set to tool_calls.
+    """
+
+    tool_prompt, tool_embeddings, context_ids = await _get_tool_call_context(
+        prompt, embeddings, data, generation, precursor
+    )
+
+    gen_params = GenerationParams.from_request(
+        data, json_schema=data.tool_call_schema, n=1, best_of=None
+    )
+    streamer = ToolCallStreamer()
+
+    tool_gen = model.container.generate_gen(
+        tool_prompt,
+        request.state.id,
+        gen_params,
+        abort_event,
+        tool_embeddings,
+        context_ids,
+    )
+
+    try:
+        async for tool_generation in tool_gen:
+            deltas = streamer.feed(unwrap(tool_generation.get("text"), ""))
+            if deltas:
+                yield {"index": generation.get("index"), "tool_calls_delta": deltas}
+    finally:
+        await tool_gen.aclose()
+
+    if streamer.calls:
+        generation["finish_reason"] = "tool_calls"
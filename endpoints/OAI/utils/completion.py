@@ -8,17 +8,27 @@ import asyncio
 import pathlib
 from asyncio import CancelledError
 from fastapi import HTTPException, Request
-from typing import List, Union
+from json.encoder import encode_basestring
+from typing import List, Optional, Union
 
 from loguru import logger
 
 from common import model
 from common.auth import get_key_permission
+from common.multimodal import MultimodalEmbeddingWrapper
 from common.networking import (
     get_generator_error,
+    get_request_disconnect,
     handle_request_disconnect,
     handle_request_error,
-    request_disconnect_loop,
+)
+from common.sampling import GenerationParams
+from common.scheduler import (
+    SchedulerRejection,
+    SchedulerTicket,
+    get_rejection_error,
+    get_rejection_generator_error,
+    scheduler,
 )
 from common.tabby_config import config
 from common.utils import unwrap
@@ -28,7 +38,32 @@ from endpoints.OAI.types.completion import (
     CompletionRespChoice,
     CompletionLogProbs,
 )
-from endpoints.OAI.types.common import UsageStats
+from endpoints.OAI.types.common import CommonCompletionRequest, UsageStats
+from endpoints.OAI.types.tools import tool_call_schema
+from endpoints.OAI.utils.stream import (
+    StreamBuffer,
+    StreamChunkEncoder,
+    StreamCoalescer,
+    StreamStalled,
+    encode_usage,
+)
+
+
+def _create_logprobs(generation: dict):
+    """Create completion logprobs from a generation."""
+
+    logprobs = generation.get("logprobs")
+    if not logprobs:
+        return None
+
+    offset = unwrap(generation.get("offset"), [])
+
+    return CompletionLogProbs(
+        text_offset=offset if isinstance(offset, list) else [offset],
+        token_logprobs=logprobs.token_logprobs,
+        tokens=logprobs.tokens,
+        top_logprobs=logprobs.top_logprob_dicts(),
+    )
 
 
 def _create_response(
@@ -42,19 +77,7 @@ def _create_response(
 
     choices: List[CompletionRespChoice] = []
     for index, generation in enumerate(generations):
-        logprob_response = None
-
-        token_probs = unwrap(generation.get("token_probs"), {})
-        if token_probs:
-            logprobs = unwrap(generation.get("logprobs"), [])
-            offset = unwrap(generation.get("offset"), [])
-
-            logprob_response = CompletionLogProbs(
-                text_offset=offset if isinstance(offset, list) else [offset],
-                token_logprobs=token_probs.values(),
-                tokens=token_probs.keys(),
-                top_logprobs=logprobs if isinstance(logprobs, list) else [logprobs],
-            )
+        logprob_response = _create_logprobs(generation)
 
         # The index can be located in the generation itself
         choice = CompletionRespChoice(
@@ -83,29 +106,91 @@ def _create_response(
     return response
 
 
+def _encode_stream_chunk(encoder: StreamChunkEncoder, generation: dict):
+    """
+    Encode a completion stream chunk.
+
+    Same output as _create_response for a single generation, without
+    building the response models.
+    """
+
+    finish_reason = generation.get("finish_reason")
+    logprob_response = _create_logprobs(generation)
+
+    choice = (
+        f'{{"index":{unwrap(generation.get("index"), 0)},'
+        f'"finish_reason":'
+        f"{encode_basestring(finish_reason) if finish_reason else 'null'},"
+        f'"logprobs":'
+        f"{logprob_response.model_dump_json() if logprob_response else 'null'},"
+        f'"text":{encode_basestring(unwrap(generation.get("text"), ""))}}}'
+    )
+
+    return encoder.encode(
+        choice,
+        encode_usage(
+            generation.get("prompt_tokens"), generation.get("generated_tokens")
+        ),
+    )
+
+
+def _create_stream_queue(request_id: str, data: CommonCompletionRequest):
+    """
+    Creates the generation buffer of a stream.
+
+    The buffer is bounded for slow clients, and is read through a
+    coalescer which merges tokens while the client is behind.
+    """
+
+    gen_buffer = StreamBuffer(
+        request_id,
+        unwrap(config.network.stream_buffer_bytes, 262144),
+        config.network.stream_stall_timeout,
+    )
+
+    flush_interval = unwrap(config.network.stream_flush_interval, 0.0)
+    if data.stream_options and not data.stream_options.coalesce:
+        flush_interval = 0.0
+
+    return StreamCoalescer(
+        gen_buffer, flush_interval, unwrap(config.network.stream_flush_bytes, 4096)
+    )
+
+
 async def _stream_collector(
-    task_idx: int,
-    gen_queue: asyncio.Queue,
+    gen_queue: StreamBuffer,
     prompt: str,
     request_id: str,
     abort_event: asyncio.Event,
-    **kwargs,
+    params: GenerationParams,
+    embeddings: Optional[MultimodalEmbeddingWrapper] = None,
 ):
-    """Collects a stream and places results in a common queue"""
+    """
+    Collects a stream and places results in a common queue.
+
+    The container runs all n choices of the request and tags each
+    generation with its index. None marks the end of the stream.
+    """
+
+    new_generation = model.container.generate_gen(
+        prompt, request_id, params, abort_event, embeddings
+    )
 
     try:
-        new_generation = model.container.generate_gen(
-            prompt, request_id, abort_event, **kwargs
-        )
         async for generation in new_generation:
-            generation["index"] = task_idx
-
             await gen_queue.put(generation)
-
-            if "finish_reason" in generation:
-                break
+    except StreamStalled as e:
+        logger.warning(f"{e} Cancelling the generation.")
+        await gen_queue.put(e)
+        return
     except Exception as e:
         await gen_queue.put(e)
+        return
+    finally:
+        # Cancels the jobs if the stream stops early
+        await new_generation.aclose()
+
+    await gen_queue.put(None)
 
 
 async def load_inline_model(model_name: str, request: Request):
@@ -172,103 +257,113 @@ async def load_inline_model(model_name: str, request: Request):
     await model.load_model(
         model_path,
         draft_model=config.draft_model.model_dump(include={"draft_model_dir"}),
+        warm_schemas=[tool_call_schema],
     )
 
 
 async def stream_generate_completion(
-    data: CompletionRequest, request: Request, model_path: pathlib.Path
+    data: CompletionRequest,
+    request: Request,
+    model_path: pathlib.Path,
+    ticket: SchedulerTicket,
 ):
     """Streaming generation for completions."""
 
     abort_event = asyncio.Event()
-    gen_queue = asyncio.Queue()
-    gen_tasks: List[asyncio.Task] = []
-    disconnect_task = asyncio.create_task(request_disconnect_loop(request))
+    stream_queue = _create_stream_queue(request.state.id, data)
+    disconnect = get_request_disconnect(request)
+    disconnect.watch(abort_event)
+    encoder = StreamChunkEncoder(
+        f"cmpl-{request.state.id}", model_path.name, "text_completion"
+    )
 
     try:
         logger.info(f"Received streaming completion request {request.state.id}")
 
-        for n in range(0, data.n):
-            task_gen_params = data.model_copy(deep=True)
-
-            gen_task = asyncio.create_task(
-                _stream_collector(
-                    n,
-                    gen_queue,
-                    data.prompt,
-                    request.state.id,
-                    abort_event,
-                    **task_gen_params.model_dump(exclude={"prompt"}),
-                )
-            )
+        await scheduler.acquire(ticket)
 
-            gen_tasks.append(gen_task)
+        asyncio.create_task(
+            _stream_collector(
+                stream_queue.buffer,
+                data.prompt,
+                request.state.id,
+                abort_event,
+                GenerationParams.from_request(data),
+            )
+        )
 
         # Consumer loop
         while True:
-            if disconnect_task.done():
-                abort_event.set()
+            if disconnect.is_set():
                 handle_request_disconnect(
                     f"Completion generation {request.state.id} cancelled by user."
                 )
+                break
 
-            generation = await gen_queue.get()
+            generation = await stream_queue.get()
+
+            # The stream collector is finished
+            if generation is None:
+                yield "[DONE]"
+                logger.info(f"Finished streaming completion request {request.state.id}")
+                break
 
             # Stream collector will push an exception to the queue if it fails
             if isinstance(generation, Exception):
                 raise generation
 
-            response = _create_response(request.state.id, generation, model_path.name)
-            yield response.model_dump_json()
+            if "finish_reason" in generation:
+                ticket.record_usage(generation)
 
-            # Check if all tasks are completed
-            if all(task.done() for task in gen_tasks) and gen_queue.empty():
-                yield "[DONE]"
-                logger.info(f"Finished streaming completion request {request.state.id}")
-                break
+            yield _encode_stream_chunk(encoder, generation)
     except CancelledError:
         # Get out if the request gets disconnected
-
-        if not disconnect_task.done():
-            abort_event.set()
-            handle_request_disconnect(
-                f"Completion generation {request.state.id} cancelled by user."
-            )
+        # The abort event is already set if the client disconnected
+        abort_event.set()
+        handle_request_disconnect(
+            f"Completion generation {request.state.id} cancelled by user."
+        )
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        yield get_rejection_generator_error(ticket, exc)
     except Exception:
         yield get_generator_error(
             f"Completion {request.state.id} aborted. Please check the server console."
         )
+    finally:
+        scheduler.release(ticket)
+        stream_queue.buffer.close()
 
 
 async def generate_completion(
-    data: CompletionRequest, request: Request, model_path: pathlib.Path
+    data: CompletionRequest,
+    request: Request,
+    model_path: pathlib.Path,
+    ticket: SchedulerTicket,
 ):
     """Non-streaming generate for completions"""
 
-    gen_tasks: List[asyncio.Task] = []
-
     try:
         logger.info(f"Recieved completion request {request.state.id}")
 
-        for _ in range(0, data.n):
-            task_gen_params = data.model_copy(deep=True)
+        await scheduler.acquire(ticket)
 
-            gen_tasks.append(
-                asyncio.create_task(
-                    model.container.generate(
-                        data.prompt,
-                        request.state.id,
-                        **task_gen_params.model_dump(exclude={"prompt"}),
-                    )
-                )
-            )
+        generations = await model.container.generate_choices(
+            data.prompt,
+            request.state.id,
+            GenerationParams.from_request(data),
+        )
+        for generation in generations:
+            ticket.record_usage(generation)
 
-        generations = await asyncio.gather(*gen_tasks)
         response = _create_response(request.state.id, generations, model_path.name)
 
         logger.info(f"Finished completion request {request.state.id}")
 
         return response
+    except SchedulerRejection as exc:
+        # The deadline passed in the queue
+        raise get_rejection_error(ticket, exc) from exc
     except Exception as exc:
         error_message = handle_request_error(
             f"Completion {request.state.id} aborted. Maybe the model was unloaded? "
@@ -277,3 +372,5 @@ async def generate_completion(
 
         # Server error if there's a generation exception
         raise HTTPException(503, error_message) from exc
+    finally:
+        scheduler.release(ticket)
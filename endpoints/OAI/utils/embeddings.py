@@ -8,17 +8,19 @@ embeddings function declared async.
 """
 
 import base64
-from fastapi import Request
+from fastapi import Request, Response
 import numpy as np
+from json.encoder import encode_basestring
 from loguru import logger
+from pydantic import TypeAdapter
+from typing import List
 
 from common import model
-from endpoints.OAI.types.embedding import (
-    EmbeddingObject,
-    EmbeddingsRequest,
-    EmbeddingsResponse,
-    UsageInfo,
-)
+from common.concurrency import cpu_pool
+from endpoints.OAI.types.embedding import EmbeddingsRequest, UsageInfo
+
+# Serializes embedding rows with pydantic-core instead of json
+_float_list_adapter = TypeAdapter(List[float])
 
 
 def float_list_to_base64(float_array: np.ndarray) -> str:
@@ -35,7 +37,44 @@ def float_list_to_base64(float_array: np.ndarray) -> str:
     return ascii_string
 
 
-async def get_embeddings(data: EmbeddingsRequest, request: Request) -> dict:
+def encode_embeddings(embeddings: np.ndarray, encoding_format: str) -> List[str]:
+    """
+    Encodes each row of an embedding matrix as a JSON value.
+
+    The whole matrix is converted at once, which avoids validating and
+    re-encoding every float like a response model would.
+    """
+
+    if encoding_format == "base64":
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        return [f'"{float_list_to_base64(row)}"' for row in embeddings]
+
+    return [
+        _float_list_adapter.dump_json(row).decode()
+        for row in embeddings.astype(np.float32, copy=False).tolist()
+    ]
+
+
+def encode_embeddings_response(
+    embeddings: np.ndarray, encoding_format: str, model_name: str, usage: int
+) -> str:
+    """Same output as EmbeddingsResponse.model_dump_json."""
+
+    data = ",".join(
+        f'{{"object":"embedding","embedding":{embedding},"index":{index}}}'
+        for index, embedding in enumerate(
+            encode_embeddings(embeddings, encoding_format)
+        )
+    )
+    usage_json = UsageInfo(prompt_tokens=usage, total_tokens=usage).model_dump_json()
+
+    return (
+        f'{{"object":"list","data":[{data}],'
+        f'"model":{encode_basestring(model_name)},"usage":{usage_json}}}'
+    )
+
+
+async def get_embeddings(data: EmbeddingsRequest, request: Request) -> Response:
     model_path = model.embeddings_container.model_dir
 
     logger.info(f"Recieved embeddings request {request.state.id}")
@@ -44,25 +83,19 @@ async def get_embeddings(data: EmbeddingsRequest, request: Request) -> dict:
         data.input = [data.input]
 
     embedding_data = await model.embeddings_container.generate(data.input)
+    embeddings = embedding_data.get("embeddings")
 
     # OAI expects a return of base64 if the input is base64
-    embedding_object = [
-        EmbeddingObject(
-            embedding=float_list_to_base64(emb)
-            if data.encoding_format == "base64"
-            else emb.tolist(),
-            index=n,
-        )
-        for n, emb in enumerate(embedding_data.get("embeddings"))
-    ]
-
-    usage = embedding_data.get("usage")
-    response = EmbeddingsResponse(
-        data=embedding_object,
-        model=model_path.name,
-        usage=UsageInfo(prompt_tokens=usage, total_tokens=usage),
+    content = await cpu_pool.run(
+        encode_embeddings_response,
+        embeddings,
+        data.encoding_format,
+        model_path.name,
+        embedding_data.get("usage"),
+        size=embeddings.size,
     )
 
     logger.info(f"Finished embeddings request {request.state.id}")
 
-    return response
+    # Already serialized, so FastAPI doesn't encode the response model again
+    return Response(content=content, media_type="application/json")
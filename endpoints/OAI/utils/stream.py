@@ -0,0 +1,297 @@
+"""Encoding and coalescing of OAI stream chunks."""
+
+import asyncio
+from collections import deque
+from json.encoder import encode_basestring
+from time import time
+from typing import Deque, Dict, Iterable, Optional, Union
+
+
+def encode_usage(prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    """Returns the JSON of usage stats."""
+
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+
+    return (
+        f'{{"prompt_tokens":{prompt_tokens},'
+        f'"completion_tokens":{completion_tokens},'
+        f'"total_tokens":{prompt_tokens + completion_tokens}}}'
+    )
+
+
+class StreamChunkEncoder:
+    """
+    Encodes the chunks of one streaming response as SSE messages.
+
+    Every chunk of a stream has the same id, model and object, so that part
+    of the JSON is built once. Each chunk only formats its choice and usage
+    into the envelope. The output matches model_dump_json of the response
+    models byte for byte, and is sent as bytes so sse_starlette doesn't
+    encode it again.
+    """
+
+    __slots__ = ("head", "tail")
+
+    def __init__(self, response_id: str, model_name: str, object_name: str):
+        self.head = f'data: {{"id":{encode_basestring(response_id)},"choices":['
+        self.tail = (
+            f',"model":{encode_basestring(model_name)},'
+            f'"object":{encode_basestring(object_name)},"usage":'
+        )
+
+    def encode(self, choice: str, usage: str = "null") -> bytes:
+        """Encodes a chunk from the JSON of its choice and usage."""
+
+        return (
+            f'{self.head}{choice}],"created":{int(time())}{self.tail}{usage}}}\r\n\r\n'
+        ).encode()
+
+
+class StreamStalled(Exception):
+    """Raised when a stream's client stops reading for too long."""
+
+    pass
+
+
+def get_text_size(generation: Union[dict, Exception, None]):
+    """Returns the UTF-8 size of a generation's text."""
+
+    if not isinstance(generation, dict):
+        return 0
+
+    text = generation.get("text")
+    return len(text.encode()) if text else 0
+
+
+def can_merge(generation: Union[dict, Exception, None]):
+    """Checks if a generation is a text chunk that can be merged."""
+
+    return isinstance(generation, dict) and "finish_reason" not in generation
+
+
+def merge_generation(generation: dict, other: dict):
+    """Appends the text of a later chunk of the same choice to a generation."""
+
+    generation["text"] = (generation.get("text") or "") + (other.get("text") or "")
+
+    # Token counts and offsets are cumulative
+    for key in ("prompt_tokens", "generated_tokens", "offset"):
+        if key in other:
+            generation[key] = other[key]
+
+    logprobs = other.get("logprobs")
+    if logprobs:
+        if generation.get("logprobs"):
+            generation["logprobs"].extend(logprobs)
+        else:
+            generation["logprobs"] = logprobs
+
+
+def merge_generations(generations: Iterable[Union[dict, Exception, None]]):
+    """
+    Merges the text chunks of each choice.
+
+    Text of a choice is placed before its finish generation. Anything after
+    an exception or the end of the stream is kept as is.
+    """
+
+    merged: Dict[int, dict] = {}
+    results = []
+
+    generations = iter(generations)
+    for generation in generations:
+        if can_merge(generation):
+            index = generation.get("index")
+            merged_generation = merged.get(index)
+            if merged_generation is None:
+                merged[index] = generation
+            else:
+                merge_generation(merged_generation, generation)
+        elif isinstance(generation, dict):
+            index = generation.get("index")
+            if index in merged:
+                results.append(merged.pop(index))
+
+            results.append(generation)
+        else:
+            results.extend(merged.values())
+            merged.clear()
+
+            results.append(generation)
+            results.extend(generations)
+
+    results.extend(merged.values())
+    return results
+
+
+class StreamStats:
+    """Buffer usage of the active streams."""
+
+    def __init__(self):
+        self.buffers: Dict[str, "StreamBuffer"] = {}
+        self.paused = 0
+        self.stalled = 0
+
+    def stats(self):
+        buffered_bytes = {
+            request_id: buffer.buffered_bytes
+            for request_id, buffer in self.buffers.items()
+        }
+
+        return {
+            "active": len(self.buffers),
+            "buffered_bytes": sum(buffered_bytes.values()),
+            "paused": self.paused,
+            "stalled": self.stalled,
+            "streams": buffered_bytes,
+        }
+
+
+class StreamBuffer:
+    """
+    Bounded buffer between a stream's generation task and its response.
+
+    Text is counted in bytes. Once the buffer is full, its text chunks are
+    merged and the generation task stops reading from the model until the
+    client catches up. A stream that stays full for longer than the stall
+    timeout raises StreamStalled, so its job can be cancelled instead of
+    decoding for a client that stopped reading. Finish generations,
+    exceptions and the end of the stream (None) are always accepted.
+    """
+
+    __slots__ = (
+        "request_id",
+        "max_bytes",
+        "stall_timeout",
+        "items",
+        "buffered_bytes",
+        "readable",
+        "writable",
+    )
+
+    def __init__(
+        self, request_id: str, max_bytes: int, stall_timeout: Optional[float] = None
+    ):
+        self.request_id = request_id
+        self.max_bytes = max_bytes
+        self.stall_timeout = stall_timeout
+        self.items: Deque[Union[dict, Exception, None]] = deque()
+        self.buffered_bytes = 0
+
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+        stream_stats.buffers[request_id] = self
+
+    def close(self):
+        stream_stats.buffers.pop(self.request_id, None)
+
+    def empty(self):
+        return not self.items
+
+    def get_nowait(self) -> Union[dict, Exception, None]:
+        if not self.items:
+            raise asyncio.QueueEmpty
+
+        generation = self.items.popleft()
+        self.buffered_bytes -= get_text_size(generation)
+
+        if not self.items:
+            self.readable.clear()
+
+        if self.buffered_bytes < self.max_bytes:
+            self.writable.set()
+
+        return generation
+
+    async def get(self) -> Union[dict, Exception, None]:
+        while not self.items:
+            await self.readable.wait()
+
+        return self.get_nowait()
+
+    async def put(self, generation: Union[dict, Exception, None]):
+        if can_merge(generation) and self.buffered_bytes >= self.max_bytes:
+            # Fewer, larger chunks while the client is behind
+            self.items = deque(merge_generations(self.items))
+
+            stream_stats.paused += 1
+            self.writable.clear()
+
+            try:
+                await asyncio.wait_for(self.writable.wait(), self.stall_timeout)
+            except asyncio.TimeoutError as exc:
+                stream_stats.stalled += 1
+
+                raise StreamStalled(
+                    f"Stream {self.request_id} stalled with "
+                    f"{self.buffered_bytes} bytes buffered."
+                ) from exc
+
+        self.items.append(generation)
+        self.buffered_bytes += get_text_size(generation)
+        self.readable.set()
+
+
+class StreamCoalescer:
+    """
+    Reads generations from a stream buffer and merges them when the client
+    falls behind.
+
+    Generations are only buffered while the previous event is still being
+    written, so a backlog means the client or the network is slower than
+    the generator. In that case the text chunks of each choice are merged
+    for up to the flush interval or until they reach the byte threshold,
+    which turns many small writes into one. Otherwise generations pass
+    through one by one and the first token isn't delayed.
+    """
+
+    __slots__ = ("buffer", "flush_interval", "max_bytes", "ready")
+
+    def __init__(self, buffer: StreamBuffer, flush_interval: float, max_bytes: int):
+        self.buffer = buffer
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.ready: Deque[Union[dict, Exception, None]] = deque()
+
+    def empty(self):
+        return not self.ready and self.buffer.empty()
+
+    async def get(self) -> Union[dict, Exception, None]:
+        if self.ready:
+            return self.ready.popleft()
+
+        generation = await self.buffer.get()
+        if self.flush_interval <= 0 or self.buffer.empty() or not can_merge(generation):
+            return generation
+
+        generations = [generation]
+        size = get_text_size(generation)
+        flush_time = time() + self.flush_interval
+
+        # Stop at an exception or the end of the stream
+        while size < self.max_bytes and isinstance(generation, dict):
+            if self.buffer.empty():
+                remaining = flush_time - time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    generation = await asyncio.wait_for(self.buffer.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                generation = self.buffer.get_nowait()
+
+            generations.append(generation)
+            size += get_text_size(generation)
+
+        self.ready.extend(merge_generations(generations))
+
+        return self.ready.popleft()
+
+
+# Global stream buffer stats
+stream_stats = StreamStats()
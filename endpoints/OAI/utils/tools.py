@@ -1,8 +1,9 @@
 import json
 from loguru import logger
-from typing import List
+from typing import List, Optional
+from uuid import uuid4
 
-from endpoints.OAI.types.tools import ToolCall
+from endpoints.OAI.types.tools import FunctionDelta, ToolCall, ToolCallDelta
 
 
 class ToolCallProcessor:
@@ -44,3 +45,165 @@ class ToolCallProcessor:
 
         # Serialize the dumped array
         return json.dumps(dumped_tool_calls, indent=2)
+
+
+class ToolCallStreamer:
+    """
+    Converts generated tool call JSON into OAI stream deltas.
+
+    Tool calls are generated as a JSON array of calls, each with an id and
+    a function holding a name and an arguments object. The text is scanned
+    as it streams. Once the arguments of a call start, its id and name are
+    sent, followed by the raw arguments text as it's generated.
+    """
+
+    __slots__ = (
+        "text",
+        "position",
+        "stack",
+        "keys",
+        "awaiting_key",
+        "in_string",
+        "escaped",
+        "string_start",
+        "call_id",
+        "call_name",
+        "calls",
+        "arguments_sent",
+    )
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+
+        # Open containers and the current key of each
+        self.stack: List[str] = []
+        self.keys: List[Optional[str]] = []
+        self.awaiting_key = False
+
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+
+        self.call_id: Optional[str] = None
+        self.call_name: Optional[str] = None
+        self.calls = 0
+
+        # Position of the unsent arguments text, None outside of arguments
+        self.arguments_sent: Optional[int] = None
+
+    def in_function(self):
+        """Checks if the scanner is directly inside a call's function."""
+
+        return len(self.stack) == 3 and self.keys[1] == "function"
+
+    def start_value(self, position: int, deltas: List[ToolCallDelta]):
+        """Handles the first character of a JSON value."""
+
+        if len(self.stack) == 1 and self.text[position] == "{":
+            # A new call in the array
+            self.call_id = None
+            self.call_name = None
+        elif (
+            self.in_function()
+            and self.keys[2] == "arguments"
+            and self.arguments_sent is None
+        ):
+            deltas.append(
+                ToolCallDelta(
+                    index=self.calls,
+                    id=self.call_id or f"call_{uuid4().hex}",
+                    type="function",
+                    function=FunctionDelta(name=self.call_name or ""),
+                )
+            )
+
+            self.calls += 1
+            self.arguments_sent = position
+
+    def end_arguments(self, position: int, deltas: List[ToolCallDelta]):
+        """Sends the arguments text up to a position."""
+
+        fragment = self.text[self.arguments_sent : position]
+        if fragment:
+            deltas.append(
+                ToolCallDelta(
+                    index=self.calls - 1, function=FunctionDelta(arguments=fragment)
+                )
+            )
+
+        self.arguments_sent = position
+
+    def end_string(self, position: int, deltas: List[ToolCallDelta]):
+        """Handles the closing quote of a JSON string."""
+
+        if self.awaiting_key and self.stack[-1] == "{":
+            self.keys[-1] = json.loads(self.text[self.string_start : position + 1])
+        elif self.in_function() and self.arguments_sent is not None:
+            self.end_arguments(position + 1, deltas)
+            self.arguments_sent = None
+        elif len(self.stack) == 2 and self.keys[1] == "id":
+            self.call_id = json.loads(self.text[self.string_start : position + 1])
+        elif self.in_function() and self.keys[2] == "name":
+            self.call_name = json.loads(self.text[self.string_start : position + 1])
+
+    def feed(self, text: str) -> List[ToolCallDelta]:
+        """Scans a chunk of generated text and returns its deltas."""
+
+        self.text += text
+        deltas: List[ToolCallDelta] = []
+
+        for position in range(self.position, len(self.text)):
+            char = self.text[position]
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.end_string(position, deltas)
+            elif char == '"':
+                if not (self.awaiting_key and self.stack[-1] == "{"):
+                    self.start_value(position, deltas)
+
+                self.in_string = True
+                self.string_start = position
+            elif char in "[{":
+                self.start_value(position, deltas)
+
+                self.stack.append(char)
+                self.keys.append(None)
+                self.awaiting_key = char == "{"
+            elif char in "]}" and self.stack:
+                if self.in_function() and self.arguments_sent is not None:
+                    # The arguments were a literal
+                    self.end_arguments(position, deltas)
+                    self.arguments_sent = None
+
+                self.stack.pop()
+                self.keys.pop()
+                self.awaiting_key = False
+
+                if self.in_function() and self.arguments_sent is not None:
+                    self.end_arguments(position + 1, deltas)
+                    self.arguments_sent = None
+            elif char == ":":
+                self.awaiting_key = False
+            elif char == ",":
+                if self.in_function() and self.arguments_sent is not None:
+                    self.end_arguments(position, deltas)
+                    self.arguments_sent = None
+
+                self.awaiting_key = self.stack[-1:] == ["{"]
+            elif not char.isspace():
+                self.start_value(position, deltas)
+
+        self.position = len(self.text)
+
+        # Send the arguments generated so far
+        if self.arguments_sent is not None:
+            self.end_arguments(self.position, deltas)
+
+        return deltas
@@ -9,15 +9,23 @@ from sse_starlette import EventSourceResponse
 
 from common import model, sampling
 from common.auth import check_admin_key, check_api_key, get_key_permission
+from common.concurrency import cpu_pool
 from common.downloader import hf_repo_download
 from common.model import check_embeddings_container, check_model_container
 from common.networking import handle_request_error, run_with_request_disconnect
+from common.rate_limit import rate_limiter
+from common.scheduler import scheduler
 from common.tabby_config import config
 from common.templating import PromptTemplate, get_all_templates
 from common.utils import unwrap
 from common.health import HealthManager
 from endpoints.OAI.utils.chat_completion import format_messages_with_template
-from endpoints.core.types.auth import AuthPermissionResponse
+from endpoints.OAI.utils.stream import stream_stats
+from endpoints.core.types.auth import (
+    AuthPermissionResponse,
+    KeyLimitsResponse,
+    KeyLimitsUpdateRequest,
+)
 from endpoints.core.types.download import DownloadRequest, DownloadResponse
 from endpoints.core.types.lora import LoraList, LoraLoadRequest, LoraLoadResponse
 from endpoints.core.types.model import (
@@ -28,6 +36,7 @@ from endpoints.core.types.model import (
     ModelLoadRequest,
     ModelLoadResponse,
     ModelPropsResponse,
+    ModelStatsResponse,
 )
 from endpoints.core.types.health import HealthCheckResponse
 from endpoints.core.types.sampler_overrides import (
@@ -157,6 +166,20 @@ async def model_props() -> ModelPropsResponse:
     return resp
 
 
+@router.get(
+    "/v1/model/stats",
+    dependencies=[Depends(check_admin_key), Depends(check_model_container)],
+)
+async def model_stats() -> ModelStatsResponse:
+    """Returns cache and scheduling statistics of the loaded model."""
+
+    return ModelStatsResponse(
+        **model.container.get_stats(),
+        scheduler=scheduler.stats(),
+        streams=stream_stats.stats(),
+    )
+
+
 @router.get("/v1/model/draft/list", dependencies=[Depends(check_api_key)])
 async def list_draft_models(request: Request) -> ModelList:
     """
@@ -445,7 +468,10 @@ async def encode_tokens(data: TokenEncodeRequest) -> TokenEncodeResponse:
 
         # Don't need template vars again
         text, mm_embeddings, _ = await format_messages_with_template(
-            data.text, template_vars, data.add_bos_token
+            data.text,
+            template_vars,
+            data.add_bos_token,
+            image_policy=data.get_image_policy(model.container.image_policy),
         )
     else:
         error_message = handle_request_error(
@@ -455,12 +481,22 @@ async def encode_tokens(data: TokenEncodeRequest) -> TokenEncodeResponse:
 
         raise HTTPException(422, error_message)
 
-    raw_tokens = model.container.encode_tokens(
-        text, embeddings=mm_embeddings, **data.get_params()
+    raw_tokens = await cpu_pool.run(
+        model.container.encode_tokens,
+        text,
+        size=len(text),
+        embeddings=mm_embeddings,
+        **data.get_params(),
     )
     tokens = unwrap(raw_tokens, [])
     response = TokenEncodeResponse(tokens=tokens, length=len(tokens))
 
+    # Images are downscaled by the policy, so their cost is reported
+    if mm_embeddings:
+        response.image_tokens = [
+            embedding.length for embedding in mm_embeddings.content
+        ]
+
     return response
 
 
@@ -498,6 +534,27 @@ async def key_permission(request: Request) -> AuthPermissionResponse:
         raise HTTPException(400, error_message) from exc
 
 
+@router.get("/v1/auth/limits", dependencies=[Depends(check_admin_key)])
+async def key_limits() -> KeyLimitsResponse:
+    """Gets the limits and usage counters of all API keys seen by the server."""
+
+    return KeyLimitsResponse(**rate_limiter.stats())
+
+
+@router.post("/v1/auth/limits", dependencies=[Depends(check_admin_key)])
+async def update_key_limits(data: KeyLimitsUpdateRequest) -> KeyLimitsResponse:
+    """Adjusts the limits of an API key, or the defaults, while running."""
+
+    key_id = data.key_id
+    if data.key:
+        key_id = rate_limiter.get_key_id(data.key)
+
+    limits = data.model_dump(exclude={"key_id", "key"}, exclude_unset=True)
+    rate_limiter.update_limits(key_id, **limits)
+
+    return KeyLimitsResponse(**rate_limiter.stats())
+
+
 @router.get("/v1/templates", dependencies=[Depends(check_api_key)])
 @router.get("/v1/template/list", dependencies=[Depends(check_api_key)])
 async def list_templates(request: Request) -> TemplateList:
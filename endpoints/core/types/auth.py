@@ -1,7 +1,43 @@
 """Types for auth requests."""
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Dict, Optional, Union
 
 
 class AuthPermissionResponse(BaseModel):
     permission: str
+
+
+class KeyLimitsUpdateRequest(BaseModel):
+    """
+    Represents an update of API key limits.
+
+    Only the provided limits are changed. Set a limit to null to remove it.
+    If no key is provided, the defaults of all keys without custom limits
+    are updated.
+    """
+
+    key_id: Optional[str] = Field(
+        default=None, description="Account ID of the key, as listed in the limits."
+    )
+    key: Optional[str] = Field(default=None, description="Raw API key.")
+    requests_per_second: Optional[float] = Field(default=None, gt=0)
+    concurrent_jobs: Optional[int] = Field(default=None, ge=1)
+    tokens_per_minute: Optional[int] = Field(default=None, ge=1)
+    weight: float = Field(
+        default=1.0,
+        description="Share of generator slots relative to other keys.",
+        gt=0,
+    )
+    timeout: Optional[float] = Field(
+        default=None,
+        description="Default timeout in seconds of the key's requests.",
+        gt=0,
+    )
+
+
+class KeyLimitsResponse(BaseModel):
+    """Represents the limits and usage counters of API keys."""
+
+    defaults: Dict[str, Optional[float]]
+    keys: Dict[str, Dict[str, Union[str, int, float, None]]]
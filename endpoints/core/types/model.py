@@ -2,7 +2,7 @@
 
 from pydantic import AliasChoices, BaseModel, Field, ConfigDict
 from time import time
-from typing import List, Literal, Optional, Union
+from typing import Dict, List, Literal, Optional, Union
 
 from common.config_models import LoggingConfig
 from common.tabby_config import config
@@ -111,8 +111,15 @@ class ModelLoadRequest(BaseModel):
     )
     cache_mode: Optional[str] = None
     chunk_size: Optional[int] = None
+    tokenizer_cache_size: Optional[int] = None
+    grammar_cache_size: Optional[int] = None
+    grammar_schemas: Optional[List[str]] = None
     prompt_template: Optional[str] = None
     vision: Optional[bool] = None
+    vision_cache_bytes: Optional[int] = None
+    vision_max_pixels: Optional[int] = None
+    vision_max_side: Optional[int] = None
+    vision_resample: Optional[str] = None
 
     # Non-config arguments
     draft_model: Optional[DraftModelLoadRequest] = Field(
@@ -130,6 +137,15 @@ class EmbeddingModelLoadRequest(BaseModel):
 
     # Set default from the config
     embeddings_device: Optional[str] = Field(config.embeddings.embeddings_device)
+    embeddings_max_batch_size: Optional[int] = Field(
+        config.embeddings.embeddings_max_batch_size
+    )
+    embeddings_batch_window: Optional[float] = Field(
+        config.embeddings.embeddings_batch_window
+    )
+    embeddings_cache_bytes: Optional[int] = Field(
+        config.embeddings.embeddings_cache_bytes
+    )
 
 
 class ModelLoadResponse(BaseModel):
@@ -144,6 +160,19 @@ class ModelLoadResponse(BaseModel):
     status: str
 
 
+class ModelStatsResponse(BaseModel):
+    """Represents runtime statistics of the loaded model."""
+
+    generation_profiles: Optional[Dict[str, Union[int, float]]] = None
+    grammar_cache: Optional[Dict[str, Union[int, float]]] = None
+    image_embedding_cache: Optional[Dict[str, Union[int, float]]] = None
+    cpu_pool: Optional[Dict[str, Union[int, float]]] = None
+    tokenizer_cache: Optional[Dict[str, Union[int, float]]] = None
+    scheduler: Optional[Dict[str, Union[int, float]]] = None
+    streams: Optional[Dict[str, Union[int, Dict[str, int]]]] = None
+    speculation: Optional[Dict[str, Dict[str, Union[int, float]]]] = None
+
+
 class ModelDefaultGenerationSettings(BaseModel):
     """Contains default generation settings for model props."""
 
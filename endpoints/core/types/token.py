@@ -1,9 +1,10 @@
 """Tokenization types"""
 
-from pydantic import BaseModel
-from typing import List, Union
+from pydantic import BaseModel, Field
+from typing import List, Optional, Union
 
 from endpoints.OAI.types.chat_completion import ChatCompletionMessage
+from endpoints.OAI.types.common import ImagePreprocessOptions
 
 
 class CommonTokenRequest(BaseModel):
@@ -22,7 +23,7 @@ class CommonTokenRequest(BaseModel):
         }
 
 
-class TokenEncodeRequest(CommonTokenRequest):
+class TokenEncodeRequest(CommonTokenRequest, ImagePreprocessOptions):
     """Represents a tokenization request."""
 
     text: Union[str, List[ChatCompletionMessage]]
@@ -33,6 +34,10 @@ class TokenEncodeResponse(BaseModel):
 
     tokens: List[int]
     length: int
+    image_tokens: Optional[List[int]] = Field(
+        default=None,
+        description="Number of tokens of each image, after downscaling.",
+    )
 
 
 class TokenDecodeRequest(CommonTokenRequest):
@@ -13,6 +13,7 @@ from endpoints.core.types.model import (
     ModelLoadRequest,
     ModelLoadResponse,
 )
+from endpoints.OAI.types.tools import tool_call_schema
 
 
 def get_model_list(model_path: pathlib.Path, draft_model_path: Optional[str] = None):
@@ -114,7 +115,10 @@ async def stream_model_load(
         load_data["draft_model"]["draft_model_dir"] = draft_model_path
 
     load_status = model.load_model_gen(
-        model_path, skip_wait=data.skip_queue, **load_data
+        model_path,
+        skip_wait=data.skip_queue,
+        warm_schemas=[tool_call_schema],
+        **load_data,
     )
     try:
         async for module, modules, model_type in load_status:
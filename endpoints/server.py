@@ -6,7 +6,7 @@ from loguru import logger
 from typing import Optional
 
 from common.logger import UVICORN_LOG_CONFIG
-from common.networking import get_global_depends
+from common.networking import DisconnectMiddleware, get_global_depends
 from common.tabby_config import config
 from endpoints.Kobold import router as KoboldRouter
 from endpoints.OAI import router as OAIRouter
@@ -35,6 +35,9 @@ def setup_app(host: Optional[str] = None, port: Optional[int] = None):
         allow_headers=["*"],
     )
 
+    # Watch for client disconnects to stop generations
+    app.add_middleware(DisconnectMiddleware)
+
     api_servers = config.network.api_servers
     api_servers = (
         api_servers
@@ -17,6 +17,7 @@ from common.logger import setup_logger
 from common.networking import is_port_in_use
 from common.signals import signal_handler
 from common.tabby_config import config
+from endpoints.OAI.types.tools import tool_call_schema
 from endpoints.server import start_api
 
 from backends.exllamav2.version import check_exllama_version
@@ -72,6 +73,8 @@ async def entrypoint_async():
             model_path.resolve(),
             **config.model.model_dump(exclude_none=True),
             draft_model=config.draft_model.model_dump(exclude_none=True),
+            # Tool calls always use the same schema
+            warm_schemas=[tool_call_schema],
         )
 
         # Load loras after loading the model
@@ -0,0 +1,33 @@
+"""Fixtures shared by the image tests."""
+
+import base64
+import io
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def encode_png():
+    """Creates a solid PNG image and returns its bytes."""
+
+    def encode(color, mode: str = "RGB", size=(8, 8)) -> bytes:
+        image_file = io.BytesIO()
+        Image.new(mode, size, color).save(image_file, format="PNG")
+        return image_file.getvalue()
+
+    return encode
+
+
+@pytest.fixture
+def red_png(encode_png):
+    return encode_png((255, 0, 0))
+
+
+@pytest.fixture
+def data_url():
+    """Wraps image bytes in a base64 data URL."""
+
+    def create(data: bytes, mime_type: str = "png") -> str:
+        return f"data:image/{mime_type};base64,{base64.b64encode(data).decode()}"
+
+    return create
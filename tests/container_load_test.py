@@ -0,0 +1,92 @@
+"""Tests the load stages of the ExLlamaV2 container without weights."""
+
+import asyncio
+import pathlib
+import pytest
+import threading
+from types import SimpleNamespace
+
+pytest.importorskip("exllamav2")
+
+# The backend is imported through common.model, like the server does
+from common import model  # noqa: E402, F401
+from backends.exllamav2 import model as model_module  # noqa: E402
+from backends.exllamav2.model import ExllamaV2Container  # noqa: E402
+
+
+def create_container(monkeypatch, load_model_sync, load_engine_vocabulary):
+    """Creates a container whose tokenizer and weights load instantly."""
+
+    container = ExllamaV2Container.__new__(ExllamaV2Container)
+    container.model_dir = pathlib.Path("model")
+    container.load_lock = asyncio.Lock()
+    container.load_condition = asyncio.Condition()
+
+    async def wait_for_jobs(skip_wait=False):
+        pass
+
+    async def create_generator():
+        pass
+
+    def load_tokenizer_sync():
+        container.tokenizer = SimpleNamespace()
+
+    container.wait_for_jobs = wait_for_jobs
+    container.create_generator = create_generator
+    container.load_tokenizer_sync = load_tokenizer_sync
+    container.load_model_sync = load_model_sync
+
+    monkeypatch.setattr(model_module, "load_engine_vocabulary", load_engine_vocabulary)
+    monkeypatch.setattr(model_module, "GrammarCache", lambda *args: args[2])
+
+    return container
+
+
+def test_vocabulary_loads_without_module_progress(monkeypatch):
+    async def main():
+        container = create_container(
+            monkeypatch, lambda progress_callback: iter(()), lambda *args: "vocab"
+        )
+
+        values = [value async for value in container.load_gen()]
+
+        # Only the vocabulary stage reports progress
+        assert values == [(0, 1), (1, 1)]
+        assert container.grammar_cache == "vocab"
+        assert container.model_loaded
+
+    asyncio.run(main())
+
+
+def test_failed_load_stops_the_vocabulary(monkeypatch):
+    vocabulary_started = threading.Event()
+    release_vocabulary = threading.Event()
+
+    def load_engine_vocabulary(*args):
+        vocabulary_started.set()
+        release_vocabulary.wait(5)
+        raise RuntimeError("Vocabulary failed")
+
+    def load_model_sync(progress_callback):
+        vocabulary_started.wait(5)
+        yield 0, 2
+        raise RuntimeError("Out of memory")
+
+    async def main():
+        container = create_container(
+            monkeypatch, load_model_sync, load_engine_vocabulary
+        )
+
+        with pytest.raises(RuntimeError, match="Out of memory"):
+            async for _ in container.load_gen():
+                pass
+
+        # No vocabulary task is left behind, and the lock is free again
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        assert not container.load_lock.locked()
+        assert not container.model_loaded
+
+        # Let the cancelled thread finish before the loop closes
+        release_vocabulary.set()
+
+    asyncio.run(main())
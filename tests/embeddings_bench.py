@@ -0,0 +1,137 @@
+"""
+Benchmark embedding responses and batching on the CPU.
+
+Run from the repository root with python -m tests.embeddings_bench
+
+Pass the folder of a small sentence-transformer, like all-MiniLM-L6-v2,
+to also benchmark batching and caching with infinity-emb installed.
+"""
+
+import asyncio
+import pathlib
+import sys
+import time
+import numpy as np
+from fastapi import FastAPI, Response
+
+from endpoints.OAI.types.embedding import (
+    EmbeddingObject,
+    EmbeddingsResponse,
+    UsageInfo,
+)
+from endpoints.OAI.utils.embeddings import (
+    encode_embeddings_response,
+    float_list_to_base64,
+)
+
+NUMBER = 20
+
+embeddings = np.random.default_rng(0).standard_normal((64, 1024)).astype(np.float32)
+app = FastAPI()
+
+
+@app.get("/model/{encoding_format}")
+async def model_response(encoding_format: str) -> EmbeddingsResponse:
+    """The previous response, serialized by FastAPI."""
+
+    return EmbeddingsResponse(
+        data=[
+            EmbeddingObject(
+                embedding=(
+                    float_list_to_base64(embedding)
+                    if encoding_format == "base64"
+                    else embedding.tolist()
+                ),
+                index=index,
+            )
+            for index, embedding in enumerate(embeddings)
+        ],
+        model="model",
+        usage=UsageInfo(prompt_tokens=1, total_tokens=1),
+    )
+
+
+@app.get("/bulk/{encoding_format}")
+async def bulk_response(encoding_format: str) -> EmbeddingsResponse:
+    content = encode_embeddings_response(embeddings, encoding_format, "model", 1)
+    return Response(content=content, media_type="application/json")
+
+
+async def get(path: str) -> bytes:
+    """Calls the app without a server."""
+
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [],
+        "server": ("test", 80),
+        "client": ("test", 1),
+        "root_path": "",
+    }
+    await app(scope, receive, send)
+
+    return b"".join(body)
+
+
+async def bench_responses():
+    for encoding_format in ("float", "base64"):
+        for name in ("model", "bulk"):
+            path = f"/{name}/{encoding_format}"
+            size = len(await get(path))
+
+            start = time.perf_counter()
+            for _ in range(NUMBER):
+                await get(path)
+            seconds = (time.perf_counter() - start) / NUMBER
+
+            print(
+                f"{encoding_format:<7} {name:<6} {seconds * 1e3:>8,.2f} ms/response "
+                f"{size / 1024:>8,.1f} KiB"
+            )
+
+
+async def bench_batching(model_path: pathlib.Path):
+    from backends.infinity.model import InfinityContainer
+
+    sentences = [f"Sentence number {i} about a topic." for i in range(256)]
+
+    for batch_window in (0.0, 0.005):
+        container = InfinityContainer(model_path)
+        await container.load(embeddings_batch_window=batch_window)
+
+        try:
+            for label in ("single", "cached"):
+                start = time.perf_counter()
+                await asyncio.gather(
+                    *(container.generate([sentence]) for sentence in sentences)
+                )
+                seconds = time.perf_counter() - start
+
+                print(
+                    f"window {batch_window:<6} {label:<7} "
+                    f"{len(sentences) / seconds:>8,.1f} sentences/s "
+                    f"{container.batcher.stats()}"
+                )
+        finally:
+            await container.unload()
+
+
+asyncio.run(bench_responses())
+
+if len(sys.argv) > 1:
+    asyncio.run(bench_batching(pathlib.Path(sys.argv[1])))
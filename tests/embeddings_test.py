@@ -0,0 +1,133 @@
+"""Tests embedding batching, caching and serialization."""
+
+import asyncio
+import json
+import numpy as np
+import pytest
+
+from backends.infinity.batching import EmbeddingBatcher
+from endpoints.OAI.types.embedding import (
+    EmbeddingObject,
+    EmbeddingsResponse,
+    UsageInfo,
+)
+from endpoints.OAI.utils.embeddings import (
+    encode_embeddings_response,
+    float_list_to_base64,
+)
+
+
+class FakeEngine:
+    """Embeds a sentence as its length and records the batches."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batches = []
+
+    async def embed(self, sentences):
+        self.batches.append(list(sentences))
+        await asyncio.sleep(self.delay)
+
+        if "fail" in sentences:
+            raise RuntimeError("Engine failed")
+
+        embeddings = [
+            np.full(4, len(sentence), dtype=np.float32) for sentence in sentences
+        ]
+        return embeddings, sum(len(sentence) for sentence in sentences)
+
+
+def test_concurrent_requests_are_batched():
+    async def main():
+        engine = FakeEngine(delay=0.01)
+        batcher = EmbeddingBatcher(engine, "model", 4, 0.01, 1024)
+
+        results = await asyncio.gather(
+            batcher.embed(["a", "bb"]),
+            batcher.embed(["ccc", "a", "dddd", "eeeee"]),
+            batcher.embed(["ffffff"]),
+        )
+
+        # The first four unique sentences fill a batch, the rest wait
+        assert engine.batches == [["a", "bb", "ccc", "dddd"], ["eeeee", "ffffff"]]
+        assert [result[:, 0].tolist() for result in results] == [
+            [1, 2],
+            [3, 1, 4, 5],
+            [6],
+        ]
+
+        # Cached sentences aren't embedded again
+        await batcher.embed(["bb", "ccc"])
+        assert len(engine.batches) == 2
+        assert batcher.stats()["hits"] == 2
+        assert batcher.stats()["avg_batch_size"] == 3
+
+        await batcher.close()
+
+    asyncio.run(main())
+
+
+def test_cache_is_bounded_by_bytes():
+    async def main():
+        engine = FakeEngine()
+
+        # Room for two embeddings of 16 bytes
+        batcher = EmbeddingBatcher(engine, "model", 8, 0.0, 32)
+        for sentence in ("a", "b", "c", "a"):
+            await batcher.embed([sentence])
+
+        assert len(engine.batches) == 4
+        assert batcher.stats()["evictions"] == 2
+        assert batcher.stats()["bytes"] == 32
+
+        # Other models don't share embeddings
+        other_batcher = EmbeddingBatcher(engine, "other", 8, 0.0, 32)
+        await other_batcher.embed(["a"])
+        assert len(engine.batches) == 5
+
+    asyncio.run(main())
+
+
+def test_errors_reach_every_request():
+    async def main():
+        engine = FakeEngine()
+        batcher = EmbeddingBatcher(engine, "model", 8, 0.0, 1024)
+
+        results = await asyncio.gather(
+            batcher.embed(["fail"]),
+            batcher.embed(["ok", "fail"]),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert not batcher.pending
+
+        # Failures aren't cached
+        assert (await batcher.embed(["ok"]))[0, 0] == 2
+        assert (await batcher.embed([])).shape == (0, 0)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("encoding_format", ["float", "base64"])
+def test_response_matches_model(encoding_format):
+    embeddings = np.random.default_rng(0).standard_normal((3, 5)).astype(np.float32)
+
+    content = encode_embeddings_response(embeddings, encoding_format, 'm"1', 12)
+    expected = EmbeddingsResponse(
+        data=[
+            EmbeddingObject(
+                embedding=(
+                    float_list_to_base64(embedding)
+                    if encoding_format == "base64"
+                    else embedding.tolist()
+                ),
+                index=index,
+            )
+            for index, embedding in enumerate(embeddings)
+        ],
+        model='m"1',
+        usage=UsageInfo(prompt_tokens=12, total_tokens=12),
+    )
+
+    assert json.loads(content) == json.loads(expected.model_dump_json())
+    assert content == expected.model_dump_json()
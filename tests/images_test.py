@@ -0,0 +1,179 @@
+"""Tests image fetching against a local HTTP server."""
+
+import asyncio
+import io
+import pytest
+from aiohttp import web
+from fastapi import HTTPException
+from PIL import Image
+
+from common.images import ImageFetcher, ImagePreprocessPolicy, decode_image
+from common.tabby_config import config
+
+
+async def start_server(body: bytes, delay: float = 0.0):
+    """Serves an image and records concurrent requests and connections."""
+
+    state = {"active": 0, "max_active": 0, "requests": 0, "connections": set()}
+
+    async def image(request: web.Request):
+        state["requests"] += 1
+        state["active"] += 1
+        state["max_active"] = max(state["max_active"], state["active"])
+        state["connections"].add(request.transport.get_extra_info("peername"))
+
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            state["active"] -= 1
+
+        return web.Response(body=body, content_type="image/png")
+
+    async def chunked(request: web.Request):
+        # No content length, so the size is only known while reading
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await response.write(body)
+        await response.write_eof()
+
+        return response
+
+    async def missing(_request: web.Request):
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get("/image", image)
+    app.router.add_get("/chunked", chunked)
+    app.router.add_get("/missing", missing)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", state
+
+
+def run_with_server(test, body: bytes, delay: float = 0.0):
+    async def main():
+        runner, base_url, state = await start_server(body, delay)
+        fetcher = ImageFetcher()
+
+        try:
+            await test(fetcher, base_url, state)
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def test_images_are_fetched_concurrently(monkeypatch, red_png):
+    monkeypatch.setattr(config.network, "image_fetch_concurrency", 3)
+
+    async def test(fetcher, base_url, state):
+        images = await fetcher.get_images([f"{base_url}/image?{i}" for i in range(8)])
+
+        assert [image.getpixel((0, 0)) for image in images] == [(255, 0, 0)] * 8
+        assert state["max_active"] == 3
+
+        # Connections are kept for later requests
+        await fetcher.get_images([f"{base_url}/image"])
+        assert state["requests"] == 9
+        assert len(state["connections"]) == 3
+
+    run_with_server(test, red_png, delay=0.05)
+
+
+def test_byte_limit_is_per_request(monkeypatch, red_png):
+    monkeypatch.setattr(config.network, "image_fetch_max_bytes", len(red_png) * 2)
+
+    async def test(fetcher, base_url, _state):
+        for path in ("image", "chunked"):
+            with pytest.raises(HTTPException) as exc_info:
+                await fetcher.fetch_all([f"{base_url}/{path}?{i}" for i in range(3)])
+
+            assert exc_info.value.status_code == 400
+
+        # Each request has its own budget
+        assert len(await fetcher.fetch_all([f"{base_url}/chunked"] * 2)) == 2
+
+    run_with_server(test, red_png)
+
+
+def test_fetch_errors(monkeypatch, red_png):
+    monkeypatch.setattr(config.network, "image_fetch_timeout", 0.05)
+
+    async def test(fetcher, base_url, _state):
+        for url in (f"{base_url}/missing", f"{base_url}/image", "data:image/png;x"):
+            with pytest.raises(HTTPException):
+                await fetcher.get_images([url])
+
+        monkeypatch.setattr(config.network, "disable_fetch_requests", True)
+        with pytest.raises(HTTPException):
+            await fetcher.get_images([f"{base_url}/chunked"])
+
+    run_with_server(test, red_png, delay=1.0)
+
+
+def test_data_urls_are_decoded(encode_png, red_png, data_url):
+    async def main():
+        fetcher = ImageFetcher()
+        urls = [data_url(red_png), data_url(encode_png((0, 0, 0, 0), "RGBA"))]
+
+        red, clear = await fetcher.get_images(urls)
+        assert red.mode == clear.mode == "RGB"
+
+        # Transparent pixels become white
+        assert clear.getpixel((0, 0)) == (255, 255, 255)
+
+        with pytest.raises(HTTPException):
+            await fetcher.get_images(["data:image/png;base64,bm90IGFuIGltYWdl"])
+
+    asyncio.run(main())
+
+
+def encode_jpeg(size, exif_orientation: int = 1):
+    image_file = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = exif_orientation
+    Image.new("RGB", size, (0, 255, 0)).save(image_file, format="JPEG", exif=exif)
+    return image_file.getvalue()
+
+
+def test_policy_sizes():
+    policy = ImagePreprocessPolicy(max_pixels=1000 * 1000, max_side=1500)
+
+    assert policy.get_size(800, 600) == (800, 600)
+    assert policy.get_size(3000, 1000) == (1500, 500)
+    assert policy.get_size(4000, 3000) == (1154, 866)
+    assert policy.get_size(100000, 1) == (1500, 1)
+
+    # Requests can only lower the limits
+    restricted = policy.restrict(max_pixels=2000 * 2000, max_side=1000)
+    assert restricted.key() == (1000 * 1000, 1000, "bicubic")
+    assert policy.restrict(resample="lanczos").key() == (1000000, 1500, "lanczos")
+    assert ImagePreprocessPolicy().restrict(max_side=64).key() == (None, 64, "bicubic")
+
+
+def test_images_are_downscaled_upright(encode_png, red_png):
+    policy = ImagePreprocessPolicy(max_side=500)
+
+    image = decode_image(encode_jpeg((2000, 1000)), policy)
+    assert image.size == (500, 250)
+    assert image.mode == "RGB"
+
+    # Rotated by EXIF before the limits apply
+    image = decode_image(encode_jpeg((2000, 1000), exif_orientation=6), policy)
+    assert image.size == (250, 500)
+
+    # PNGs aren't draft decoded, but are resized the same
+    png = encode_png((0, 0, 255, 128), "RGBA", size=(1000, 1000))
+    image = decode_image(png, policy.restrict(resample="nearest"))
+    assert image.size == (500, 500)
+    assert image.getpixel((0, 0)) == (127, 127, 255)
+
+    # Small images are unchanged
+    assert decode_image(red_png, policy).size == (8, 8)
@@ -0,0 +1,66 @@
+"""Tests loading a model with config defaults against a fake container."""
+
+import asyncio
+import pathlib
+
+from common import model
+from common.config_models import ModelConfig
+from endpoints.OAI.types.tools import tool_call_schema
+
+
+class FakeContainer:
+    """Loads instantly and records its kwargs and warmed schemas."""
+
+    use_vision = False
+    draft_config = None
+    max_batch_size = 4
+
+    def __init__(self, kwargs: dict):
+        self.kwargs = kwargs
+        self.warmed = []
+
+    @classmethod
+    async def create(cls, model_directory: pathlib.Path, quiet: bool, **kwargs):
+        return cls(kwargs)
+
+    async def load_gen(self, progress_callback, **kwargs):
+        for module in range(3):
+            yield module, 2
+
+    async def warm_grammar_cache(self, schemas):
+        self.warmed.extend(schemas)
+
+
+def test_config_schemas_reach_the_container(monkeypatch):
+    monkeypatch.setattr(model, "ExllamaV2Container", FakeContainer, raising=False)
+    monkeypatch.setattr(model, "container", None, raising=False)
+    monkeypatch.setattr(model, "configure_scheduler", lambda max_batch_size: None)
+
+    # Like startup, the config dump always holds its grammar_schemas list
+    kwargs = ModelConfig(grammar_schemas=["schema.json"]).model_dump(exclude_none=True)
+
+    asyncio.run(
+        model.load_model(
+            pathlib.Path("model"), warm_schemas=[tool_call_schema], **kwargs
+        )
+    )
+
+    assert model.container.kwargs["grammar_schemas"] == ["schema.json"]
+    assert model.container.warmed == [tool_call_schema]
+
+
+def test_default_config_loads(monkeypatch):
+    monkeypatch.setattr(model, "ExllamaV2Container", FakeContainer, raising=False)
+    monkeypatch.setattr(model, "container", None, raising=False)
+    monkeypatch.setattr(model, "configure_scheduler", lambda max_batch_size: None)
+
+    async def main():
+        load_status = model.load_model_gen(
+            pathlib.Path("model"),
+            warm_schemas=[tool_call_schema],
+            **ModelConfig().model_dump(exclude_none=True),
+        )
+        return [model_type async for _, _, model_type in load_status]
+
+    assert asyncio.run(main()) == ["model", "model", "model"]
+    assert model.container.kwargs["grammar_schemas"] == []
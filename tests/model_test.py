@@ -1,6 +1,7 @@
 """Test the model container."""
 
 from backends.exllamav2.model import ModelContainer
+from common.sampling import GenerationParams
 
 
 def progress(module, modules):
@@ -21,7 +22,9 @@ def test_load_gen(model_path):
 def test_generate_gen(model_path):
     """Test generating from a model."""
     container = ModelContainer(model_path)
-    generator = container.generate_gen("Once upon a tim", token_healing=True)
+    generator = container.generate_gen(
+        "Once upon a tim", "test", GenerationParams(token_healing=True)
+    )
     for chunk in generator:
         print(chunk, end="")
     container.unload()
@@ -37,7 +40,7 @@ def test_generate(model_path):
         "All work and no play makes turbo a derpy cat.\nAll"
     )
     response = model_container.generate(
-        prompt, top_k=1, max_new_tokens=1000, stream_interval=0.5
+        prompt, "test", GenerationParams(top_k=1, max_tokens=1000)
     )
     print(response)
 
@@ -0,0 +1,78 @@
+"""Tests the client disconnect middleware with a raw ASGI app."""
+
+import asyncio
+
+from common.networking import DisconnectMiddleware
+
+
+def create_channel():
+    """Returns a receive channel and a function to disconnect the client."""
+
+    messages = asyncio.Queue()
+    messages.put_nowait({"type": "http.request", "body": b"{}", "more_body": False})
+
+    async def receive():
+        return await messages.get()
+
+    def disconnect():
+        messages.put_nowait({"type": "http.disconnect"})
+
+    return receive, disconnect
+
+
+async def send(_message):
+    pass
+
+
+def test_disconnect_sets_abort_event():
+    async def main():
+        abort_event = asyncio.Event()
+        body = []
+
+        async def app(scope, receive, _send):
+            scope["request_disconnect"].watch(abort_event)
+            body.append((await receive())["body"])
+
+            await abort_event.wait()
+
+            # The app can still listen for the disconnect itself
+            assert (await receive())["type"] == "http.disconnect"
+            assert (await receive())["type"] == "http.disconnect"
+
+        receive, disconnect = create_channel()
+        app_task = asyncio.create_task(
+            DisconnectMiddleware(app)({"type": "http"}, receive, send)
+        )
+        await asyncio.sleep(0)
+
+        assert not abort_event.is_set()
+
+        disconnect()
+        await asyncio.wait_for(app_task, 1)
+
+        assert body == [b"{}"]
+
+    asyncio.run(main())
+
+
+def test_finished_response_is_not_a_disconnect():
+    async def main():
+        disconnects = []
+
+        async def app(scope, receive, send):
+            disconnects.append(scope["request_disconnect"])
+
+            await receive()
+            await send({"type": "http.response.start", "status": 200})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+            # Servers report a disconnect once the response is sent
+            disconnect()
+            assert (await receive())["type"] == "http.disconnect"
+
+        receive, disconnect = create_channel()
+        await DisconnectMiddleware(app)({"type": "http"}, receive, send)
+
+        assert not disconnects[0].is_set()
+
+    asyncio.run(main())
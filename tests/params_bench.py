@@ -0,0 +1,58 @@
+"""
+Benchmark passing generation params, before and after GenerationParams.
+
+Run from the repository root with python -m tests.params_bench
+"""
+
+import timeit
+import tracemalloc
+
+from common.sampling import GenerationParams
+from endpoints.OAI.types.chat_completion import ChatCompletionRequest
+
+NUMBER = 2_000
+
+# A long conversation with tools, which model_dump copies for every call
+data = ChatCompletionRequest(
+    messages=[
+        {"role": "user" if i % 2 else "assistant", "content": "word " * 200}
+        for i in range(64)
+    ],
+    tools=[
+        {
+            "type": "function",
+            "function": {
+                "name": f"tool_{i}",
+                "description": "A tool. " * 20,
+                "parameters": {
+                    "type": "object",
+                    "properties": {"arg": {"type": "string"}},
+                },
+            },
+        }
+        for i in range(16)
+    ],
+    temperature=0.7,
+    top_p=0.9,
+    stop=["</s>", "<|eot_id|>"],
+    max_tokens=256,
+)
+
+benchmarks = {
+    "model_dump": lambda: data.model_dump(exclude={"prompt"}),
+    "GenerationParams": lambda: GenerationParams.from_request(data),
+}
+
+for name, func in benchmarks.items():
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+
+    tracemalloc.start()
+    result = func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    print(
+        f"{name:<18} {seconds / NUMBER * 1e6:>10,.1f} us/request "
+        f"{size / 1024:>10,.1f} KiB retained {peak / 1024:>10,.1f} KiB peak"
+    )
@@ -0,0 +1,38 @@
+"""
+Benchmark request validation with the sample override preset loaded.
+
+Run from the repository root with python -m tests.sampling_bench
+"""
+
+import asyncio
+import timeit
+
+from common import sampling
+from endpoints.OAI.types.chat_completion import ChatCompletionRequest
+from endpoints.OAI.types.completion import CompletionRequest
+
+NUMBER = 2_000
+
+asyncio.run(sampling.overrides_from_file("sample_preset"))
+
+# Forced and additive overrides are applied after every request
+overrides = dict(sampling.overrides_container.overrides)
+overrides["stop"] = {"override": ["</s>"], "additive": True}
+overrides["temperature"] = {"override": 0.8, "force": True}
+sampling.overrides_from_dict(overrides)
+
+completion = {"prompt": "Once upon a time", "max_tokens": 64, "stop": ["\n"]}
+chat = {
+    "messages": [{"role": "user", "content": "Hello"}],
+    "temperature": 0.7,
+    "top_p": 0.9,
+}
+
+benchmarks = {
+    "completion": lambda: CompletionRequest.model_validate(completion),
+    "chat completion": lambda: ChatCompletionRequest.model_validate(chat),
+}
+
+for name, func in benchmarks.items():
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+    print(f"{name:<18} {NUMBER / seconds:>10,.0f} requests/s")
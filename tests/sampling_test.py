@@ -0,0 +1,75 @@
+"""Tests the generation params built from requests."""
+
+import pytest
+
+from common import sampling
+from common.sampling import GenerationParams
+from endpoints.Kobold.types.generation import GenerateRequest
+from endpoints.OAI.types.chat_completion import ChatCompletionRequest
+
+
+def test_params_match_model_dump():
+    data = ChatCompletionRequest(
+        messages=[{"role": "user", "content": "Hello"}],
+        temperature=0.7,
+        stop=["</s>"],
+        logit_bias={1: -100},
+        n=2,
+        stream=True,
+    )
+    params = GenerationParams.from_request(data)
+    dumped = data.model_dump(exclude={"prompt"})
+
+    for key in GenerationParams.__slots__:
+        assert getattr(params, key) == dumped.get(key)
+
+
+def test_kobold_params():
+    data = GenerateRequest(prompt="Hi", temperature=1.0, dynatemp_range=0.5)
+    params = GenerationParams.from_request(data)
+
+    assert (params.min_temp, params.max_temp) == (0.5, 1.5)
+    assert params.n is None
+
+
+def test_params_are_read_only():
+    params = GenerationParams(temperature=0.5, n=2)
+
+    with pytest.raises(AttributeError):
+        params.temperature = 1.0
+
+    replaced = params.replace(n=1, json_schema={"type": "object"})
+
+    assert (replaced.temperature, replaced.n) == (0.5, 1)
+    assert replaced.json_schema == {"type": "object"}
+    assert params.n == 2 and params.json_schema is None
+
+
+@pytest.fixture
+def overrides():
+    yield sampling.overrides_from_dict
+    sampling.overrides_from_dict({})
+
+
+def test_override_defaults(overrides):
+    overrides(
+        {
+            "top_k": {"override": 40},
+            "stop": {"override": ["</s>"], "additive": True},
+            "banned_strings": {"override": ["a"]},
+            "temperature": {"override": 0.5, "force": True},
+            "min_p": {"override": 0.0, "force": True},
+        }
+    )
+
+    data = GenerateRequest(prompt="Hi", stop=["\n"], temperature=2.0, min_p=0.1)
+    assert data.top_k == 40
+    assert data.stop == ["</s>", "\n"]
+    assert data.temperature == 0.5
+
+    # Falsy values are defaults, but aren't forced
+    assert data.min_p == 0.1
+
+    # Every request gets its own copy of list defaults
+    data.banned_strings.append("b")
+    assert GenerateRequest(prompt="Hi").banned_strings == ["a"]
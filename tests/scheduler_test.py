@@ -0,0 +1,382 @@
+"""Tests the request scheduler against a fake model container on CPU."""
+
+import asyncio
+import pytest
+import time
+from fastapi import HTTPException
+
+from common import scheduler as scheduler_module
+from common.rate_limit import KeyAccount, RateLimitExceeded
+from common.scheduler import (
+    RequestScheduler,
+    SchedulerRejection,
+    SchedulerTicket,
+    check_admission,
+)
+
+
+class FakeContainer:
+    """Streams a fixed number of chunks and records job start order."""
+
+    def __init__(self, chunk_delay: float = 0.01):
+        self.chunk_delay = chunk_delay
+        self.started = []
+        self.release_event = asyncio.Event()
+
+    async def generate_gen(self, prompt: str, request_id: str, max_tokens: int = 4):
+        self.started.append(request_id)
+
+        for _ in range(max_tokens):
+            await asyncio.sleep(self.chunk_delay)
+            yield {"text": "a"}
+
+        yield {"finish_reason": "stop"}
+
+    async def blocking_gen(self, request_id: str):
+        self.started.append(request_id)
+        await self.release_event.wait()
+        yield {"finish_reason": "stop"}
+
+
+async def run_request(
+    scheduler: RequestScheduler, container: FakeContainer, ticket: SchedulerTicket
+):
+    await scheduler.acquire(ticket)
+    try:
+        return [
+            generation
+            async for generation in container.generate_gen("", ticket.request_id)
+        ]
+    finally:
+        scheduler.release(ticket)
+
+
+async def hold_slot(
+    scheduler: RequestScheduler, container: FakeContainer, ticket: SchedulerTicket
+):
+    await scheduler.acquire(ticket)
+    try:
+        async for _ in container.blocking_gen(ticket.request_id):
+            pass
+    finally:
+        scheduler.release(ticket)
+
+
+def test_interactive_before_batch():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1)
+        container = FakeContainer()
+
+        holder = asyncio.create_task(
+            hold_slot(scheduler, container, SchedulerTicket("hold", "batch", 10))
+        )
+        await asyncio.sleep(0)
+
+        batch = asyncio.create_task(
+            run_request(scheduler, container, SchedulerTicket("batch", "batch", 10))
+        )
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(
+            run_request(
+                scheduler, container, SchedulerTicket("interactive", "interactive", 10)
+            )
+        )
+        await asyncio.sleep(0)
+
+        assert scheduler.stats()["queued_batch"] == 1
+        assert scheduler.stats()["queued_interactive"] == 1
+
+        container.release_event.set()
+        await asyncio.gather(holder, batch, interactive)
+
+        assert container.started == ["hold", "interactive", "batch"]
+        assert scheduler.active_jobs == 0
+
+    asyncio.run(main())
+
+
+def test_jobs_share_capacity():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=4)
+        container = FakeContainer()
+
+        tickets = [SchedulerTicket(str(i), "interactive", 10, jobs=2) for i in range(3)]
+        tasks = [
+            asyncio.create_task(run_request(scheduler, container, ticket))
+            for ticket in tickets
+        ]
+        await asyncio.sleep(0)
+
+        # Two requests of two jobs each fill the generator
+        assert scheduler.active_jobs == 4
+        assert scheduler.stats()["queued_interactive"] == 1
+
+        results = await asyncio.gather(*tasks)
+        assert all(result[-1]["finish_reason"] == "stop" for result in results)
+        assert scheduler.active_jobs == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_with_429():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1, max_queued=1)
+        container = FakeContainer()
+
+        holder = asyncio.create_task(
+            hold_slot(scheduler, container, SchedulerTicket("hold", "batch", 10))
+        )
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(
+            run_request(scheduler, container, SchedulerTicket("queued", "batch", 10))
+        )
+        await asyncio.sleep(0)
+
+        with pytest.raises(SchedulerRejection) as exc_info:
+            scheduler.check(SchedulerTicket("rejected", "batch", 10))
+
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.retry_after >= 1
+
+        # Interactive requests have their own queue
+        scheduler.check(SchedulerTicket("interactive", "interactive", 10))
+
+        container.release_event.set()
+        await asyncio.gather(holder, queued)
+        assert scheduler.stats()["rejected_full"] == 1
+
+    asyncio.run(main())
+
+
+def test_long_wait_rejects_with_503():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1, max_queue_wait=0.01)
+        container = FakeContainer(chunk_delay=0.02)
+
+        # Measure throughput with one finished request
+        await run_request(scheduler, container, SchedulerTicket("first", "batch", 10))
+        assert scheduler.throughput() is not None
+
+        holder = asyncio.create_task(
+            hold_slot(scheduler, container, SchedulerTicket("hold", "batch", 10_000))
+        )
+        await asyncio.sleep(0)
+
+        assert scheduler.estimate_wait("interactive") > 0.01
+
+        with pytest.raises(SchedulerRejection) as exc_info:
+            scheduler.check(SchedulerTicket("rejected", "interactive", 10))
+
+        assert exc_info.value.status_code == 503
+
+        container.release_event.set()
+        await holder
+
+        # An idle generator admits right away
+        assert scheduler.estimate_wait("interactive") == 0.0
+
+    asyncio.run(main())
+
+
+def test_cancel_while_queued():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1)
+        container = FakeContainer()
+
+        holder = asyncio.create_task(
+            hold_slot(scheduler, container, SchedulerTicket("hold", "batch", 10))
+        )
+        await asyncio.sleep(0)
+
+        cancelled = asyncio.create_task(
+            run_request(
+                scheduler, container, SchedulerTicket("cancelled", "interactive", 10)
+            )
+        )
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(
+            run_request(scheduler, container, SchedulerTicket("waiting", "batch", 10))
+        )
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        assert scheduler.stats()["queued_interactive"] == 0
+        assert scheduler.queued_budget["interactive"] == 0
+
+        container.release_event.set()
+        await asyncio.gather(holder, waiting)
+
+        assert container.started == ["hold", "waiting"]
+        assert scheduler.active_jobs == 0
+
+    asyncio.run(main())
+
+
+def test_check_admission_sets_retry_after(monkeypatch):
+    scheduler = RequestScheduler(max_active_jobs=1, max_queued=1)
+    monkeypatch.setattr(scheduler_module, "scheduler", scheduler)
+
+    # Fill the generator and the batch queue
+    scheduler._admit(SchedulerTicket("active", "batch", 10))
+    scheduler.queues["batch"].append(SchedulerTicket("queued", "batch", 10))
+
+    with pytest.raises(HTTPException) as exc_info:
+        check_admission(SchedulerTicket("rejected", "batch", 10))
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers["Retry-After"] == "1"
+
+
+def test_scheduler_rejections_keep_rate_budget(monkeypatch):
+    scheduler = RequestScheduler(max_active_jobs=1, max_queued=1)
+    monkeypatch.setattr(scheduler_module, "scheduler", scheduler)
+
+    scheduler._admit(SchedulerTicket("active", "batch", 10))
+    scheduler.queues["batch"].append(SchedulerTicket("queued", "batch", 10))
+
+    account = KeyAccount("key", "api", {"requests_per_second": 1})
+    for _ in range(3):
+        with pytest.raises(HTTPException) as exc_info:
+            check_admission(SchedulerTicket("retry", "batch", 10, account=account))
+
+        assert exc_info.value.status_code == 429
+
+    assert account.requests == 0 and account.rejected == 0
+
+    # The key can still send a request once the server has room
+    scheduler.queues["batch"].clear()
+    check_admission(SchedulerTicket("retry", "interactive", 10, account=account))
+    assert account.requests == 1
+
+
+def create_account(key_id: str, **limits):
+    return KeyAccount(key_id, "api", limits)
+
+
+def test_weighted_fair_share():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1)
+        container = FakeContainer()
+        heavy = create_account("heavy")
+        light = create_account("light", weight=2.0)
+
+        holder = asyncio.create_task(
+            hold_slot(
+                scheduler,
+                container,
+                SchedulerTicket("hold", "interactive", 10, account=heavy),
+            )
+        )
+        await asyncio.sleep(0)
+
+        tasks = []
+        for request_id, account in (
+            ("heavy-1", heavy),
+            ("heavy-2", heavy),
+            ("light-1", light),
+        ):
+            ticket = SchedulerTicket(request_id, "interactive", 10, account=account)
+            tasks.append(asyncio.create_task(run_request(scheduler, container, ticket)))
+            await asyncio.sleep(0)
+
+        container.release_event.set()
+        await asyncio.gather(holder, *tasks)
+
+        # The light key hasn't been served, so it goes before the heavy key's backlog
+        assert container.started == ["hold", "light-1", "heavy-1", "heavy-2"]
+        assert heavy.active_jobs == 0 and light.active_jobs == 0
+
+    asyncio.run(main())
+
+
+def test_key_concurrent_jobs():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=4)
+        container = FakeContainer()
+        limited = create_account("limited", concurrent_jobs=1)
+
+        holder = asyncio.create_task(
+            hold_slot(
+                scheduler,
+                container,
+                SchedulerTicket("hold", "interactive", 10, account=limited),
+            )
+        )
+        await asyncio.sleep(0)
+
+        limited_task = asyncio.create_task(
+            run_request(
+                scheduler,
+                container,
+                SchedulerTicket("limited", "interactive", 10, account=limited),
+            )
+        )
+        await asyncio.sleep(0)
+
+        # Another key isn't blocked by the limited key's queued request
+        other = SchedulerTicket("other", "interactive", 10, account=create_account("o"))
+        await run_request(scheduler, container, other)
+        assert container.started == ["hold", "other"]
+
+        container.release_event.set()
+        await asyncio.gather(holder, limited_task)
+        assert container.started == ["hold", "other", "limited"]
+
+    asyncio.run(main())
+
+
+def test_key_rate_limits():
+    account = create_account("key", requests_per_second=1, tokens_per_minute=100)
+
+    account.check()
+    with pytest.raises(RateLimitExceeded):
+        account.check()
+
+    assert account.rejected == 1
+
+    # Usage over the token budget blocks the key until it refills
+    account.request_bucket.level = 1.0
+    account.record_usage(80, 40)
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        account.check()
+
+    assert "Token rate limit" in exc_info.value.message
+    assert exc_info.value.retry_after >= 1
+
+
+def test_deadline_while_queued():
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1)
+        container = FakeContainer()
+
+        holder = asyncio.create_task(
+            hold_slot(scheduler, container, SchedulerTicket("hold", "batch", 10))
+        )
+        await asyncio.sleep(0)
+
+        # A deadline that already passed is rejected up front
+        with pytest.raises(SchedulerRejection) as exc_info:
+            scheduler.check(
+                SchedulerTicket("late", "batch", 10, deadline=time.time() - 1)
+            )
+
+        assert exc_info.value.status_code == 504
+
+        expiring = SchedulerTicket("expiring", "batch", 10, deadline=time.time() + 0.05)
+        with pytest.raises(SchedulerRejection) as exc_info:
+            await run_request(scheduler, container, expiring)
+
+        assert exc_info.value.status_code == 504
+        assert scheduler.stats()["queued_batch"] == 0
+        assert scheduler.queued_budget["batch"] == 0
+
+        container.release_event.set()
+        await holder
+
+        assert container.started == ["hold"]
+        assert scheduler.stats()["rejected_deadline"] == 2
+
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+"""Tests speculation mode admission."""
+
+import asyncio
+import pytest
+import time
+from types import SimpleNamespace
+
+pytest.importorskip("exllamav2")
+
+from backends.exllamav2.speculation import SpeculationScheduler  # noqa: E402
+from common.scheduler import SchedulerRejection  # noqa: E402
+
+
+def create_scheduler(**kwargs):
+    """Creates a scheduler around a generator stub without a draft model."""
+
+    inner_generator = SimpleNamespace(
+        draft_model=None,
+        iterate_ngram_gen=lambda results: None,
+        use_ngram_draft=False,
+        num_draft_tokens=0,
+        active_jobs=[],
+    )
+
+    return SpeculationScheduler(SimpleNamespace(generator=inner_generator), **kwargs)
+
+
+def test_default_jobs_pass_waiting_speculative_jobs():
+    async def main():
+        speculation = create_scheduler(max_mode_wait=0.05)
+        assert await speculation.acquire("none") == "none"
+
+        ngram_task = asyncio.create_task(speculation.acquire("ngram"))
+        await asyncio.sleep(0)
+        assert not ngram_task.done()
+
+        # Later default jobs aren't held back by the mode switch
+        assert await speculation.acquire("none") == "none"
+
+        # The speculative job runs without drafts once it waited long enough
+        assert await ngram_task == "none"
+        assert speculation.mode == "none"
+        assert speculation.active_jobs == 3
+        assert speculation.counters["ngram"]["fallbacks"] == 1
+
+        # The mode switches once the generator is idle
+        for _ in range(3):
+            speculation.release()
+        assert await speculation.acquire("ngram") == "ngram"
+        assert speculation.generator.generator.use_ngram_draft
+
+    asyncio.run(main())
+
+
+def test_speculative_groups_drain_for_waiting_jobs():
+    async def main():
+        speculation = create_scheduler(max_mode_wait=0.01)
+        assert await speculation.acquire("ngram") == "ngram"
+
+        default_task = asyncio.create_task(speculation.acquire("none"))
+        await asyncio.sleep(0.02)
+
+        # No new jobs join the group while another mode waits
+        ngram_task = asyncio.create_task(speculation.acquire("ngram"))
+        await asyncio.sleep(0.02)
+        assert not default_task.done() and not ngram_task.done()
+
+        speculation.release()
+        assert await default_task == "none"
+        assert await ngram_task == "none"
+
+    asyncio.run(main())
+
+
+def test_acquire_honors_deadline():
+    async def main():
+        speculation = create_scheduler()
+        await speculation.acquire("ngram")
+
+        with pytest.raises(SchedulerRejection) as exc_info:
+            await speculation.acquire("none", time.time() + 0.01)
+
+        assert exc_info.value.status_code == 504
+        assert not speculation.waiters
+
+        speculation.release()
+        assert speculation.active_jobs == 0
+
+    asyncio.run(main())
+
+
+def test_drafts_fit_the_logits_buffer():
+    async def main():
+        speculation = create_scheduler(num_draft_tokens=16, num_jump_tokens=16)
+        inner_generator = speculation.generator.generator
+
+        # The sampled token and the drafts share max_q_size positions
+        for mode in ("ngram", "jump_forward"):
+            assert await speculation.acquire(mode) == mode
+            assert inner_generator.num_draft_tokens == speculation.max_q_size - 1
+            speculation.release()
+
+        speculation = create_scheduler(max_q_size=4)
+        await speculation.acquire("jump_forward")
+        assert speculation.generator.generator.num_draft_tokens == 3
+
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Benchmark stream chunk serialization, before and after the chunk encoder.
+
+Run from the repository root with python -m tests.stream_bench
+"""
+
+import timeit
+from sse_starlette.event import ServerSentEvent
+
+from endpoints.OAI.utils import chat_completion, completion
+from endpoints.OAI.utils.stream import StreamChunkEncoder
+
+REQUEST_ID = "0123456789abcdef0123456789abcdef"
+MODEL_NAME = "Llama-3.1-8B-Instruct-exl2"
+NUMBER = 20_000
+
+generation = {
+    "index": 0,
+    "text": " token",
+    "offset": 42,
+    "prompt_tokens": 512,
+    "generated_tokens": 64,
+}
+
+
+def chat_models():
+    chunk = chat_completion._create_stream_chunk(REQUEST_ID, generation, MODEL_NAME)
+    return ServerSentEvent(data=chunk.model_dump_json()).encode()
+
+
+def completion_models():
+    response = completion._create_response(REQUEST_ID, generation, MODEL_NAME)
+    return ServerSentEvent(data=response.model_dump_json()).encode()
+
+
+chat_encoder = StreamChunkEncoder(
+    f"chatcmpl-{REQUEST_ID}", MODEL_NAME, "chat.completion.chunk"
+)
+completion_encoder = StreamChunkEncoder(
+    f"cmpl-{REQUEST_ID}", MODEL_NAME, "text_completion"
+)
+
+benchmarks = {
+    "chat (models)": chat_models,
+    "chat (encoder)": lambda: chat_completion._encode_stream_chunk(
+        chat_encoder, generation
+    ),
+    "completion (models)": completion_models,
+    "completion (encoder)": lambda: completion._encode_stream_chunk(
+        completion_encoder, generation
+    ),
+}
+
+for name, func in benchmarks.items():
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+    print(f"{name:<22} {NUMBER / seconds:>12,.0f} chunks/s")
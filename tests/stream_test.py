@@ -0,0 +1,238 @@
+"""Tests stream chunk encoding and coalescing."""
+
+import asyncio
+import json
+import pathlib
+import pytest
+import time
+from sse_starlette.event import ServerSentEvent
+from types import SimpleNamespace
+
+from common.logprobs import TokenLogprobs
+from common.networking import RequestDisconnect
+from common.scheduler import RequestScheduler, SchedulerTicket
+from endpoints.OAI.types import chat_completion as chat_types, completion as types
+from endpoints.OAI.types.tools import FunctionDelta, ToolCallDelta
+from endpoints.OAI.utils import chat_completion, completion, stream
+from endpoints.OAI.utils.stream import (
+    StreamBuffer,
+    StreamChunkEncoder,
+    StreamCoalescer,
+    StreamStalled,
+    stream_stats,
+)
+
+REQUEST_ID = "0123abcd"
+MODEL_NAME = 'model "name" \\ ü'
+
+GENERATIONS = [
+    {"index": 0, "text": "Hello", "prompt_tokens": 12, "generated_tokens": 1},
+    {"index": 1, "text": ' "quoted"\n\ttab \x01 ü 🙂  ', "generated_tokens": 2},
+    {"index": 0, "text": "", "prompt_tokens": 12, "generated_tokens": 3},
+    {
+        "index": 2,
+        "text": " a",
+        "offset": 7,
+        "prompt_tokens": 12,
+        "generated_tokens": 4,
+        "logprobs": TokenLogprobs(
+            [1], [" a"], [-0.25], [[" a", " b"]], [[-0.25, -1.5e-05]]
+        ),
+    },
+    {
+        "index": 1,
+        "prompt_tokens": 12,
+        "generated_tokens": 5,
+        "finish_reason": "stop",
+        "stop_str": "</s>",
+    },
+    {
+        "index": 0,
+        "prompt_tokens": 12,
+        "generated_tokens": 5,
+        "finish_reason": "length",
+        "stop_str": None,
+    },
+]
+
+
+@pytest.fixture(autouse=True)
+def fixed_time(monkeypatch):
+    for module in (stream, types, chat_types):
+        monkeypatch.setattr(module, "time", lambda: 1700000000.5)
+
+
+def encode_event(data: str):
+    return ServerSentEvent(data=data).encode()
+
+
+@pytest.mark.parametrize("generation", GENERATIONS)
+def test_completion_chunk(generation):
+    encoder = StreamChunkEncoder(f"cmpl-{REQUEST_ID}", MODEL_NAME, "text_completion")
+    response = completion._create_response(REQUEST_ID, generation, MODEL_NAME)
+
+    assert completion._encode_stream_chunk(encoder, generation) == encode_event(
+        response.model_dump_json()
+    )
+
+
+@pytest.mark.parametrize("generation", GENERATIONS)
+def test_chat_completion_chunk(generation):
+    encoder = StreamChunkEncoder(
+        f"chatcmpl-{REQUEST_ID}", MODEL_NAME, "chat.completion.chunk"
+    )
+    chunk = chat_completion._create_stream_chunk(REQUEST_ID, generation, MODEL_NAME)
+
+    assert chat_completion._encode_stream_chunk(encoder, generation) == encode_event(
+        chunk.model_dump_json()
+    )
+
+
+def test_chat_completion_tool_calls_chunk():
+    encoder = StreamChunkEncoder(
+        f"chatcmpl-{REQUEST_ID}", MODEL_NAME, "chat.completion.chunk"
+    )
+    generation = {
+        "index": 1,
+        "tool_calls_delta": [
+            ToolCallDelta(
+                index=0, id="call_1", type="function", function=FunctionDelta(name="f")
+            ),
+            ToolCallDelta(index=0, function=FunctionDelta(arguments='{"a": 1')),
+        ],
+    }
+    chunk = chat_completion._create_stream_chunk(REQUEST_ID, generation, MODEL_NAME)
+
+    assert chunk.choices[0].delta.tool_calls[1].function.arguments == '{"a": 1'
+    assert chat_completion._encode_stream_chunk(encoder, generation) == encode_event(
+        chunk.model_dump_json()
+    )
+
+
+def test_coalescer_passes_through_without_backlog():
+    async def main():
+        queue = StreamBuffer("test", 4096)
+        coalescer = StreamCoalescer(queue, 0.05, 4096)
+
+        await queue.put({"index": 0, "text": "a"})
+        assert await coalescer.get() == {"index": 0, "text": "a"}
+
+        await queue.put({"index": 0, "text": "b"})
+        assert await coalescer.get() == {"index": 0, "text": "b"}
+        assert coalescer.empty()
+
+    asyncio.run(main())
+
+
+def test_coalescer_merges_backlog():
+    async def main():
+        queue = StreamBuffer("test", 4096)
+        coalescer = StreamCoalescer(queue, 0.01, 4096)
+
+        for generation in (
+            {"index": 0, "text": "a", "generated_tokens": 1},
+            {"index": 1, "text": "x", "generated_tokens": 1},
+            {"index": 0, "text": "b", "generated_tokens": 2},
+            {"index": 0, "finish_reason": "stop", "generated_tokens": 2},
+            {"index": 1, "text": "y", "generated_tokens": 2},
+        ):
+            await queue.put(generation)
+
+        results = [await coalescer.get() for _ in range(3)]
+        assert coalescer.empty()
+
+        # Text of a choice is sent before its finish generation
+        assert results == [
+            {"index": 0, "text": "ab", "generated_tokens": 2},
+            {"index": 0, "finish_reason": "stop", "generated_tokens": 2},
+            {"index": 1, "text": "xy", "generated_tokens": 2},
+        ]
+
+    asyncio.run(main())
+
+
+def test_coalescer_byte_threshold():
+    async def main():
+        queue = StreamBuffer("test", 4096)
+        coalescer = StreamCoalescer(queue, 1.0, 4)
+
+        for text in ("ab", "cd", "ef"):
+            await queue.put({"index": 0, "text": text})
+
+        assert (await coalescer.get())["text"] == "abcd"
+        assert (await coalescer.get())["text"] == "ef"
+
+    asyncio.run(main())
+
+
+def test_buffer_pauses_when_full():
+    async def main():
+        buffer = StreamBuffer("paused", 4)
+
+        await buffer.put({"index": 0, "text": "ab"})
+        await buffer.put({"index": 0, "text": "cd"})
+        assert stream_stats.stats()["streams"]["paused"] == 4
+
+        # The writer waits until the client reads
+        writer = asyncio.create_task(buffer.put({"index": 0, "text": "ef"}))
+        await asyncio.sleep(0)
+        assert not writer.done()
+
+        # Buffered chunks were merged
+        assert await buffer.get() == {"index": 0, "text": "abcd"}
+        await writer
+        assert await buffer.get() == {"index": 0, "text": "ef"}
+
+        # The end of the stream is always accepted
+        await buffer.put({"index": 0, "text": "ghij"})
+        await buffer.put({"index": 0, "finish_reason": "stop"})
+        await buffer.put(None)
+
+        buffer.close()
+        assert "paused" not in stream_stats.buffers
+
+    asyncio.run(main())
+
+
+def test_buffer_stall_timeout():
+    async def main():
+        buffer = StreamBuffer("stalled", 1, stall_timeout=0.01)
+        await buffer.put({"index": 0, "text": "a"})
+
+        with pytest.raises(StreamStalled):
+            await buffer.put({"index": 0, "text": "b"})
+
+        buffer.close()
+
+    asyncio.run(main())
+
+
+def test_stream_reports_queue_deadline(monkeypatch):
+    async def main():
+        scheduler = RequestScheduler(max_active_jobs=1)
+        monkeypatch.setattr(completion, "scheduler", scheduler)
+        scheduler._admit(SchedulerTicket("active", "interactive", 10))
+
+        request = SimpleNamespace(
+            state=SimpleNamespace(id=REQUEST_ID),
+            scope={"request_disconnect": RequestDisconnect()},
+        )
+        ticket = SchedulerTicket(
+            REQUEST_ID, "interactive", 10, deadline=time.time() + 0.02
+        )
+        data = types.CompletionRequest(prompt="Hello", stream=True)
+
+        events = [
+            event
+            async for event in completion.stream_generate_completion(
+                data, request, pathlib.Path(MODEL_NAME), ticket
+            )
+        ]
+
+        # The stream already started, so the status is sent in the error
+        assert len(events) == 1
+        error = json.loads(events[0])["error"]
+        assert error["code"] == 504
+        assert "deadline passed while it was queued" in error["message"]
+
+    asyncio.run(main())
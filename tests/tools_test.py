@@ -0,0 +1,76 @@
+"""Tests streaming of generated tool calls."""
+
+import json
+import pytest
+
+from endpoints.OAI.utils.tools import ToolCallProcessor, ToolCallStreamer
+
+TOOL_CALLS = json.dumps(
+    [
+        {
+            "id": "call_1",
+            "function": {
+                "name": "get_weather",
+                "arguments": {"city": 'Paris "FR" }', "days": [1, {"a": 2}]},
+            },
+            "type": "function",
+        },
+        {
+            "id": "call_2",
+            "function": {"name": "noop", "arguments": {}},
+            "type": "function",
+        },
+    ]
+)
+
+
+def stream_tool_calls(text: str, chunk_size: int):
+    streamer = ToolCallStreamer()
+
+    deltas = []
+    for start in range(0, len(text), chunk_size):
+        deltas.extend(streamer.feed(text[start : start + chunk_size]))
+
+    return streamer, deltas
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, len(TOOL_CALLS)])
+def test_streamed_tool_calls_match(chunk_size):
+    streamer, deltas = stream_tool_calls(TOOL_CALLS, chunk_size)
+    assert streamer.calls == 2
+
+    # The first part of each call has its id and name
+    headers = [delta for delta in deltas if delta.id]
+    assert [(delta.index, delta.id, delta.function.name) for delta in headers] == [
+        (0, "call_1", "get_weather"),
+        (1, "call_2", "noop"),
+    ]
+
+    arguments = ["", ""]
+    for delta in deltas:
+        arguments[delta.index] += delta.function.arguments
+
+    expected = ToolCallProcessor.from_json(TOOL_CALLS)
+    assert [json.loads(value) for value in arguments] == [
+        json.loads(tool_call.function.arguments) for tool_call in expected
+    ]
+
+
+def test_arguments_are_sent_while_generated():
+    streamer = ToolCallStreamer()
+
+    deltas = streamer.feed('[{"id": "a", "function": {"name": "f", "arguments": {"x"')
+    assert [delta.function.arguments for delta in deltas] == ["", '{"x"']
+
+    deltas = streamer.feed(": 1}")
+    assert [delta.function.arguments for delta in deltas] == [": 1}"]
+
+    # Nothing after the arguments is sent
+    assert streamer.feed('}, "type": "function"}]') == []
+
+
+def test_missing_id_is_generated():
+    _, deltas = stream_tool_calls('[{"function": {"name": "f", "arguments": {}}}]', 3)
+
+    assert deltas[0].id.startswith("call_")
+    assert deltas[0].type == "function"
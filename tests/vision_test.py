@@ -0,0 +1,107 @@
+"""Tests the content-addressed image embedding cache."""
+
+import asyncio
+import pytest
+
+from backends.exllamav2.vision import ImageEmbeddingCache
+from common.images import ImagePreprocessPolicy
+
+
+@pytest.fixture
+def blue_png(encode_png):
+    return encode_png((0, 0, 255))
+
+
+class FakeEmbedding:
+    def __init__(self, size: int, index: int, image_size=None):
+        self.size = size
+        self.text_alias = f"<$EMB_{index}$>"
+        self.image_size = image_size
+
+    def get_size_in_bytes(self):
+        return self.size
+
+
+class FakeVisionModel:
+    """Creates embeddings of a fixed size and counts the calls."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.calls = 0
+
+    def get_image_embeddings(self, model, tokenizer, image, text_alias):
+        self.calls += 1
+        return FakeEmbedding(self.size, self.calls, image.size)
+
+
+def test_identical_images_are_embedded_once(red_png, blue_png, data_url):
+    async def main():
+        vision_model = FakeVisionModel(100)
+        cache = ImageEmbeddingCache(vision_model, None, None, 1000)
+
+        # Same bytes under different URLs
+        urls = [data_url(red_png), data_url(blue_png), data_url(red_png, "x-png")]
+        red, blue, red_again = await cache.get_embeddings(urls)
+        assert red is red_again and red is not blue
+        assert vision_model.calls == 2
+
+        # Concurrent requests share the embedding
+        results = await asyncio.gather(
+            cache.get_embeddings(urls[:1]), cache.get_embeddings(urls[2:])
+        )
+        assert results == [[red], [red]]
+        assert vision_model.calls == 2
+
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["bytes"] == 200
+        assert stats["hits"] == 2
+
+        # Concurrent misses wait on the same embedding
+        cache.clear()
+        results = await asyncio.gather(
+            cache.get_embeddings(urls[:1]), cache.get_embeddings(urls[2:])
+        )
+        assert results[0] == results[1]
+        assert vision_model.calls == 3
+
+    asyncio.run(main())
+
+
+def test_cache_is_bounded_by_bytes(red_png, blue_png, data_url):
+    async def main():
+        vision_model = FakeVisionModel(600)
+        cache = ImageEmbeddingCache(vision_model, None, None, 1000)
+
+        await cache.get_embeddings([data_url(red_png)])
+        await cache.get_embeddings([data_url(blue_png)])
+        await cache.get_embeddings([data_url(red_png)])
+
+        assert vision_model.calls == 3
+        assert cache.stats()["evictions"] == 2
+        assert cache.stats()["bytes"] == 600
+
+        cache.clear()
+        assert cache.stats()["entries"] == 0
+
+    asyncio.run(main())
+
+
+def test_policy_is_part_of_the_key(encode_png, data_url):
+    async def main():
+        vision_model = FakeVisionModel(100)
+        cache = ImageEmbeddingCache(vision_model, None, None, 1000)
+        url = data_url(encode_png((0, 255, 0), size=(64, 32)))
+
+        (full,) = await cache.get_embeddings([url])
+        (small,) = await cache.get_embeddings([url], ImagePreprocessPolicy(max_side=16))
+        (small_again,) = await cache.get_embeddings(
+            [url], ImagePreprocessPolicy(max_side=16)
+        )
+
+        assert full.image_size == (64, 32)
+        assert small.image_size == (16, 8)
+        assert small is small_again
+        assert vision_model.calls == 2
+
+    asyncio.run(main())